@@ -0,0 +1,175 @@
+"""@package benchmarks.fetch_queue
+Shared fetch queue benchmark of the URL Automation database.
+Queues synthetic domain names in a temporary database, then starts worker
+processes that claim, "fetch" (sleep) and release them concurrently, as
+several `worker run` commands sharing a database do. One of the workers
+crashes after its first claim, without releasing its leases, so that the
+other workers take its domains over once the leases expire.
+It checks that no domain was fetched by two workers while holding a lease,
+that every domain ends up done, and reports the throughput of the queue.
+
+Usage: python benchmarks/fetch_queue.py [--domains N] [--workers N] [--claim N]
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+from tempfile import TemporaryDirectory
+
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from urlautomation.database.manager import DatabaseManager  # noqa: E402
+from urlautomation.database.types import FetchQueue  # noqa: E402
+
+JOB_NAME = "queue-benchmark"
+
+
+def worker(
+    db_path: str,
+    name: str,
+    claim: int,
+    lease: float,
+    delay: float,
+    crash: bool,
+    results: multiprocessing.Queue,
+) -> None:
+    """Claims and releases domains until the queue is drained.
+    Sends the (domain, released) pairs of the worker on the result queue.
+    """
+    database = DatabaseManager(db_path)
+    released = []
+    while True:
+        with database as session:
+            claimed = database.claim_fetches(session, JOB_NAME, name, claim, lease)
+        if crash:
+            # Leave the leases behind, for the other workers to take over.
+            break
+        if not claimed:
+            with database as session:
+                status = database.queue_status(session, JOB_NAME)
+            if not status[FetchQueue.LEASED]:
+                break
+            time.sleep(lease / 4)
+            continue
+        for domain_name in claimed:
+            time.sleep(delay)
+            with database as session:
+                released.append(
+                    (
+                        domain_name,
+                        database.release_fetch(
+                            session, JOB_NAME, domain_name, name, FetchQueue.DONE
+                        ),
+                    )
+                )
+    results.put((name, released))
+
+
+def main():
+    parser = ArgumentParser(description="URL Automation fetch queue benchmark")
+    parser.add_argument("--domains", type=int, default=1000, help="Queued domains")
+    parser.add_argument("--workers", type=int, default=4, help="Worker processes")
+    parser.add_argument("--claim", type=int, default=10, help="Domains per claim")
+    parser.add_argument(
+        "--lease", type=float, default=2, help="Duration of the leases in seconds"
+    )
+    parser.add_argument(
+        "--delay", type=float, default=0.005, help="Simulated fetch time in seconds"
+    )
+    parser.add_argument(
+        "--output", default=None, help="Write the results to this JSON file"
+    )
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "queue.db")
+        database = DatabaseManager(db_path)
+        names = [f"domain{i:07d}.example" for i in range(args.domains)]
+        with database as session:
+            database.enqueue_fetches(session, JOB_NAME, names)
+
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=worker,
+                args=(
+                    db_path,
+                    f"worker-{i}",
+                    args.claim,
+                    args.lease,
+                    args.delay,
+                    i == 0,
+                    results,
+                ),
+            )
+            for i in range(args.workers + 1)
+        ]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        released = dict(results.get() for _ in processes)
+        elapsed = time.perf_counter() - start
+        for process in processes:
+            process.join()
+
+        with database as session:
+            status = database.queue_status(session, JOB_NAME)
+            attempts = Counter(
+                attempt
+                for (attempt,) in session.query(FetchQueue.attempts).filter(
+                    FetchQueue.job_name == JOB_NAME
+                )
+            )
+        database._engine.dispose()
+
+    completed = Counter(
+        domain_name
+        for pairs in released.values()
+        for domain_name, succeeded in pairs
+        if succeeded
+    )
+    lost = sum(not succeeded for pairs in released.values() for _, succeeded in pairs)
+    duplicates = [name for name, count in completed.items() if count > 1]
+    missing = args.domains - len(completed)
+
+    print(f"workers           {args.workers} (+1 crashing)")
+    print(f"domains           {args.domains}")
+    print(f"elapsed           {elapsed:.2f} s (lease {args.lease} s)")
+    print(f"throughput        {args.domains / elapsed:.0f} domains/s")
+    for name in sorted(released):
+        print(f"  {name:<15} {len(released[name])} released")
+    print(f"attempts          {dict(sorted(attempts.items()))}")
+    print(f"lost leases       {lost}")
+    print(f"queue             {status}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "workers": args.workers,
+                    "domains": args.domains,
+                    "elapsed": elapsed,
+                    "status": status,
+                    "lost": lost,
+                },
+                f,
+                indent=2,
+            )
+
+    if duplicates or missing or status[FetchQueue.DONE] != args.domains:
+        print(
+            f"FAILED: {len(duplicates)} domains completed twice, {missing} missing",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,386 @@
+"""@package benchmarks.ingest
+Ingest and parser micro-benchmarks of the URL Automation fetchers.
+The benchmarks are driven by the --simulate fixtures in testdata/:
+- parse_certificate_text: CrtshDataFetcher._parse_certificate_data_string
+  over certificate texts rendered from the testdata/crtsh_*_parsed.json files
+  (crt.sh pages are not stored in testdata, so their text is rebuilt in the
+  layout of `openssl x509 -text`).
+- deduplicate_results: CrtshDataFetcher._deduplicate_results over all the
+  testdata/crtsh_<domain>.json search results.
+- crtsh_ingest and securitytrails_ingest: a simulated fetch of all the
+  fixture domains into a fresh SQLite database, replaying the responses from
+  the JSON files of testdata, or from a capture archive packed from them
+  (crtsh_ingest_archive and securitytrails_ingest_archive).
+- crtsh_ingest_large: 2,000 synthetic crt.sh results over 200 domains,
+  committed every 500 records, and in a single unit of work
+  (crtsh_ingest_large_unchunked), to compare their peak memory.
+Each benchmark reports its duration, rows per second and peak (Python) memory.
+Results are written as JSON, and can be compared against a baseline run.
+
+Usage: python benchmarks/ingest.py [--repeat N] [--output FILE] [--baseline FILE]
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+from statistics import median
+from tempfile import TemporaryDirectory
+from typing import Any, Callable, Dict, List, Tuple
+
+import glob
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from urlautomation.database.archive import CaptureArchive, pack_directory  # noqa: E402
+from urlautomation.database.fetchers import load_datafetcher  # noqa: E402
+from urlautomation.database.manager import DatabaseManager  # noqa: E402
+from urlautomation.database.types import Base  # noqa: E402
+
+import sqlalchemy  # noqa: E402
+
+TESTDATA = os.path.join(ROOT, "testdata")
+
+
+def fixture_domains() -> List[str]:
+    """Returns the domains that have crt.sh and SecurityTrails fixtures."""
+    return sorted(
+        os.path.basename(path)[len("crtsh_") : -len(".json")]
+        for path in glob.glob(os.path.join(TESTDATA, "crtsh_*.json"))
+        if not path.endswith("_parsed.json")
+    )
+
+
+def render_certificate_text(parsed: Dict[str, Any]) -> str:
+    """Rebuilds the text of a certificate page of crt.sh from its parsed
+    fixture, in the layout expected by the crt.sh parser.
+    """
+    issuer = " ".join(f"{key} = {value}" for key, value in parsed["issuer"].items())
+    subject = ", ".join(f"{key} = {value}" for key, value in parsed["subject"].items())
+    public_key = parsed["public_key_info"]
+    extensions = parsed["extensions"]
+    key_usage = extensions.get("key_usage", "Digital Signature")
+    lines = [
+        "Certificate:",
+        "    Data:",
+        f"        Version: {parsed['version']} (0x2)",
+        f"        Serial Number: {parsed['serial_number']}",
+        f"    Signature Algorithm: {parsed['signature_algorithm']}",
+        f"        Issuer: {issuer}",
+        "        Validity",
+        f"            Not Before: {parsed['validity']['not_before']} GMT",
+        f"            Not After : {parsed['validity']['not_after']} GMT",
+        f"        Subject: {subject}",
+        "        Subject Public Key Info:",
+        f"            Public Key Algorithm: {public_key['algorithm']}",
+    ]
+    if "key_size" in public_key:
+        modulus = public_key.get("modulus", "")
+        lines += [
+            f"                RSA Public-Key: ({public_key['key_size']} bit)",
+            "                Modulus:",
+            *(
+                "                    "
+                + ":".join(modulus[i : i + 30][j : j + 2] for j in range(0, 30, 2))
+                for i in range(0, len(modulus), 30)
+            ),
+            f"                Exponent: {public_key.get('exponent', 65537)} (0x10001)",
+        ]
+    lines += [
+        "        X509v3 extensions:",
+        # The parsed key usage ends with the "X" of the next "X509v3" line.
+        f"            X509v3 Key Usage: {key_usage.removesuffix(' X')}",
+        f"            X509v3 Extended Key Usage: {extensions.get('extended_key_usage', 'TLS')} Web Server Authentication",
+        f"            X509v3 Basic Constraints: critical CA:{'TRUE' if extensions.get('basic_constraints', {}).get('CA') else 'FALSE'}",
+        f"            X509v3 Subject Key Identifier: {parsed['subject_key_identifier']}",
+        f"            X509v3 Authority Key Identifier: keyid:{parsed['authority_key_identifier']}",
+        "            Authority Information Access:",
+        f"                CA Issuers - URI:{parsed['authority_information_access'].get('ca_issuers', '')}",
+        f"                OCSP - URI:{parsed['authority_information_access'].get('ocsp', '')}",
+        "            X509v3 Subject Alternative Name:",
+        "                "
+        + ", ".join(f"DNS:{name}" for name in parsed["subject_alternative_names"]),
+        f"            X509v3 Certificate Policies: Policy: {parsed['certificate_policies']}",
+    ]
+    if "crl_distribution_point" in parsed:
+        lines += [
+            "            X509v3 CRL Distribution Points:",
+            f"                Full Name: URI:{parsed['crl_distribution_point']}",
+        ]
+    for sct in parsed.get("ct_precertificate_scts", []):
+        lines += [
+            "                Signed Certificate Timestamp:",
+            f"                    Version   : {sct['version']}",
+            f"                    Log Name  : {sct['log_name']}",
+            f"                    Log ID    : {sct['log_id']}",
+            f"                    Timestamp : {sct['timestamp']} GMT",
+        ]
+    signature = parsed["final_signature"]
+    lines += [
+        f"    Signature Algorithm: {parsed['final_signature_algorithm']}",
+        *(
+            "         "
+            + ":".join(signature[i : i + 36][j : j + 2] for j in range(0, 36, 2))
+            for i in range(0, len(signature), 36)
+        ),
+    ]
+    return "\n".join(lines)
+
+
+def count_rows(database: DatabaseManager) -> int:
+    """Returns the number of rows in all the tables of the database."""
+    with database as session:
+        return sum(
+            session.execute(
+                sqlalchemy.select(sqlalchemy.func.count()).select_from(table)
+            ).scalar()
+            for table in Base.metadata.sorted_tables
+        )
+
+
+def parse_benchmark() -> Tuple[Callable[[], int], Callable[[], None]]:
+    crtsh = load_datafetcher("crtsh")(None)
+    texts = []
+    for path in sorted(glob.glob(os.path.join(TESTDATA, "crtsh_*_parsed.json"))):
+        with open(path, "r") as f:
+            texts.append(render_certificate_text(json.load(f)))
+    # Parse every certificate several times to get a measurable duration.
+    texts *= 20
+
+    def run() -> int:
+        for text in texts:
+            crtsh._parse_certificate_data_string(text)
+        return len(texts)
+
+    return run, lambda: None
+
+
+def deduplicate_benchmark() -> Tuple[Callable[[], int], Callable[[], None]]:
+    crtsh = load_datafetcher("crtsh")(None)
+    results = []
+    for domain in fixture_domains():
+        with open(os.path.join(TESTDATA, f"crtsh_{domain}.json"), "r") as f:
+            results.extend(json.load(f))
+    results *= 50
+
+    def run() -> int:
+        crtsh._deduplicate_results(results)
+        return len(results)
+
+    return run, lambda: None
+
+
+def ingest_benchmark(
+    fetcher: str, archive: bool = False
+) -> Callable[[], Tuple[Callable[[], int], Callable[[], None]]]:
+    def setup() -> Tuple[Callable[[], int], Callable[[], None]]:
+        directory = TemporaryDirectory()
+        database = DatabaseManager(os.path.join(directory.name, "benchmark.db"))
+        arguments = {"simulate": True}
+        if fetcher == "securitytrails":
+            arguments["apikey"] = ""
+        if archive:
+            arguments["archive"] = CaptureArchive(
+                os.path.join(directory.name, "testdata.uacap")
+            )
+            pack_directory(arguments["archive"], TESTDATA)
+
+        def run() -> int:
+            database.fetch_data(fetcher, fixture_domains(), **arguments)
+            return count_rows(database)
+
+        def cleanup() -> None:
+            if archive:
+                arguments["archive"].close()
+            database._engine.dispose()
+            directory.cleanup()
+
+        return run, cleanup
+
+    return setup
+
+
+def large_crtsh_batch(results: int = 2000, domains: int = 200) -> Dict[str, Any]:
+    """Returns a crt.sh batch of distinct certificates spread over many
+    domains, as a large backfill would return.
+    """
+    return {
+        "results": [
+            {
+                "id": i,
+                "issuer_ca_id": 1000 + i % 7,
+                "issuer_name": f"C=US, O=Benchmark CA, CN=Benchmark CA {i % 7}",
+                "name_value": f"www.domain{i % domains}.example\ndomain{i % domains}.example",
+                "serial_number": f"{i:032x}",
+                "entry_timestamp": "2024-01-01T00:00:00.000",
+                "not_before": "2024-01-01T00:00:00",
+                "not_after": "2024-04-01T00:00:00",
+            }
+            for i in range(results)
+        ],
+        "certificates": {},
+    }
+
+
+def large_ingest_benchmark(
+    chunk_size: int,
+) -> Callable[[], Tuple[Callable[[], int], Callable[[], None]]]:
+    def setup() -> Tuple[Callable[[], int], Callable[[], None]]:
+        directory = TemporaryDirectory()
+        database = DatabaseManager(
+            os.path.join(directory.name, "benchmark.db"),
+            ingest_chunk_size=chunk_size,
+        )
+        batch = large_crtsh_batch()
+
+        def run() -> int:
+            database.ingest_data("crtsh", batch)
+            return count_rows(database)
+
+        def cleanup() -> None:
+            database._engine.dispose()
+            directory.cleanup()
+
+        return run, cleanup
+
+    return setup
+
+
+BENCHMARKS = {
+    "parse_certificate_text": parse_benchmark,
+    "deduplicate_results": deduplicate_benchmark,
+    "crtsh_ingest": ingest_benchmark("crtsh"),
+    "securitytrails_ingest": ingest_benchmark("securitytrails"),
+    "crtsh_ingest_archive": ingest_benchmark("crtsh", archive=True),
+    "securitytrails_ingest_archive": ingest_benchmark("securitytrails", archive=True),
+    "crtsh_ingest_large": large_ingest_benchmark(500),
+    "crtsh_ingest_large_unchunked": large_ingest_benchmark(10**9),
+}
+
+
+def measure(setup, repeat: int) -> Dict[str, Any]:
+    """Runs a benchmark repeat times (each run with a fresh setup), then once
+    more under tracemalloc to measure its peak memory.
+    """
+    times, rows = [], 0
+    for _ in range(repeat):
+        run, cleanup = setup()
+        start = time.perf_counter()
+        rows = run()
+        times.append(time.perf_counter() - start)
+        cleanup()
+
+    run, cleanup = setup()
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cleanup()
+
+    return {
+        "rows": rows,
+        "seconds_median": median(times),
+        "seconds_min": min(times),
+        "rows_per_second": rows / median(times),
+        "peak_memory_bytes": peak,
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(
+    results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> bool:
+    """Prints the change of each benchmark against a baseline run.
+    @return True if a benchmark is slower than the baseline by more than the
+    tolerance (a fraction, e.g. 0.1 for 10%).
+    """
+    regressed = False
+    print(f"\nCompared to {baseline['meta']['revision']} ({baseline['meta']['date']}):")
+    for name, result in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]
+        change = result["seconds_median"] / before["seconds_median"] - 1
+        memory = result["peak_memory_bytes"] / max(before["peak_memory_bytes"], 1) - 1
+        status = "REGRESSION" if change > tolerance else "ok"
+        regressed |= change > tolerance
+        print(f"{name:<24} time {change:+7.1%}  memory {memory:+7.1%}  [{status}]")
+    return regressed
+
+
+def main():
+    parser = ArgumentParser(description="URL Automation ingest benchmarks")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per benchmark")
+    parser.add_argument(
+        "--only", nargs="+", choices=list(BENCHMARKS), help="Benchmarks to run"
+    )
+    parser.add_argument(
+        "--output", default=None, help="Write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--baseline", default=None, help="JSON results to compare against"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Slowdown against the baseline reported as a regression (0.1 is 10%%)",
+    )
+    args = parser.parse_args()
+
+    # The fetchers read the fixtures relatively to the repository root.
+    os.chdir(ROOT)
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {
+        "meta": {
+            "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "revision": git_revision(),
+            "python": platform.python_version(),
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": {},
+    }
+    for name in args.only or BENCHMARKS:
+        result = measure(BENCHMARKS[name], args.repeat)
+        results["results"][name] = result
+        print(
+            f"{name:<24} {result['seconds_median'] * 1000:9.1f} ms "
+            f"{result['rows_per_second']:12.0f} rows/s "
+            f"{result['peak_memory_bytes'] / 2**20:8.1f} MiB peak"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    regressed = False
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressed = compare(results, json.load(f), args.tolerance)
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""@package benchmarks.scale
+Query scale benchmark of the URL Automation CLI.
+Generates synthetic databases of increasing sizes (see benchmarks/synthetic.py)
+and times the query commands against each of them, so that the growth of their
+cost with the size of the data (linear, quadratic...) shows up. The commands
+run in-process, their output being discarded, so only the work of the command
+itself is measured. Generated databases are kept in --data-dir and reused by
+later runs.
+
+Usage: python benchmarks/scale.py [--sizes 10000 100000 1000000] [--runs N]
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from statistics import median
+from typing import Dict, List
+
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import generate  # noqa: E402
+from urlautomation.cli import CommandLine  # noqa: E402
+from urlautomation.database.manager import DatabaseManager  # noqa: E402
+
+from sqlalchemy import text  # noqa: E402
+
+# Benchmarked commands, {name} placeholders being filled by targets().
+COMMANDS = {
+    "domain search": ["domain", "search", "{domain}"],
+    "domain search (hub)": ["domain", "search", "{hub_domain}"],
+    "domain search --contains": ["domain", "search", "--contains", "poker"],
+    "domain query": ["domain", "query", "{domain}"],
+    "domain list (page)": ["domain", "list", "--limit", "100", "--after", "m"],
+    "domain list (all)": ["domain", "list"],
+    "case report": ["case", "report", "--case", "{case}"],
+}
+
+
+def targets(database: DatabaseManager) -> Dict[str, str]:
+    """Picks the domains and case the commands are run against: a typical
+    domain, a domain of the most shared IP address, and the largest case.
+    """
+    with database as session:
+        return {
+            "domain": session.execute(
+                text(
+                    "SELECT domain_name FROM domains "
+                    "WHERE domain_id = (SELECT max(domain_id) / 2 FROM domains)"
+                )
+            ).scalar(),
+            "hub_domain": session.execute(
+                text(
+                    "SELECT domain_name FROM domains "
+                    "JOIN dns_records ON dns_records.domain_id = domains.domain_id "
+                    "JOIN a_record_values ON a_record_values.dns_record_id = dns_records.record_id "
+                    "JOIN a_record_ip_association USING (a_record_value_id) "
+                    "WHERE ip_id = (SELECT entity_id FROM entity_degrees "
+                    "WHERE entity_type = 'ip' ORDER BY degree DESC LIMIT 1) LIMIT 1"
+                )
+            ).scalar(),
+            "case": session.execute(
+                text(
+                    "SELECT case_name FROM cases JOIN case_domains USING (case_id) "
+                    "GROUP BY cases.case_id ORDER BY count(*) DESC LIMIT 1"
+                )
+            ).scalar(),
+        }
+
+
+def time_command(command_line: CommandLine, arguments: List[str], runs: int) -> float:
+    """Runs a command several times in-process.
+    @return The median wall time of the runs, in milliseconds.
+    """
+    args = CommandLine.build_parser().parse_args(arguments)
+    times = []
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        for _ in range(runs):
+            start = time.perf_counter()
+            command_line.execute(args)
+            times.append((time.perf_counter() - start) * 1000)
+    return median(times)
+
+
+def main():
+    parser = ArgumentParser(description="URL Automation query scale benchmark")
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10000, 100000, 1000000],
+        help="Numbers of domains of the generated databases",
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Runs per command")
+    parser.add_argument(
+        "--only", nargs="+", choices=list(COMMANDS), help="Commands to run"
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "urlautomation-scale"),
+        help="Directory of the generated databases",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator")
+    parser.add_argument(
+        "--output", default=None, help="Write the results to this JSON file"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    os.makedirs(args.data_dir, exist_ok=True)
+    commands = args.only or list(COMMANDS)
+
+    results = {}
+    for size in args.sizes:
+        db_path = os.path.join(args.data_dir, f"synthetic_{size}_{args.seed}.db")
+        if not os.path.exists(db_path):
+            logging.info(f"Generating {db_path}...")
+            generate(db_path, size, seed=args.seed)
+
+        database = DatabaseManager(db_path)
+        command_line = CommandLine({"db_path": db_path}, database)
+        names = targets(database)
+        # The commands log their results, keep only the warnings and errors.
+        logging.getLogger().setLevel(logging.WARNING)
+        results[size] = {}
+        for name in commands:
+            arguments = [argument.format(**names) for argument in COMMANDS[name]]
+            results[size][name] = time_command(command_line, arguments, args.runs)
+        logging.getLogger().setLevel(logging.INFO)
+        database._engine.dispose()
+
+    print(f"{'command':<26}" + "".join(f"{size:>14,}" for size in args.sizes))
+    for name in commands:
+        print(
+            f"{name:<26}"
+            + "".join(f"{results[size][name]:>11.1f} ms" for size in args.sizes)
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"runs": args.runs, "seed": args.seed, "results": results}, f, indent=2
+            )
+
+
+if __name__ == "__main__":
+    main()
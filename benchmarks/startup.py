@@ -0,0 +1,162 @@
+"""@package benchmarks.startup
+Startup benchmark of the URL Automation CLI.
+Runs read-only commands in fresh interpreters, as scripts calling the CLI do,
+and reports their wall time, beyond the startup of an empty interpreter,
+against the startup target. It also checks that the heavy optional libraries
+are not imported by the CLI itself.
+
+Usage: python benchmarks/startup.py [--runs N] [--target MS] [--server [--port PORT]]
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager, nullcontext
+from statistics import median
+from tempfile import TemporaryDirectory
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Read-only commands that scripts call many times a day.
+COMMANDS = [
+    ["case", "info", "Benchmark"],
+    ["case", "report", "--case", "Benchmark"],
+    ["domain", "list", "--limit", "10"],
+]
+
+# Libraries that are only needed by some commands, and must be imported lazily.
+LAZY_MODULES = ["requests", "lxml", "numpy", "pyarrow"]
+
+
+def run_cli(config_path: str, arguments: list, server: str = None) -> float:
+    """Runs the CLI once in a fresh interpreter.
+    @return The wall time of the run, in milliseconds.
+    """
+    options = ["-c", config_path] + (["--server", server] if server else [])
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "urlautomation.py", *options, *arguments],
+        cwd=ROOT,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return (time.perf_counter() - start) * 1000
+
+
+def interpreter_time(runs: int) -> float:
+    """Returns the median wall time of an empty interpreter, in milliseconds."""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], cwd=ROOT, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return median(times)
+
+
+@contextmanager
+def query_server(config_path: str, port: int):
+    """Runs a query server on the database of a configuration until the end
+    of the block (the server refuses the commands of another database).
+    @return The address of the server.
+    """
+    server = subprocess.Popen(
+        [sys.executable, "urlautomation.py", "-c", config_path]
+        + ["serve", "--port", str(port)],
+        cwd=ROOT,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if server.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("The query server did not start.")
+                time.sleep(0.1)
+        yield f"127.0.0.1:{port}"
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def eager_modules() -> list:
+    """Returns the lazy modules that are imported along with the CLI."""
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, urlautomation.cli; "
+            f"print(' '.join(m for m in {LAZY_MODULES!r} if m in sys.modules))",
+        ],
+        cwd=ROOT,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+    return output.split()
+
+
+def main():
+    parser = ArgumentParser(description="URL Automation CLI startup benchmark")
+    parser.add_argument("--runs", type=int, default=10, help="Runs per command")
+    parser.add_argument(
+        "--target",
+        type=float,
+        default=100,
+        help="Target startup overhead of read-only commands, beyond an empty interpreter, in milliseconds",
+    )
+    parser.add_argument(
+        "--server",
+        action="store_true",
+        help="Send the commands to a query server running on the benchmark database",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port of the query server, with --server",
+    )
+    args = parser.parse_args()
+
+    eager = eager_modules()
+    print(f"Modules imported eagerly: {', '.join(eager) if eager else 'none'}")
+
+    baseline = interpreter_time(args.runs)
+    print(f"Empty interpreter: {baseline:.1f} ms")
+
+    failed = bool(eager)
+    with TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "config.json")
+        with open(config_path, "w") as config_file:
+            json.dump({"db_path": os.path.join(directory, "benchmark.db")}, config_file)
+        # The first run creates the database schema, it is not measured.
+        run_cli(config_path, ["case", "create", "Benchmark"])
+
+        server = query_server(config_path, args.port) if args.server else nullcontext()
+        with server as address:
+            for arguments in COMMANDS:
+                times = sorted(
+                    run_cli(config_path, arguments, address) for _ in range(args.runs)
+                )
+                overhead = median(times) - baseline
+                status = "ok" if overhead <= args.target else "SLOW"
+                failed |= overhead > args.target
+                print(
+                    f"{' '.join(arguments):<30} median {median(times):7.1f} ms, "
+                    f"max {times[-1]:7.1f} ms, overhead {overhead:7.1f} ms [{status}]"
+                )
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""@package benchmarks.synthetic
+Synthetic dataset generator of the URL Automation database.
+Generates a database of any size with the shape of production data:
+- IP addresses, nameservers and organizations are shared following a power
+  law (Zipf), so that a few hubs (shared hosting, big registrars) are linked to
+  a large share of the domains while most entities have a handful of domains.
+- Domains move between IP addresses and nameservers over time (DNS history).
+- Most domains get short-lived certificates renewed every 60 days or so, in
+  the way of Let's Encrypt, some of them also covering a wildcard name.
+- Cases group domains, most of them around the infrastructure they share.
+Rows are written with bulk INSERT statements and explicit IDs, which is orders
+of magnitude faster than going through the fetchers. The text index is kept up
+to date by its triggers, and the degree counters are rebuilt at the end.
+
+Usage: python benchmarks/synthetic.py --domains N --db FILE [--seed S]
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from random import Random
+from typing import Any, Dict, List
+
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from urlautomation.database.manager import DatabaseManager  # noqa: E402
+from urlautomation.database.types import (  # noqa: E402
+    Case,
+    CaseDomain,
+    Domain,
+    DNSRecord,
+    ARecordValue,
+    ARecordIP,
+    NSRecordValue,
+    NSRecordNameserver,
+    Organization,
+    SSLCertificate,
+    SSLCertificateIdentity,
+    a_record_ip_association,
+    a_record_organizations,
+    ns_record_nameserver_association,
+    ssl_identity_domains,
+)
+
+from sqlalchemy import insert  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+WORDS = (
+    "alpha bank bet best big blue buy cash casino city cloud coin crypto daily "
+    "deal digital easy fast free game gold green group home hot link live lucky "
+    "mail market media mega money net online pay play poker prime pro quick red "
+    "secure shop smart spin star store sun super team tech top trade travel "
+    "trust web win world"
+).split()
+TLDS = ["com"] * 10 + ["net"] * 3 + ["org"] * 2 + ["io", "xyz", "top", "co.uk", "de"]
+ISSUERS = [
+    (183267, "C=US, O=Let's Encrypt, CN=R3"),
+    (183283, "C=US, O=Let's Encrypt, CN=E1"),
+    (185756, "C=US, O=DigiCert Inc, CN=DigiCert TLS RSA SHA256 2020 CA1"),
+    (
+        180753,
+        "C=GB, O=Sectigo Limited, CN=Sectigo RSA Domain Validation Secure Server CA",
+    ),
+]
+CASE_STATUSES = ["open"] * 7 + ["closed"] * 3
+
+
+def power_law_index(rng: Random, size: int) -> int:
+    """Draws an index in [0, size) with a probability proportional to
+    1 / (index + 1), i.e. the rank of an entity in a Zipf distribution.
+    """
+    return min(int(size ** rng.random()) - 1, size - 1)
+
+
+def ip_address(index: int) -> str:
+    """Returns a distinct IPv4 address for each index (below 2^32)."""
+    value = (index * 2654435761 + 0x0A000001) % 2**32
+    return ".".join(str(value >> shift & 0xFF) for shift in (24, 16, 8, 0))
+
+
+class SyntheticDataset:
+    """Generates a synthetic dataset into a database."""
+
+    def __init__(
+        self,
+        domains: int,
+        seed: int = 0,
+        years: float = 3,
+        end: datetime = None,
+    ):
+        """Class constructor for SyntheticDataset.
+        @param domains The number of domains to generate.
+        @param seed The seed of the random generator, the same seed always
+        generates the same dataset.
+        @param years The length of the DNS and certificate history.
+        @param end The end of the history, defaults to today.
+        """
+        self.domains = domains
+        self.rng = Random(seed)
+        self.end = end or datetime.now().replace(
+            hour=0, minute=0, second=0, microsecond=0
+        )
+        self.start = self.end - timedelta(days=365 * years)
+        self.ips = max(domains // 4, 10)
+        self.providers = max(domains // 100, 5)
+        self.organizations = max(domains // 200, 5)
+        self.cases = max(domains // 2000, 1)
+        self._names = set()
+        self._ids = {}
+        # The domains of each IP address, to build cases around them.
+        self._ip_domains: Dict[int, List[int]] = {}
+
+    def _next_id(self, table: str) -> int:
+        self._ids[table] = self._ids.get(table, 0) + 1
+        return self._ids[table]
+
+    def _random_date(self, after: datetime = None) -> datetime:
+        after = after or self.start
+        seconds = (self.end - after).total_seconds()
+        return after + timedelta(seconds=int(self.rng.random() * seconds))
+
+    def _domain_name(self) -> str:
+        rng = self.rng
+        while True:
+            name = "".join(rng.choice(WORDS) for _ in range(rng.choice([1, 2, 2, 3])))
+            if rng.random() < 0.3:
+                name += str(rng.randrange(1000))
+            if rng.random() < 0.05:
+                name = rng.choice(["www", "mail", "shop", "login"]) + "." + name
+            name = f"{name}.{rng.choice(TLDS)}"
+            if name not in self._names:
+                self._names.add(name)
+                return name
+
+    def _entities(self) -> Dict[Any, List[Dict[str, Any]]]:
+        """Returns the rows of the shared entities (IP addresses, nameservers
+        and organizations), by table.
+        """
+        return {
+            ARecordIP: [
+                {"ip_id": i + 1, "ip_address": ip_address(i)} for i in range(self.ips)
+            ],
+            NSRecordNameserver: [
+                {
+                    "nameserver_id": 2 * provider + server,
+                    "nameserver": f"ns{server}.{WORDS[provider % len(WORDS)]}dns{provider}.net",
+                }
+                for provider in range(self.providers)
+                for server in (1, 2)
+            ],
+            Organization: [
+                {
+                    "organization_id": i + 1,
+                    "organization_name": f"{WORDS[i % len(WORDS)].title()} Hosting {i}",
+                }
+                for i in range(self.organizations)
+            ],
+        }
+
+    def _history(self) -> List[List[datetime]]:
+        """Returns the (first seen, last seen) periods of a DNS history, as
+        contiguous periods from a random start to the end.
+        """
+        count = 1 + power_law_index(self.rng, 5)
+        dates = sorted(self._random_date() for _ in range(count + 1))
+        dates[-1] = self.end
+        return [[dates[i], dates[i + 1]] for i in range(count)]
+
+    def _domain_rows(self, rows: Dict[Any, List[Dict[str, Any]]]) -> None:
+        """Adds the rows of a new domain: DNS history and certificates."""
+        rng = self.rng
+        domain_id = self._next_id("domains")
+        domain_name = self._domain_name()
+        rows[Domain].append({"domain_id": domain_id, "domain_name": domain_name})
+        rows[DNSRecord].append({"record_id": domain_id, "domain_id": domain_id})
+
+        for first_seen, last_seen in self._history():
+            value_id = self._next_id("a_record_values")
+            rows[ARecordValue].append(
+                {
+                    "a_record_value_id": value_id,
+                    "dns_record_id": domain_id,
+                    "first_seen": first_seen,
+                    "last_seen": last_seen,
+                }
+            )
+            ip_ids = {
+                power_law_index(rng, self.ips) + 1
+                for _ in range(rng.choice([1, 1, 1, 2]))
+            }
+            for ip_id in ip_ids:
+                self._ip_domains.setdefault(ip_id, []).append(domain_id)
+                rows[a_record_ip_association].append(
+                    {"a_record_value_id": value_id, "ip_id": ip_id}
+                )
+            rows[a_record_organizations].append(
+                {
+                    "a_record_value_id": value_id,
+                    "organization_id": power_law_index(rng, self.organizations) + 1,
+                }
+            )
+
+        for first_seen, last_seen in self._history()[:2]:
+            value_id = self._next_id("ns_record_values")
+            rows[NSRecordValue].append(
+                {
+                    "ns_record_value_id": value_id,
+                    "dns_record_id": domain_id,
+                    "first_seen": first_seen,
+                    "last_seen": last_seen,
+                }
+            )
+            provider = power_law_index(rng, self.providers)
+            for server in (1, 2):
+                rows[ns_record_nameserver_association].append(
+                    {
+                        "ns_record_value_id": value_id,
+                        "nameserver_id": 2 * provider + server,
+                    }
+                )
+
+        if rng.random() < 0.25:
+            return
+        issuer_ca_id, issuer_name = rng.choice(ISSUERS)
+        names = [domain_name] + ([f"*.{domain_name}"] if rng.random() < 0.3 else [])
+        not_before = self._random_date()
+        while not_before < self.end:
+            certificate_id = self._next_id("ssl_certificates")
+            rows[SSLCertificate].append(
+                {
+                    "certificate_id": certificate_id,
+                    "issuer_ca_id": issuer_ca_id,
+                    "issuer_name": issuer_name,
+                    "common_name": domain_name,
+                    "entry_timestamp": not_before
+                    + timedelta(minutes=rng.randrange(60)),
+                    "not_before": not_before,
+                    "not_after": not_before + timedelta(days=90),
+                    "serial_number": f"{rng.getrandbits(128):032x}",
+                }
+            )
+            for name in names:
+                identity_id = self._next_id("ssl_certificates_identities")
+                rows[SSLCertificateIdentity].append(
+                    {
+                        "identity_id": identity_id,
+                        "certificate_id": certificate_id,
+                        "identity": name,
+                    }
+                )
+                rows[ssl_identity_domains].append(
+                    {"identity_id": identity_id, "domain_id": domain_id}
+                )
+            # Renewed about 30 days before the 90 days validity ends.
+            not_before += timedelta(days=60, hours=rng.randrange(-48, 48))
+
+    def _case_rows(self, rows: Dict[Any, List[Dict[str, Any]]]) -> None:
+        """Adds the rows of the cases. Most cases group the domains of a few
+        IP addresses (picked uniformly, so mostly small clusters rather than
+        hubs), padded with random domains.
+        """
+        rng = self.rng
+        for case_id in range(1, self.cases + 1):
+            rows[Case].append(
+                {
+                    "case_id": case_id,
+                    "case_name": f"Case {case_id:05d}",
+                    "investigating_officer": f"Officer {rng.randrange(20)}",
+                    "date_opened": self._random_date(),
+                    "case_status": rng.choice(CASE_STATUSES),
+                    "description": "Synthetic case",
+                }
+            )
+            size = min(10 + power_law_index(rng, 500), self.domains)
+            domain_ids = set()
+            while rng.random() < 0.8 and len(domain_ids) < size:
+                cluster = self._ip_domains.get(rng.randrange(self.ips) + 1, [])
+                domain_ids.update(cluster[: size - len(domain_ids)])
+            while len(domain_ids) < size:
+                domain_ids.add(rng.randrange(self.domains) + 1)
+            rows[CaseDomain].extend(
+                {"case_id": case_id, "domain_id": domain_id} for domain_id in domain_ids
+            )
+
+    @staticmethod
+    def _write(session, rows: Dict[Any, List[Dict[str, Any]]]) -> int:
+        count = 0
+        for table, table_rows in rows.items():
+            if table_rows:
+                session.execute(insert(table), table_rows)
+                count += len(table_rows)
+        return count
+
+    def generate(
+        self,
+        database: DatabaseManager,
+        chunk_size: int = 10000,
+        lookalikes: bool = False,
+    ) -> int:
+        """Generates the dataset into an empty database.
+        @param database The database to write to.
+        @param chunk_size The number of domains written per transaction.
+        @param lookalikes Whether to build the lookalike index, which is slow
+        (one BK-tree insertion per domain).
+        @return The number of rows written.
+        """
+        tables = [
+            Domain,
+            DNSRecord,
+            ARecordValue,
+            a_record_ip_association,
+            a_record_organizations,
+            NSRecordValue,
+            ns_record_nameserver_association,
+            SSLCertificate,
+            SSLCertificateIdentity,
+            ssl_identity_domains,
+            Case,
+            CaseDomain,
+        ]
+        count = 0
+        with database as session:
+            count += self._write(session, self._entities())
+
+        start = time.perf_counter()
+        for offset in range(0, self.domains, chunk_size):
+            rows = {table: [] for table in tables}
+            for _ in range(min(chunk_size, self.domains - offset)):
+                self._domain_rows(rows)
+            with database as session:
+                count += self._write(session, rows)
+            logger.info(
+                f"{offset + len(rows[Domain])} domains, {count} rows "
+                f"({time.perf_counter() - start:.0f} s)"
+            )
+
+        rows = {table: [] for table in tables}
+        self._case_rows(rows)
+        with database as session:
+            count += self._write(session, rows)
+            logger.info("Rebuilding degree counters...")
+            database.rebuild_degrees(session)
+            if lookalikes:
+                logger.info("Rebuilding lookalike index...")
+                database.rebuild_lookalikes(session)
+        return count
+
+
+def generate(
+    db_path: str,
+    domains: int,
+    seed: int = 0,
+    years: float = 3,
+    lookalikes: bool = False,
+) -> int:
+    """Generates a synthetic dataset into a new database file.
+    @return The number of rows written.
+    """
+    if os.path.exists(db_path):
+        raise FileExistsError(f"{db_path} already exists.")
+    dataset = SyntheticDataset(domains, seed=seed, years=years)
+    return dataset.generate(DatabaseManager(db_path), lookalikes=lookalikes)
+
+
+def main():
+    parser = ArgumentParser(description="URL Automation synthetic dataset generator")
+    parser.add_argument("--domains", type=int, required=True, help="Number of domains")
+    parser.add_argument("--db", required=True, help="Path of the database to create")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the generator")
+    parser.add_argument(
+        "--years", type=float, default=3, help="Length of the generated history"
+    )
+    parser.add_argument(
+        "--lookalikes",
+        action="store_true",
+        help="Also build the lookalike index (slow on large datasets)",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
+    start = time.perf_counter()
+    count = generate(args.db, args.domains, args.seed, args.years, args.lookalikes)
+    logger.info(
+        f"Generated {args.domains} domains ({count} rows) in "
+        f"{time.perf_counter() - start:.1f} s"
+    )
+
+
+if __name__ == "__main__":
+    main()
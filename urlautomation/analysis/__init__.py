@@ -0,0 +1,3 @@
+"""@package urlautomation.analysis
+This package contains analytics computed over the data in the database.
+"""
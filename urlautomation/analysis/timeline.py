@@ -0,0 +1,231 @@
+"""@package urlautomation.analysis.timeline
+This module contains the certificate timeline analytics.
+The timestamps of all the certificates of a case (or domain) are loaded into
+NumPy arrays with a single query, and every statistic is computed with
+vectorized operations, so that a run over millions of certificates takes
+seconds.
+"""
+
+from urlautomation.database.types import (
+    Case,
+    CaseDomain,
+    Domain,
+    SSLCertificate,
+    SSLCertificateIdentity,
+    ssl_identity_domains,
+)
+
+from sqlalchemy import Integer, cast, func, select
+
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+SECONDS_PER_DAY = 86400.0
+
+# NumPy datetime units used for the issuance histogram.
+BIN_UNITS = {"day": "D", "week": "W", "month": "M", "year": "Y"}
+
+
+def _epoch(column):
+    """Returns a SQL expression for a timestamp column as epoch seconds."""
+    return cast(func.strftime("%s", column), Integer)
+
+
+def load_timestamps(session, domain_ids) -> Dict[str, np.ndarray]:
+    """Loads the certificate timestamps of the given domains.
+    @param domain_ids A select of the IDs of the domains.
+    @return A dictionary of int64 arrays, one row per (domain, certificate):
+    "domain_id", "certificate_id", "entry" (entry timestamp), "not_before" and
+    "not_after", the timestamps being epoch seconds.
+    """
+    query = (
+        select(
+            ssl_identity_domains.c.domain_id,
+            SSLCertificate.certificate_id,
+            func.coalesce(
+                _epoch(SSLCertificate.entry_timestamp),
+                _epoch(SSLCertificate.not_before),
+            ),
+            _epoch(SSLCertificate.not_before),
+            _epoch(SSLCertificate.not_after),
+        )
+        .join(
+            SSLCertificateIdentity,
+            SSLCertificateIdentity.identity_id == ssl_identity_domains.c.identity_id,
+        )
+        .join(
+            SSLCertificate,
+            SSLCertificate.certificate_id == SSLCertificateIdentity.certificate_id,
+        )
+        .where(ssl_identity_domains.c.domain_id.in_(domain_ids))
+        .where(SSLCertificate.not_before.is_not(None))
+        .where(SSLCertificate.not_after.is_not(None))
+        .distinct()
+    )
+    rows = np.array(session.execute(query).all(), dtype=np.int64).reshape(-1, 5)
+    return {
+        name: rows[:, i]
+        for i, name in enumerate(
+            ["domain_id", "certificate_id", "entry", "not_before", "not_after"]
+        )
+    }
+
+
+def _stats(values: np.ndarray) -> Dict[str, Any]:
+    """Summarizes an array of durations in seconds, as days."""
+    if values.size == 0:
+        return {"count": 0}
+    days = values / SECONDS_PER_DAY
+    p10, median, p90 = np.percentile(days, [10, 50, 90])
+    return {
+        "count": int(days.size),
+        "min": round(float(days.min()), 2),
+        "p10": round(float(p10), 2),
+        "median": round(float(median), 2),
+        "mean": round(float(days.mean()), 2),
+        "p90": round(float(p90), 2),
+        "max": round(float(days.max()), 2),
+    }
+
+
+def _isoformat(seconds: int) -> str:
+    return str(np.datetime64(int(seconds), "s"))
+
+
+def analyze(
+    timestamps: Dict[str, np.ndarray],
+    bin: str = "month",
+    burst_size: int = 3,
+    max_bursts: int = 20,
+) -> Dict[str, Any]:
+    """Computes the timeline statistics of a set of certificates.
+    @param timestamps The arrays returned by load_timestamps().
+    @param bin The period of the issuance histogram (day, week, month, year).
+    @param burst_size The minimum number of distinct domains getting
+    certificates within the same minute to report a co-issuance burst.
+    @param max_bursts The maximum number of bursts reported, largest first.
+    @return A dictionary of statistics. Durations are in days.
+    """
+    domain_ids = timestamps["domain_id"]
+    certificate_ids = timestamps["certificate_id"]
+    not_before = timestamps["not_before"]
+    not_after = timestamps["not_after"]
+    entry = timestamps["entry"]
+
+    if domain_ids.size == 0:
+        return {"certificates": 0, "domains": 0}
+
+    # One row per certificate for certificate-level statistics.
+    _, first_rows = np.unique(certificate_ids, return_index=True)
+    cert_not_before = not_before[first_rows]
+    cert_not_after = not_after[first_rows]
+
+    # Issuance histogram
+    periods, counts = np.unique(
+        cert_not_before.astype("datetime64[s]").astype(f"datetime64[{BIN_UNITS[bin]}]"),
+        return_counts=True,
+    )
+
+    # Renewal intervals and validity overlaps between consecutive
+    # certificates of the same domain.
+    order = np.lexsort((not_before, domain_ids))
+    sorted_domains = domain_ids[order]
+    sorted_not_before = not_before[order]
+    sorted_not_after = not_after[order]
+    same_domain = sorted_domains[1:] == sorted_domains[:-1]
+    renewals = (sorted_not_before[1:] - sorted_not_before[:-1])[same_domain]
+    # Positive overlaps mean the new certificate was valid before the latest
+    # expiry of the previous ones, negative overlaps are coverage gaps. The
+    # running maximum of the expiry is kept per domain by offsetting each
+    # domain's expiries above those of the domains sorted before it.
+    group = np.r_[0, np.cumsum(~same_domain)]
+    base = sorted_not_after.min()
+    offset = group * (sorted_not_after.max() - base + 1)
+    covered_until = (
+        np.maximum.accumulate(sorted_not_after - base + offset) - offset + base
+    )
+    overlaps = (covered_until[:-1] - sorted_not_before[1:])[same_domain]
+
+    # Co-issuance bursts: distinct domains logged within the same minute. The
+    # (minute, domain) pairs are packed into a single sorted int64 key, so the
+    # domains of each minute are contiguous.
+    minutes = entry // 60
+    stride = int(domain_ids.max()) + 1
+    pairs = np.unique(minutes * stride + domain_ids)
+    pair_minutes, pair_domains = pairs // stride, pairs % stride
+    burst_minutes, starts, burst_counts = np.unique(
+        pair_minutes, return_index=True, return_counts=True
+    )
+    largest = np.argsort(-burst_counts, kind="stable")[:max_bursts]
+    largest = largest[burst_counts[largest] >= burst_size]
+    bursts = [
+        {
+            "minute": _isoformat(burst_minutes[i] * 60)[:16],
+            "domains": int(burst_counts[i]),
+            "domain_ids": pair_domains[
+                starts[i] : starts[i] + burst_counts[i]
+            ].tolist(),
+        }
+        for i in largest
+    ]
+
+    return {
+        "certificates": int(first_rows.size),
+        "domains": int(np.unique(domain_ids).size),
+        "first_issued": _isoformat(cert_not_before.min()),
+        "last_issued": _isoformat(cert_not_before.max()),
+        "issuance": [
+            {"period": str(period), "certificates": int(count)}
+            for period, count in zip(periods, counts)
+        ],
+        "validity_days": _stats(cert_not_after - cert_not_before),
+        "renewal_interval_days": _stats(renewals),
+        "overlap_days": _stats(overlaps),
+        "coverage_gaps": int((overlaps < 0).sum()),
+        "bursts": bursts,
+    }
+
+
+def certificate_timeline(
+    session,
+    case_name: Optional[str] = None,
+    domain_name: Optional[str] = None,
+    bin: str = "month",
+    burst_size: int = 3,
+    max_bursts: int = 20,
+) -> Dict[str, Any]:
+    """Computes the certificate timeline of a case or a single domain.
+    @param case_name The name of the case to analyze.
+    @param domain_name The name of the domain to analyze, if no case is given.
+    @param bin The period of the issuance histogram (day, week, month, year).
+    @param burst_size The minimum number of domains of a co-issuance burst.
+    @param max_bursts The maximum number of bursts reported, largest first.
+    @return A dictionary of statistics, see analyze().
+    """
+    if case_name is not None:
+        domain_ids = (
+            select(CaseDomain.domain_id)
+            .join(Case, Case.case_id == CaseDomain.case_id)
+            .where(Case.case_name == case_name)
+        )
+    else:
+        domain_ids = select(Domain.domain_id).where(Domain.domain_name == domain_name)
+
+    timeline = analyze(
+        load_timestamps(session, domain_ids), bin, burst_size, max_bursts
+    )
+
+    # Resolve the names of the domains involved in the reported bursts only.
+    bursts = timeline.get("bursts", [])
+    burst_domain_ids = {i for burst in bursts for i in burst["domain_ids"]}
+    names = dict(
+        session.execute(
+            select(Domain.domain_id, Domain.domain_name).where(
+                Domain.domain_id.in_(burst_domain_ids)
+            )
+        ).all()
+    )
+    for burst in bursts:
+        burst["names"] = sorted(names[i] for i in burst.pop("domain_ids"))
+    return timeline
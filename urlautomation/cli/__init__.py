@@ -1,69 +1,185 @@
-"""@package urlautomation.cli
-Main package for the CLI of the URL Automation project.
-This package contains the code for the Command Line Interface (CLI)
-"""
-
-from urlautomation.cli.commands import ALL_SUBCOMMANDS
-from urlautomation.database.manager import DatabaseManager
-
-from argparse import ArgumentParser, Namespace
-
-import logging
-import json
-
-
-class CommandLine:
-    def __init__(self):
-        """Class constructor for CommandLine."""
-        self._args: Namespace = None
-        self._config: dict = None
-        self._database: DatabaseManager = None
-        self._logger = logging.getLogger(__name__)
-
-    def parse_args(self):
-        """Parse command line arguments."""
-        parser = ArgumentParser(description="URL Automation CLI")
-        parser.add_argument(
-            "-c",
-            "--config",
-            type=str,
-            default="config.json",
-            help="Path to the configuration file",
-        )
-        subparsers = parser.add_subparsers(dest="command", required=True)
-
-        for subcommand, subcommand_class in ALL_SUBCOMMANDS.items():
-            subparser = subparsers.add_parser(subcommand, help=subcommand_class.__doc__)
-            subcommand_class.add_arguments(subparser)
-
-        return parser.parse_args()
-
-    def run(self):
-        """Main method to run the command line interface."""
-        self._args = self.parse_args()
-        with open(self._args.config, "r") as config_file:
-            self._config = json.load(config_file)
-
-        self._database = DatabaseManager(self._config["db_path"])
-
-        command_class = ALL_SUBCOMMANDS[self._args.command]
-        command = getattr(self._args, command_class.__name__, None)
-        command_instance = command_class(self._args, self._config, self._database)
-
-        try:
-            command_instance.execute(command)
-        except Exception as e:
-            self._logger.exception(e)
-            exit(1)
-
-
-def main():
-    """Convenience function to construct a
-    CommandLine object and call run().
-    """
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s - %(levelname)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
-    CommandLine().run()
+"""@package urlautomation.cli
+Main package for the CLI of the URL Automation project.
+This package contains the code for the Command Line Interface (CLI)
+"""
+
+from urlautomation.cli import client
+from urlautomation.metrics import METRICS
+
+from argparse import ArgumentParser, Namespace
+
+import logging
+import json
+import os
+import sys
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s: %(message)s"
+LOG_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class CommandLine:
+    def __init__(self, config: dict = None, database=None):
+        """Class constructor for CommandLine.
+        @param config The loaded configuration, if the database is already open.
+        @param database The DatabaseManager to run the commands against, if
+        already open.
+        """
+        self._args: Namespace = None
+        self._config = config
+        self._database = database
+        self._logger = logging.getLogger(__name__)
+
+    @staticmethod
+    def build_parser() -> ArgumentParser:
+        """Builds the parser of the command line arguments.
+        The subcommands (and with them SQLAlchemy) are imported here rather
+        than at module level, so that the thin client does not load them.
+        """
+        from urlautomation.cli.commands import ALL_SUBCOMMANDS
+
+        parser = ArgumentParser(description="URL Automation CLI")
+        parser.add_argument(
+            "-c",
+            "--config",
+            type=str,
+            default="config.json",
+            help="Path to the configuration file",
+        )
+        parser.add_argument(
+            "--metrics-out",
+            default=None,
+            help="Write the timers and counters of the run to this file at exit",
+        )
+        parser.add_argument(
+            "--metrics-format",
+            choices=["json", "prometheus"],
+            default=None,
+            help="Format of --metrics-out (defaults to prometheus for .prom files, json otherwise)",
+        )
+        parser.add_argument(
+            "--profile",
+            default=None,
+            help="Profile the run with cProfile and write the stats to this file",
+        )
+        parser.add_argument(
+            "--slow-query-ms",
+            type=float,
+            default=None,
+            help="Log the SQL statements slower than this many milliseconds with their query plan (defaults to slow_query_ms in the configuration)",
+        )
+        parser.add_argument(
+            "--sql-stats",
+            action="store_true",
+            help="Log the number of SQL statements of the command and flag the statements repeated many times (N+1 patterns)",
+        )
+        parser.add_argument(
+            "--server",
+            default=None,
+            help="Address (host:port) of a running 'serve' process to send read-only commands to",
+        )
+        subparsers = parser.add_subparsers(dest="command", required=True)
+
+        for subcommand, subcommand_class in ALL_SUBCOMMANDS.items():
+            subparser = subparsers.add_parser(subcommand, help=subcommand_class.__doc__)
+            subcommand_class.add_arguments(subparser)
+
+        return parser
+
+    def parse_args(self):
+        """Parse command line arguments."""
+        return self.build_parser().parse_args()
+
+    def execute(self, args: Namespace) -> None:
+        """Executes the command described by parsed arguments against the
+        database of this command line.
+        @param args The parsed command line arguments.
+        """
+        from urlautomation.cli.commands import ALL_SUBCOMMANDS
+
+        command_class = ALL_SUBCOMMANDS[args.command]
+        command = getattr(args, command_class.__name__, None)
+        command_instance = command_class(args, self._config, self._database)
+        self._database.sql_monitor.reset()
+        try:
+            command_instance.execute(command)
+        finally:
+            label = args.command if command is None else f"{args.command} {command}"
+            self._report_sql(label, getattr(args, "sql_stats", False))
+
+    def _report_sql(self, label: str, log: bool) -> None:
+        """Records the SQL statistics of a command in the metrics, and logs
+        them if asked to.
+        @param label The command, e.g. "domain fetch".
+        @param log Whether to log the statistics and the repeated statements.
+        """
+        summary = self._database.sql_monitor.summary()
+        METRICS.count("db_statements", summary["statements"], command=label)
+        if not log:
+            return
+        self._logger.info(
+            f"{label}: {summary['statements']} SQL statements "
+            f"({summary['shapes']} distinct shapes) in {summary['total_seconds']:.3f} s"
+        )
+        for shape, count, seconds in summary["repeated_shapes"]:
+            self._logger.warning(
+                f"Statement repeated {count} times ({seconds:.3f} s), "
+                f"possible N+1 query: {shape[:300]}"
+            )
+
+    def open_database(self, config_path: str, slow_query_ms: float = None) -> None:
+        """Loads the configuration file and opens the database it points to.
+        @param config_path The path to the configuration file.
+        @param slow_query_ms The slow SQL statement threshold, overriding the
+        slow_query_ms value of the configuration.
+        """
+        from urlautomation.database.manager import DatabaseManager
+
+        with open(config_path, "r") as config_file:
+            self._config = json.load(config_file)
+
+        if slow_query_ms is None:
+            slow_query_ms = self._config.get("slow_query_ms")
+        self._database = DatabaseManager(
+            self._config["db_path"],
+            slow_query_ms,
+            ingest_chunk_size=self._config.get("ingest_chunk_size", 5000),
+        )
+
+    def run(self):
+        """Main method to run the command line interface."""
+        self._args = self.parse_args()
+        profiler = None
+        if self._args.profile:
+            import cProfile
+
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        try:
+            self.open_database(self._args.config, self._args.slow_query_ms)
+            self.execute(self._args)
+        except BrokenPipeError:
+            # The reader of our output went away (e.g. piped into head), stop
+            # quietly and keep Python from complaining when flushing stdout.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            exit(1)
+        except Exception as e:
+            self._logger.exception(e)
+            exit(1)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(self._args.profile)
+            if self._args.metrics_out:
+                METRICS.write(self._args.metrics_out, self._args.metrics_format)
+
+
+def main():
+    """Convenience function to construct a
+    CommandLine object and call run().
+    """
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=LOG_DATE_FORMAT)
+    exit_code = client.forward(sys.argv[1:])
+    if exit_code is not None:
+        sys.exit(exit_code)
+    CommandLine().run()
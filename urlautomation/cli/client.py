@@ -0,0 +1,98 @@
+"""@package urlautomation.cli.client
+Thin client of the URL Automation query server (see the serve command).
+When a server address is given, read-only commands are sent to the server as
+they were typed, instead of being run locally. This module only uses the
+standard library, so forwarding a command does not import SQLAlchemy.
+"""
+
+from argparse import ArgumentParser
+from typing import List, Optional
+
+import json
+import logging
+import os
+import sys
+
+# The read-only commands answered by the query server.
+SERVED_COMMANDS = {
+    "case": {"info", "overlap", "report", "timeline"},
+    "domain": {"list", "lookalikes", "query", "search", "timeline"},
+}
+
+logger = logging.getLogger(__name__)
+
+
+def is_served(command: str, subcommand: str) -> bool:
+    """Checks whether a command is answered by the query server."""
+    return subcommand in SERVED_COMMANDS.get(command, ())
+
+
+def database_path(config: dict) -> str:
+    """Returns the resolved path of the database of a configuration, which
+    the client and the server compare to check they use the same database.
+    """
+    return os.path.realpath(config["db_path"])
+
+
+def forward(argv: List[str]) -> Optional[int]:
+    """Sends a command to the query server given with --server, and writes
+    its output as if the command had been run locally.
+    @param argv The command line arguments, without the program name.
+    @return The exit code of the command, or None if the command must be run
+    locally (no server given, command not served, server unreachable or
+    serving another database).
+    """
+    parser = ArgumentParser(add_help=False, allow_abbrev=False)
+    parser.add_argument("-c", "--config", default="config.json")
+    parser.add_argument("--server")
+    parser.add_argument("--metrics-out")
+    parser.add_argument("--metrics-format")
+    parser.add_argument("--profile")
+    known, command = parser.parse_known_args(argv)
+    if not known.server or len(command) < 2 or not is_served(*command[:2]):
+        return None
+    if known.metrics_out or known.profile:
+        # Metrics and profiles are about a local run.
+        return None
+    try:
+        with open(known.config, "r") as config_file:
+            db_path = database_path(json.load(config_file))
+    except (OSError, ValueError, KeyError):
+        # The local run reports the invalid configuration.
+        return None
+
+    # Only imported when forwarding, local runs do not need it.
+    from http.client import HTTPConnection
+
+    host, _, port = known.server.rpartition(":")
+    connection = HTTPConnection(host or "127.0.0.1", int(port))
+    try:
+        connection.request(
+            "POST",
+            "/run",
+            body=json.dumps({"argv": command, "db_path": db_path}).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        body = response.read()
+    except OSError as e:
+        logger.warning(f"Server {known.server} is unreachable ({e}), running locally.")
+        return None
+    finally:
+        connection.close()
+    if response.status == 409:
+        logger.warning(
+            f"Server {known.server} serves another database than {db_path}, "
+            f"running locally."
+        )
+        return None
+    if response.status != 200:
+        logger.error(f"The server rejected the command: {body.decode()}")
+        return 1
+
+    result = json.loads(body)
+    sys.stdout.write(result["output"])
+    sys.stdout.flush()
+    for message in result["messages"]:
+        sys.stderr.write(f"{message}\n")
+    return result["exit_code"]
@@ -1,4 +1,15 @@
 from urlautomation.cli.commands.case import CaseCommand
 from urlautomation.cli.commands.domain import DomainCommand
+from urlautomation.cli.commands.export import ExportCommand
+from urlautomation.cli.commands.refresh import RefreshCommand
+from urlautomation.cli.commands.serve import ServeCommand
+from urlautomation.cli.commands.worker import WorkerCommand
 
-ALL_SUBCOMMANDS = {"case": CaseCommand, "domain": DomainCommand}
+ALL_SUBCOMMANDS = {
+    "case": CaseCommand,
+    "domain": DomainCommand,
+    "export": ExportCommand,
+    "refresh": RefreshCommand,
+    "serve": ServeCommand,
+    "worker": WorkerCommand,
+}
@@ -4,17 +4,13 @@ This package contains the code for the Command Line Interface (CLI)
 """
 
 from argparse import ArgumentParser
+from contextlib import nullcontext
 
+import sys
+
+from urlautomation.cli.emitter import ALL_EMITTERS
 from urlautomation.cli.subcommand import SubCommand
-from urlautomation.database.types import (
-    Case,
-    CaseDomain,
-    Domain,
-    DNSRecord,
-    ARecordValue,
-    NSRecordValue,
-    NSRecordNameserver,
-)
+from urlautomation.export.exporters import ALL_EXPORTERS, load_exporter
 
 
 class CaseCommand(SubCommand):
@@ -71,8 +67,86 @@ class CaseCommand(SubCommand):
             required=True,
             help="Name of the case to report",
         )
+        report.add_argument(
+            "--max-degree",
+            type=int,
+            default=None,
+            help="Ignore IP addresses and nameservers shared by more than this many domains.",
+        )
+        report.add_argument(
+            "--format",
+            choices=["text", *ALL_EXPORTERS],
+            default="text",
+            help="Format of the report, all formats except text stream the case as a graph of domains, DNS history, certificates and relationships.",
+        )
+        report.add_argument(
+            "--output",
+            default="-",
+            help="File to write the report to (defaults to stdout).",
+        )
         # Report END
 
+        # Timeline
+        timeline = subparsers.add_parser(
+            "timeline",
+            help="Analyze the certificate timeline of a case",
+        )
+        timeline.add_argument(
+            "--case",
+            required=True,
+            help="Name of the case to analyze",
+        )
+        timeline.add_argument(
+            "--bin",
+            choices=["day", "week", "month", "year"],
+            default="month",
+            help="Period of the certificate issuance histogram.",
+        )
+        timeline.add_argument(
+            "--burst-size",
+            type=int,
+            default=3,
+            help="Minimum number of domains getting certificates within the same minute to report a co-issuance burst.",
+        )
+        timeline.add_argument(
+            "--format",
+            choices=["text", "json"],
+            default="text",
+            help="Output format of the timeline.",
+        )
+        # Timeline END
+
+        # Overlap
+        overlap = subparsers.add_parser(
+            "overlap",
+            help="List the pairs of cases sharing domains, IP addresses, nameservers or certificates",
+        )
+        overlap.add_argument(
+            "--max-degree",
+            type=int,
+            default=None,
+            help="Ignore IP addresses and nameservers shared by more than this many domains.",
+        )
+        overlap.add_argument(
+            "--min-shared",
+            type=int,
+            default=1,
+            help="Only list pairs of cases sharing at least this many entities.",
+        )
+        overlap.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="Maximum number of pairs to list.",
+        )
+        overlap.add_argument(
+            "--format",
+            choices=[*ALL_EMITTERS],
+            default="text",
+            help="Output format of the pairs.",
+        )
+        # Overlap END
+
         # Domains
         domains = subparsers.add_parser(
             "domains",
@@ -131,6 +205,8 @@ class CaseCommand(SubCommand):
         )
 
     def _create_case(self):
+        from urlautomation.database.types import Case
+
         with self._database as session:
             # Check if the case already exists
             existing_case = (
@@ -150,7 +226,9 @@ class CaseCommand(SubCommand):
     def _list_cases(self):
         pass
 
-    def _report_case(self):
+    def _report_case_text(self, stream):
+        from urlautomation.database.types import Case, CaseDomain
+
         with self._database as session:
             domain_cases = (
                 session.query(CaseDomain)
@@ -169,9 +247,9 @@ class CaseCommand(SubCommand):
                 "NS Record (Name Server)": [],
             }
 
-            print(f"\n{'='*50}\nDOMAIN RELATIONSHIP REPORT\n{'='*50}")
-            print(f"\nViewing relationships for case: {self._args.case}\n")
-            print(f"Search domains: {', '.join(domains_in_case)}\n")
+            print(f"\n{'='*50}\nDOMAIN RELATIONSHIP REPORT\n{'='*50}", file=stream)
+            print(f"\nViewing relationships for case: {self._args.case}\n", file=stream)
+            print(f"Search domains: {', '.join(domains_in_case)}\n", file=stream)
 
             for case_domain in domain_cases:
                 target_domain = case_domain.domain
@@ -181,7 +259,7 @@ class CaseCommand(SubCommand):
 
                 # Find domains sharing A Records (IP Addresses)
                 related_domains_ip = self._database._find_ip_associations(
-                    session, target_domain
+                    session, target_domain, self._args.max_degree
                 )
                 for domain1_name, domain2_name, ip_address in related_domains_ip:
                     relationships["A Record (IP Address)"].append(
@@ -190,7 +268,7 @@ class CaseCommand(SubCommand):
 
                 # Find domains sharing NS Records (Name Servers)
                 related_domains_ns = self._database._find_nameserver_associations(
-                    session, target_domain
+                    session, target_domain, self._args.max_degree
                 )
                 for ns_domain_name, nameserver in related_domains_ns:
                     if ns_domain_name != target_domain.domain_name:
@@ -200,16 +278,74 @@ class CaseCommand(SubCommand):
 
             # Print relationships in a grouped format
             for category, relation_list in relationships.items():
-                print(f"\n{category} Relationships:")
+                print(f"\n{category} Relationships:", file=stream)
                 if relation_list:
                     for relation in relation_list:
-                        print(f"- {relation}")
+                        print(f"- {relation}", file=stream)
                 else:
-                    print("- None found")
+                    print("- None found", file=stream)
+
+            print("\n" + "=" * 50, file=stream)
 
-            print("\n" + "=" * 50)
+    def _report_case(self):
+        if self._args.output == "-":
+            output = nullcontext(sys.stdout)
+        else:
+            output = open(self._args.output, "w", encoding="utf-8", newline="")
+
+        with output as stream:
+            if self._args.format == "text":
+                self._report_case_text(stream)
+                return
+
+            exporter = load_exporter(self._args.format)(
+                stream, self._database.CASE_REPORT_FIELDS
+            )
+            with self._database as session:
+                count = exporter.export(
+                    self._args.case,
+                    self._database.iter_case_report(
+                        session, self._args.case, self._args.max_degree
+                    ),
+                )
+        self._logger.info(f"Exported {count} records for case '{self._args.case}'.")
+
+    def _timeline_case(self):
+        # NumPy is only needed (and imported) for the analytics commands.
+        from urlautomation.analysis.timeline import certificate_timeline
+
+        with self._database as session:
+            timeline = certificate_timeline(
+                session,
+                case_name=self._args.case,
+                bin=self._args.bin,
+                burst_size=self._args.burst_size,
+            )
+        with ALL_EMITTERS[self._args.format]() as emitter:
+            emitter.emit(timeline)
+
+    def _overlap_cases(self):
+        with self._database as session:
+            pairs = self._database.case_overlap(
+                session,
+                max_degree=self._args.max_degree,
+                min_shared=self._args.min_shared,
+                limit=self._args.limit,
+            )
+        if not pairs:
+            self._logger.info("No overlapping cases found.")
+            return
+        with ALL_EMITTERS[self._args.format]() as emitter:
+            if self._args.format in ("text", "json"):
+                # A single document, the line formats get a line per pair.
+                emitter.emit(pairs)
+            else:
+                for pair in pairs:
+                    emitter.emit(pair)
 
     def _info_case(self):
+        from urlautomation.database.types import Case
+
         with self._database as session:
             # Check if the case exists
             for case in self._args.cases:
@@ -232,6 +368,8 @@ class CaseCommand(SubCommand):
                 self._logger.info(f"    - Description: {existing_case.description}")
 
     def _domains_command(self):
+        from urlautomation.database.types import Case, CaseDomain, Domain
+
         with self._database as session:
             # Check if the case exists
             existing_case = (
@@ -321,6 +459,10 @@ class CaseCommand(SubCommand):
             self._list_cases()
         elif command == "report":
             self._report_case()
+        elif command == "timeline":
+            self._timeline_case()
+        elif command == "overlap":
+            self._overlap_cases()
         elif command == "info":
             self._info_case()
         elif command == "domains":
@@ -3,21 +3,13 @@ Main package for the CLI of the URL Automation project.
 This package contains the code for the Command Line Interface (CLI)
 """
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, BooleanOptionalAction
 from collections import defaultdict
-from typing import List, Tuple
+from datetime import datetime
 
-from urlautomation.cli.subcommand import SubCommand
-from urlautomation.database.types import (
-    Domain,
-)
-
-from sqlalchemy.orm import aliased
-
-import re
-
-
-DOMAIN_NAME_REGEX = re.compile(r"^(?:[a-zA-Z0-9-]+\.)+[a-zA-Z]{2,}$")
+from urlautomation.cli.emitter import ALL_EMITTERS
+from urlautomation.cli.subcommand import DOMAIN_NAME_REGEX, SubCommand
+from urlautomation.database.planner import FetchPlanner
 
 
 class DomainCommand(SubCommand):
@@ -42,6 +34,101 @@ class DomainCommand(SubCommand):
             "list",
             help="List all domains",
         )
+        list.add_argument(
+            "--format",
+            choices=["plain", "ndjson"],
+            default="plain",
+            help="Output format, one domain per line.",
+        )
+        list.add_argument(
+            "--limit",
+            type=int,
+            default=None,
+            help="Maximum number of domains to list.",
+        )
+        list.add_argument(
+            "--after",
+            default=None,
+            help="Only list domains sorted after this name (pass the last domain of the previous page).",
+        )
+        list.add_argument(
+            "--case",
+            default=None,
+            help="Only list domains in this case.",
+        )
+        list.add_argument(
+            "--first-seen-after",
+            type=datetime.fromisoformat,
+            default=None,
+            help="Only list domains first seen (in DNS history or certificates) at or after this date.",
+        )
+        list.add_argument(
+            "--first-seen-before",
+            type=datetime.fromisoformat,
+            default=None,
+            help="Only list domains first seen (in DNS history or certificates) before this date.",
+        )
+        list.add_argument(
+            "--has-certs",
+            action=BooleanOptionalAction,
+            default=None,
+            help="Only list domains with (or without) SSL certificates.",
+        )
+        list.add_argument(
+            "--has-dns",
+            action=BooleanOptionalAction,
+            default=None,
+            help="Only list domains with (or without) DNS records.",
+        )
+        lookalikes = subparsers.add_parser(
+            "lookalikes",
+            help="Find stored domains that look like a brand or domain (typosquats)",
+        )
+        lookalikes.add_argument(
+            "--distance",
+            type=int,
+            default=2,
+            help="Maximum edit distance between the registrable labels, after folding homoglyphs.",
+        )
+        lookalikes.add_argument(
+            "--variants",
+            action="store_true",
+            help="Also list the generated typosquatting variants of the brand (e.g. to fetch them).",
+        )
+        lookalikes.add_argument(
+            "name",
+            help="Brand label (e.g. pokerkg) or domain name to find lookalikes of",
+        )
+        timeline = subparsers.add_parser(
+            "timeline",
+            help="Analyze the certificate timeline of a domain",
+        )
+        timeline.add_argument(
+            "--bin",
+            choices=["day", "week", "month", "year"],
+            default="month",
+            help="Period of the certificate issuance histogram.",
+        )
+        timeline.add_argument(
+            "--burst-size",
+            type=int,
+            default=3,
+            help="Minimum number of domains getting certificates within the same minute to report a co-issuance burst.",
+        )
+        timeline.add_argument(
+            "--format",
+            choices=["text", "json"],
+            default="text",
+            help="Output format of the timeline.",
+        )
+        timeline.add_argument(
+            "name",
+            help="Name of the domain to analyze",
+        )
+        subparsers.add_parser(
+            "reindex",
+            help="Rebuild derived indexes (degree counters, lookalike and text indexes) from the stored data",
+        )
         fetch.add_argument(
             "--dump",
             action="store_true",
@@ -52,56 +139,192 @@ class DomainCommand(SubCommand):
             action="store_true",
             help="Simulate the fetch based on hardcoded responses.",
         )
+        fetch.add_argument(
+            "--archive",
+            metavar="PATH",
+            default=None,
+            help="Capture archive (single compressed file) to write the responses to with --dump, or to replay them from with --simulate, instead of one JSON file per response.",
+        )
         fetch.add_argument(
             "--quick",
             action="store_true",
             help="Fetch only data that can be gathered from minimal requests (e.g. no extended info for SSL certificates).",
         )
+        cls._add_crtsh_arguments(fetch)
+        fetch.add_argument(
+            "--from-file",
+            metavar="PATH",
+            default=None,
+            help="Read the domain names to fetch from a file, one per line ('-' for stdin).",
+        )
+        fetch.add_argument(
+            "--job",
+            default=None,
+            help="Name of the fetch job in the fetch journal (defaults to a new timestamped name, or to the last job with --resume).",
+        )
+        fetch.add_argument(
+            "--resume",
+            action="store_true",
+            help="Resume a fetch job, skipping the domains and providers it already completed. Without domain names, retry its unfinished domains.",
+        )
+        fetch.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="Fetch and parse with this many worker processes, the database being written by a single process.",
+        )
+        fetch.add_argument(
+            "--write-batch",
+            type=int,
+            default=50,
+            help="With --workers, number of domains written per transaction.",
+        )
         fetch.add_argument(
             "names",
-            nargs="+",
+            nargs="*",
             help="Name of the domain to fetch for",
         )
+        search_mode = search.add_mutually_exclusive_group()
+        search_mode.add_argument(
+            "--contains",
+            action="store_true",
+            help="Find domains and certificate identities containing the given text.",
+        )
+        search_mode.add_argument(
+            "--fuzzy",
+            action="store_true",
+            help="Find domains and certificate identities similar to the given text (e.g. typosquats).",
+        )
+        search.add_argument(
+            "--limit",
+            type=int,
+            default=50,
+            help="Maximum number of results for --contains and --fuzzy searches.",
+        )
+        search.add_argument(
+            "--depth",
+            type=int,
+            default=1,
+            help="Follow links up to this many hops away from the domain (breadth first, one query per hop).",
+        )
+        search.add_argument(
+            "--fanout",
+            type=int,
+            default=100,
+            help="With --depth, maximum number of domains followed through each shared IP address or nameserver.",
+        )
+        search.add_argument(
+            "--max-degree",
+            type=int,
+            default=None,
+            help="Ignore IP addresses, nameservers and organizations shared by more than this many domains.",
+        )
+        search.add_argument(
+            "--score",
+            action="store_true",
+            help="Rank linked domains by IDF-style weights of the shared infrastructure (one hop only, not with --depth).",
+        )
         search.add_argument(
             "name",
             help="Name of the domain to search for",
         )
+        query.add_argument(
+            "--format",
+            choices=["text", "json"],
+            default="text",
+            help="Output format of the domain profile.",
+        )
+        query.add_argument(
+            "--limit",
+            type=int,
+            default=1000,
+            help="Maximum number of certificate identities to show, most recent first (0 for no limit).",
+        )
         query.add_argument(
             "name",
             help="Name of the domain to query for",
         )
 
-    def _fetch_domain(self):
-        for domain_name in self._args.names:
-            if not DOMAIN_NAME_REGEX.match(domain_name):
-                self._logger.warning(
-                    f"Invalid domain name provided (skipping): {domain_name}"
-                )
-                continue
-
-            try:
-                self._database.fetch_data(
-                    fetcher="crtsh",
-                    domains=domain_name,
-                    dump=self._args.dump,
-                    simulate=self._args.simulate,
-                    quick=self._args.quick,
-                )
-                self._database.fetch_data(
-                    fetcher="securitytrails",
-                    domains=domain_name,
-                    apikey=self._config["securitytrails_api_key"],
-                    dump=self._args.dump,
-                    simulate=self._args.simulate,
-                    quick=self._args.quick,
+    def _fetch_domain(self, archive):
+        job_name = self._args.job
+        names = self._iter_fetch_names()
+        if self._args.resume:
+            with self._database as session:
+                job_name = job_name or self._database.last_fetch_job(session)
+                if job_name is None:
+                    self._logger.error("There is no fetch job to resume.")
+                    return
+                if not self._args.names and self._args.from_file is None:
+                    names = iter(self._database.unfinished_fetches(session, job_name))
+            self._logger.info(f"Resuming fetch job '{job_name}'.")
+        elif not self._args.names and self._args.from_file is None:
+            self._logger.error("No domain names to fetch, use names or --from-file.")
+            return
+        job_name = job_name or f"fetch-{datetime.now():%Y%m%d-%H%M%S}"
+
+        fetcher_arguments = self._all_fetcher_arguments(archive)
+        if len(self._args.names) != 1 or self._args.from_file is not None:
+            self._warm_entity_cache()
+        fetched, skipped, failed = 0, 0, 0
+        if self._args.workers > 1:
+            if self._args.dump and self._args.archive:
+                self._logger.error(
+                    "--dump cannot append to a capture archive from several workers."
                 )
-            except Exception as e:
-                self._logger.exception(
-                    f"Failed to fetch data for domain {domain_name}: {e}"
+                return
+            # Imported here, multiprocessing is only needed by this mode.
+            from urlautomation.database.pipeline import FetchPipeline
+
+            fetched, failed, skipped = FetchPipeline(
+                self._database, self._args.workers, self._args.write_batch
+            ).run(job_name, self._valid_fetch_names(names), fetcher_arguments)
+        else:
+            planner = FetchPlanner.from_arguments(fetcher_arguments)
+            for domain_name, search_names, covered in planner.plan(
+                self._valid_fetch_names(names)
+            ):
+                fetched_all = self._database.fetch_domain(
+                    job_name, domain_name, fetcher_arguments, search_names, covered
                 )
+                if fetched_all is None:
+                    skipped += 1
+                elif fetched_all:
+                    fetched += 1
+                else:
+                    failed += 1
+
+        self._logger.info(
+            f"Fetch job '{job_name}': {fetched} domains fetched, {failed} failed, "
+            f"{skipped} already done."
+        )
+
+    def _search_names(self):
+        """Search the text index for names containing or resembling the input."""
+        with self._database as session:
+            results = self._database.search_names(
+                session, self._args.name, fuzzy=self._args.fuzzy, limit=self._args.limit
+            )
+        if not results:
+            self._logger.info("No names found matching %s", self._args.name)
+            return
+
+        for name, kinds, score in results:
+            self._logger.info(
+                f"MATCH {name} (score {score:.3f}), found in: {', '.join(kinds)}"
+            )
 
     def _search_domain(self):
-        domain_name = self._args.name
+        from urlautomation.database.types import Domain
+
+        if self._args.contains or self._args.fuzzy:
+            self._search_names()
+            return
+
+        if self._args.score and self._args.depth > 1:
+            self._logger.error("--score cannot be combined with --depth.")
+            return
+
+        domain_name = self._normalize_name(self._args.name)
         assert DOMAIN_NAME_REGEX.match(domain_name), "Invalid domain name provided."
 
         with self._database as session:
@@ -112,8 +335,42 @@ class DomainCommand(SubCommand):
                 self._logger.info("No domain found with the name %s", domain_name)
                 return
 
+            if self._args.depth > 1:
+                for linked_domain_name, hops, path in self._database.pivot_search(
+                    session,
+                    domain,
+                    self._args.depth,
+                    self._args.fanout,
+                    self._args.max_degree,
+                ):
+                    self._logger.info(
+                        f"LINK ({hops} hops) between {domain_name} -> {linked_domain_name}, path: {domain_name}"
+                        + "".join(
+                            f" -[{entity_type} {entity}]-> {to_domain}"
+                            for _, entity_type, entity, to_domain in path
+                        )
+                    )
+                return
+
+            if self._args.score:
+                for (
+                    linked_domain_name,
+                    score,
+                    shared,
+                ) in self._database.score_associations(
+                    session, domain, self._args.max_degree
+                ):
+                    self._logger.info(
+                        f"LINK between {domain_name} -> {linked_domain_name}, score {score:.3f}, sharing "
+                        + ", ".join(
+                            f"{entity_type} {entity} (degree {degree})"
+                            for entity_type, entity, degree in shared
+                        )
+                    )
+                return
+
             for domain1_name, domain2_name, ip in self._database._find_ip_associations(
-                session, domain
+                session, domain, self._args.max_degree
             ):
                 self._logger.info(
                     f"LINK between {domain1_name} -> {domain2_name}, there are A records sharing the IP address {ip}"
@@ -122,154 +379,114 @@ class DomainCommand(SubCommand):
             for (
                 ns_domain_name,
                 nameserver,
-            ) in self._database._find_nameserver_associations(session, domain):
+            ) in self._database._find_nameserver_associations(
+                session, domain, self._args.max_degree
+            ):
                 self._logger.info(
                     f"LINK between {domain_name} -> {ns_domain_name}, there are NS records sharing nameserver {nameserver}"
                 )
 
     def _query_domain(self):
-        domain_name = self._args.name
+        domain_name = self._normalize_name(self._args.name)
         assert DOMAIN_NAME_REGEX.match(domain_name), "Invalid domain name provided."
 
-        # Query database for SSL records associated with the domain
+        # Bulk load the domain profile, then render it in the requested format
         with self._database as session:
-            domain_records: List[Domain] = (
-                session.query(Domain).filter(Domain.domain_name == domain_name).all()
+            profile = self._database.load_domain_profile(
+                session, domain_name, limit=self._args.limit or None
             )
+            if profile is None:
+                self._logger.info("No domain found with the name %s", domain_name)
+                return
 
-            for record in domain_records:
-                self._logger.info("- Domain: %s", record.domain_name)
-                self._logger.info("  - ID: %d", record.domain_id)
-
-                # The DNS records associated with the domain
-                self._logger.info("  - DNS Records:")
-                for dns_record in record.dns_records:
-                    self._logger.info("      - A Records:")
-                    for a_record in dns_record.a_records:
-                        self._logger.info(
-                            "            - %s", a_record.a_record_value_id
-                        )
-                        self._logger.info(
-                            "                - First seen: %s", a_record.first_seen
-                        )
-                        self._logger.info(
-                            "                - Last seen: %s", a_record.last_seen
-                        )
-                        self._logger.info("                - IP Addresses:")
-                        for ip_address in a_record.ip_addresses:
-                            self._logger.info(
-                                "                    - %s", ip_address.ip_address
-                            )
-                        self._logger.info("                - Organizations:")
-                        for organization in a_record.organizations:
-                            self._logger.info(
-                                "                    - %s",
-                                organization.organization_name,
-                            )
-                    self._logger.info("      - NS Records:")
-                    for ns_record in dns_record.ns_records:
-                        self._logger.info(
-                            "            - %s", ns_record.ns_record_value_id
-                        )
-                        self._logger.info(
-                            "                - First seen: %s", ns_record.first_seen
-                        )
-                        self._logger.info(
-                            "                - Last seen: %s", ns_record.last_seen
-                        )
-                        self._logger.info("                - Nameservers:")
-                        for nameserver in ns_record.nameservers:
-                            self._logger.info(
-                                "                   - %s", nameserver.nameserver
-                            )
-                        self._logger.info("                - Organizations:")
-                        for organization in ns_record.organizations:
-                            self._logger.info(
-                                "                   - %s",
-                                organization.organization_name,
-                            )
-
-                    # Log identities first, then their associated SSL certificates
-                    self._logger.info("  - Identities:")
-                    for identity in record.identities:
-                        self._logger.info("    - %s", identity.identity)
-
-                        # Log the SSL certificate linked to this identity
-                        ssl_cert = identity.certificate
-                        self._logger.info("      - SSL Certificate:")
-                        self._logger.info(
-                            "          - Certificate ID: %s", ssl_cert.certificate_id
-                        )
-                        self._logger.info(
-                            "          - Issuer: %s", ssl_cert.issuer_name
-                        )
-                        self._logger.info(
-                            "          - Valid From: %s", ssl_cert.not_before
-                        )
-                        self._logger.info(
-                            "          - Valid To: %s", ssl_cert.not_after
-                        )
-                        self._logger.info(
-                            "          - Serial Number: %s", ssl_cert.serial_number
-                        )
-
-                        # Additional fields
-                        self._logger.info(
-                            "          - Subject Key Identifier: %s",
-                            ssl_cert.subject_key_identifier,
-                        )
-                        self._logger.info(
-                            "          - Authority Key Identifier: %s",
-                            ssl_cert.authority_key_identifier,
-                        )
-                        self._logger.info(
-                            "          - Public Key Algorithm: %s",
-                            ssl_cert.public_key_algorithm,
-                        )
-                        self._logger.info(
-                            "          - Public Key Size: %s",
-                            ssl_cert.public_key_size,
-                        )
-                        self._logger.info(
-                            "          - Public Key Modulus: %s",
-                            ssl_cert.public_key_modulus,
-                        )
-                        self._logger.info(
-                            "          - Public Key Exponent: %s",
-                            ssl_cert.public_key_exponent,
-                        )
-                        self._logger.info(
-                            "          - Signature Algorithm: %s",
-                            ssl_cert.signature_algorithm,
-                        )
-                        self._logger.info(
-                            "          - Signature: %s", ssl_cert.signature
-                        )
+            with ALL_EMITTERS[self._args.format]() as emitter:
+                emitter.emit(profile)
 
-                        # Log associated domains under the identity
-                        self._logger.info("      - Associated Domains:")
-                        for domain in identity.domains:
-                            self._logger.info("          - %s", domain.domain_name)
+            if len(profile["identities"]) < profile["total_identities"]:
+                self._logger.warning(
+                    "Showing %d of %d identities, use --limit to show more.",
+                    len(profile["identities"]),
+                    profile["total_identities"],
+                )
 
     def _list_domains(self):
-        """List all domains in the database."""
+        """Stream the domains in the database to stdout."""
+        count = 0
+        with self._database as session, ALL_EMITTERS[self._args.format]() as emitter:
+            for domain_id, domain_name in self._database.iter_domains(
+                session,
+                after=self._args.after,
+                limit=self._args.limit,
+                case_name=self._args.case,
+                first_seen_after=self._args.first_seen_after,
+                first_seen_before=self._args.first_seen_before,
+                has_certs=self._args.has_certs,
+                has_dns=self._args.has_dns,
+            ):
+                emitter.emit({"domain": domain_name, "id": domain_id})
+                count += 1
+
+        if not count:
+            self._logger.info("No matching domains found in the database.")
+
+    def _find_lookalikes(self):
+        """Find the stored domains that look like the given brand or domain."""
+        from urlautomation.database.lookalike import brand_label, generate_variants
+
         with self._database as session:
-            domains = session.query(Domain).all()
-            if not domains:
-                self._logger.info("No domains found in the database.")
-                return
+            results = self._database.find_lookalikes(
+                session, self._args.name, self._args.distance
+            )
+        if not results:
+            self._logger.info("No lookalikes found for %s", self._args.name)
+        for domain_name, label, distance, kind in results:
+            self._logger.info(
+                f"LOOKALIKE {domain_name} (label {label}, distance {distance}, {kind})"
+            )
+
+        if self._args.variants:
+            for variant, kind in generate_variants(brand_label(self._args.name)):
+                self._logger.info(f"VARIANT {variant} ({kind})")
 
-            for domain in domains:
-                self._logger.info("- Domain: %s", domain.domain_name)
-                self._logger.info("  - ID: %d", domain.domain_id)
+    def _timeline_domain(self):
+        # NumPy is only needed (and imported) for the analytics commands.
+        from urlautomation.analysis.timeline import certificate_timeline
+
+        with self._database as session:
+            timeline = certificate_timeline(
+                session,
+                domain_name=self._args.name,
+                bin=self._args.bin,
+                burst_size=self._args.burst_size,
+            )
+        with ALL_EMITTERS[self._args.format]() as emitter:
+            emitter.emit(timeline)
+
+    def _reindex(self):
+        """Rebuild the derived indexes from the stored data."""
+        with self._database as session:
+            self._logger.info("Rebuilding degree counters...")
+            self._database.rebuild_degrees(session)
+            self._logger.info("Rebuilding lookalike index...")
+            self._database.rebuild_lookalikes(session)
+            self._logger.info("Rebuilding text index...")
+            self._database.rebuild_text_index(session)
+        self._logger.info("Reindex complete.")
 
     def execute(self, command: str):
         """Execute the command."""
         if command == "fetch":
-            self._fetch_domain()
+            with self._open_archive() as archive:
+                self._fetch_domain(archive)
         elif command == "search":
             self._search_domain()
         elif command == "query":
             self._query_domain()
         elif command == "list":
             self._list_domains()
+        elif command == "lookalikes":
+            self._find_lookalikes()
+        elif command == "timeline":
+            self._timeline_domain()
+        elif command == "reindex":
+            self._reindex()
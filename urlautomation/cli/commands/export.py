@@ -0,0 +1,91 @@
+"""@package urlautomation.cli.export
+Main package for the CLI of the URL Automation project.
+This package contains the code for the Command Line Interface (CLI)
+"""
+
+from argparse import ArgumentParser
+
+from urlautomation.cli.subcommand import SubCommand
+
+
+class ExportCommand(SubCommand):
+    """Class for exporting the database for analytics."""
+
+    @classmethod
+    def add_arguments(cls: "ExportCommand", parser: ArgumentParser):
+        subparsers = parser.add_subparsers(dest=cls.__name__, required=True)
+
+        snapshot = subparsers.add_parser(
+            "snapshot",
+            help="Export the tables to Parquet files for analytics",
+        )
+        snapshot.add_argument(
+            "--output",
+            metavar="DIR",
+            required=True,
+            help="Snapshot directory. If it holds a previous snapshot, only the rows added since then are exported.",
+        )
+        snapshot.add_argument(
+            "--full",
+            action="store_true",
+            help="Export every row again, replacing the previous snapshots of the directory.",
+        )
+        snapshot.add_argument(
+            "--chunk-size",
+            type=int,
+            default=65536,
+            help="Number of rows read and converted at a time.",
+        )
+
+        archive = subparsers.add_parser(
+            "archive",
+            help="Pack the JSON files written by --dump into a capture archive",
+        )
+        archive.add_argument(
+            "directory",
+            help="Directory of the JSON files written by --dump (e.g. testdata).",
+        )
+        archive.add_argument(
+            "--output",
+            metavar="FILE",
+            required=True,
+            help="Capture archive to append the responses to, created if it does not exist.",
+        )
+
+    def _snapshot(self):
+        # PyArrow is only needed (and imported) for the snapshot export.
+        from urlautomation.export.snapshot import export_snapshot
+
+        with self._database as session:
+            snapshot = export_snapshot(
+                session,
+                self._args.output,
+                full=self._args.full,
+                chunk_size=self._args.chunk_size,
+            )
+        for name, table in snapshot["tables"].items():
+            self._logger.debug(
+                f"{name}: {table['rows']} rows (watermark {table['watermark']})"
+            )
+        rows = sum(table["rows"] for table in snapshot["tables"].values())
+        self._logger.info(
+            f"Snapshot {snapshot['snapshot']}: exported {rows} rows to "
+            f"{self._args.output}."
+        )
+
+    def _archive(self):
+        from urlautomation.database.archive import CaptureArchive, pack_directory
+
+        with CaptureArchive(self._args.output) as archive:
+            count = pack_directory(archive, self._args.directory)
+        self._logger.info(
+            f"Packed {count} responses from {self._args.directory} into "
+            f"{self._args.output}."
+        )
+
+    def execute(self, command: str):
+        """Execute the command."""
+        if command == "snapshot":
+            self._snapshot()
+        elif command == "archive":
+            self._archive()
@@ -0,0 +1,127 @@
+"""@package urlautomation.cli.refresh
+Main package for the CLI of the URL Automation project.
+This package contains the code for the Command Line Interface (CLI)
+"""
+
+from argparse import ArgumentParser
+from datetime import datetime
+
+from urlautomation.cli.subcommand import SubCommand
+from urlautomation.database.fetchers import REQUEST_COSTS
+from urlautomation.database.planner import FetchPlanner
+from urlautomation.metrics import METRICS
+
+import time
+
+
+class RefreshCommand(SubCommand):
+    """Class for refreshing the stalest domains of the open cases."""
+
+    @classmethod
+    def add_arguments(cls: "RefreshCommand", parser: ArgumentParser):
+        parser.add_argument(
+            "--budget",
+            type=int,
+            default=300,
+            help="Maximum number of API requests per refresh cycle (a domain costs one crt.sh and two SecurityTrails requests, plus a crt.sh request per new certificate without --quick).",
+        )
+        parser.add_argument(
+            "--min-score",
+            type=float,
+            default=0.05,
+            help="Do not refresh domains whose staleness score (probability of a change since the last fetch, weighted by open cases) is below this value.",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="Also refresh domains that are not in any open case.",
+        )
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=None,
+            help="Run a refresh cycle every this many minutes, instead of a single cycle.",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only list the domains that would be refreshed, with their staleness score.",
+        )
+        parser.add_argument(
+            "--simulate",
+            action="store_true",
+            help="Simulate the fetches based on hardcoded responses.",
+        )
+        parser.add_argument(
+            "--archive",
+            metavar="PATH",
+            default=None,
+            help="With --simulate, replay the responses from this capture archive instead of testdata.",
+        )
+        parser.add_argument(
+            "--quick",
+            action="store_true",
+            help="Fetch only data that can be gathered from minimal requests (e.g. no extended info for SSL certificates).",
+        )
+        cls._add_crtsh_arguments(parser)
+
+    def _refresh_cycle(self, archive):
+        with self._database as session:
+            scores = self._database.score_staleness(session, include_all=self._args.all)
+        # The most domains the budget can pay for, each costing at least
+        # domain_cost requests: the cycle stops once the budget is spent.
+        domain_cost = sum(REQUEST_COSTS.values())
+        selected = [
+            (domain_name, score)
+            for domain_name, score in scores
+            if score >= self._args.min_score
+        ][: self._args.budget // domain_cost]
+
+        if self._args.dry_run:
+            for domain_name, score in selected:
+                self._logger.info(f"{domain_name} (staleness {score:.3f})")
+            self._logger.info(
+                f"At most {len(selected)} of {len(scores)} domains would be refreshed."
+            )
+            return
+
+        job_name = f"refresh-{datetime.now():%Y%m%d-%H%M%S}"
+        fetcher_arguments = self._all_fetcher_arguments(archive)
+        scores_by_name = dict(selected)
+        planner = FetchPlanner.from_arguments(fetcher_arguments)
+        self._warm_entity_cache()
+        failed, refreshed, start = 0, 0, METRICS.total("api_requests")
+        for domain_name, search_names, covered in planner.plan(scores_by_name):
+            used = METRICS.total("api_requests") - start
+            if used + domain_cost > self._args.budget:
+                self._logger.info(
+                    f"Request budget spent, {len(selected) - refreshed} domains left."
+                )
+                break
+            refreshed += 1
+            score = scores_by_name[domain_name]
+            self._logger.info(f"Refreshing {domain_name} (staleness {score:.3f})")
+            if (
+                self._database.fetch_domain(
+                    job_name, domain_name, fetcher_arguments, search_names, covered
+                )
+                is False
+            ):
+                failed += 1
+        self._logger.info(
+            f"Refresh job '{job_name}': {refreshed - failed} of {len(scores)} "
+            f"domains refreshed, {failed} failed, "
+            f"{METRICS.total('api_requests') - start:g} of {self._args.budget} "
+            f"requests used."
+        )
+
+    def execute(self, command: str):
+        try:
+            with self._open_archive() as archive:
+                while True:
+                    self._refresh_cycle(archive)
+                    if self._args.interval is None:
+                        break
+                    time.sleep(self._args.interval * 60)
+        except KeyboardInterrupt:
+            self._logger.info("Refresh stopped.")
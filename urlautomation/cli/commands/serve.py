@@ -0,0 +1,42 @@
+"""@package urlautomation.cli.serve
+Main package for the CLI of the URL Automation project.
+This package contains the code for the Command Line Interface (CLI)
+"""
+
+from argparse import ArgumentParser
+
+from urlautomation.cli.subcommand import SubCommand
+
+
+class ServeCommand(SubCommand):
+    """Class for serving read-only commands over a local HTTP API."""
+
+    @classmethod
+    def add_arguments(cls: "ServeCommand", parser: ArgumentParser):
+        parser.add_argument(
+            "--host",
+            default="127.0.0.1",
+            help="Address to listen on, only local addresses should be used.",
+        )
+        parser.add_argument(
+            "--port",
+            type=int,
+            default=8765,
+            help="Port to listen on.",
+        )
+
+    def execute(self, command: str):
+        # The HTTP server is only needed (and imported) by this command.
+        from urlautomation.cli.server import QueryServer
+
+        with QueryServer(
+            (self._args.host, self._args.port), self._config, self._database
+        ) as server:
+            self._logger.info(
+                f"Serving queries on {self._args.host}:{self._args.port}, "
+                f"use --server {self._args.host}:{self._args.port} to send commands."
+            )
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                self._logger.info("Server stopped.")
@@ -0,0 +1,243 @@
+"""@package urlautomation.cli.worker
+Main package for the CLI of the URL Automation project.
+This package contains the code for the Command Line Interface (CLI)
+"""
+
+from argparse import ArgumentParser
+from itertools import islice
+
+from urlautomation.cli.subcommand import SubCommand
+from urlautomation.database.planner import FetchPlanner
+
+import os
+import socket
+import threading
+import time
+
+
+class WorkerCommand(SubCommand):
+    """Class for fetching domains from a queue shared by several workers."""
+
+    @classmethod
+    def add_arguments(cls: "WorkerCommand", parser: ArgumentParser):
+        subparsers = parser.add_subparsers(dest=cls.__name__, required=True)
+
+        enqueue = subparsers.add_parser(
+            "enqueue",
+            help="Add domains to the queue of a job",
+        )
+        enqueue.add_argument(
+            "--job",
+            required=True,
+            help="Name of the job to add the domains to.",
+        )
+        enqueue.add_argument(
+            "--from-file",
+            metavar="PATH",
+            default=None,
+            help="Read the domain names from a file, one per line ('-' for stdin).",
+        )
+        enqueue.add_argument(
+            "names",
+            nargs="*",
+            help="Name of the domain to add",
+        )
+
+        run = subparsers.add_parser(
+            "run",
+            help="Fetch the domains of a job's queue until it is empty",
+        )
+        run.add_argument(
+            "--job",
+            required=True,
+            help="Name of the job to work on.",
+        )
+        run.add_argument(
+            "--id",
+            default=None,
+            help="Unique name of this worker (defaults to the host name and process ID).",
+        )
+        run.add_argument(
+            "--claim",
+            type=int,
+            default=10,
+            help="Number of domains claimed at a time.",
+        )
+        run.add_argument(
+            "--lease",
+            type=float,
+            default=300,
+            help="Duration of the leases in seconds, after which the domains of a worker that stopped renewing them are taken over by other workers.",
+        )
+        run.add_argument(
+            "--max-attempts",
+            type=int,
+            default=3,
+            help="Mark a domain as failed after its lease expired this many times.",
+        )
+        run.add_argument(
+            "--poll",
+            type=float,
+            default=10,
+            help="Seconds to wait before claiming again when the other workers hold the remaining domains.",
+        )
+        run.add_argument(
+            "--wait",
+            action="store_true",
+            help="Keep waiting for new domains when the queue is empty.",
+        )
+        run.add_argument(
+            "--dump",
+            action="store_true",
+            help="Dump the results of web requests to JSON files.",
+        )
+        run.add_argument(
+            "--simulate",
+            action="store_true",
+            help="Simulate the fetch based on hardcoded responses.",
+        )
+        run.add_argument(
+            "--archive",
+            metavar="PATH",
+            default=None,
+            help="With --simulate, replay the responses from this capture archive instead of testdata.",
+        )
+        run.add_argument(
+            "--quick",
+            action="store_true",
+            help="Fetch only data that can be gathered from minimal requests (e.g. no extended info for SSL certificates).",
+        )
+        cls._add_crtsh_arguments(run)
+
+        status = subparsers.add_parser(
+            "status",
+            help="Show the progress of a job's queue",
+        )
+        status.add_argument(
+            "--job",
+            required=True,
+            help="Name of the job to show.",
+        )
+
+    def _enqueue(self):
+        names = self._valid_fetch_names(self._iter_fetch_names())
+        added, total = 0, 0
+        while chunk := list(islice(names, 1000)):
+            with self._database as session:
+                added += self._database.enqueue_fetches(session, self._args.job, chunk)
+            total += len(chunk)
+        self._logger.info(
+            f"Job '{self._args.job}': {added} domains queued, "
+            f"{total - added} already in the queue."
+        )
+
+    def _heartbeat(self, worker: str, stop: threading.Event):
+        """Renews the leases of the worker until stopped, from its own session
+        so that it keeps running while the worker is busy fetching.
+        """
+        while not stop.wait(self._args.lease / 3):
+            session = self._database.new_session()
+            try:
+                self._database.renew_leases(
+                    session, self._args.job, worker, self._args.lease
+                )
+                session.commit()
+            except Exception:
+                session.rollback()
+                self._logger.warning("Failed to renew the leases.", exc_info=True)
+            finally:
+                session.close()
+
+    def _run(self, archive):
+        from urlautomation.database.types import FetchQueue
+
+        if self._args.dump and self._args.archive:
+            self._logger.error(
+                "--dump cannot append to a capture archive from several workers."
+            )
+            return
+        job_name = self._args.job
+        worker = self._args.id or f"{socket.gethostname()}-{os.getpid()}"
+        fetcher_arguments = self._all_fetcher_arguments(archive)
+        # Kept across claims, so that the searches of earlier claims cover
+        # the subdomains claimed later.
+        planner = FetchPlanner.from_arguments(fetcher_arguments)
+        self._warm_entity_cache()
+
+        stop = threading.Event()
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(worker, stop), daemon=True
+        )
+        heartbeat.start()
+        self._logger.info(f"Worker {worker} working on job '{job_name}'.")
+
+        fetched, failed = 0, 0
+        try:
+            while True:
+                with self._database as session:
+                    claimed = self._database.claim_fetches(
+                        session,
+                        job_name,
+                        worker,
+                        self._args.claim,
+                        self._args.lease,
+                        self._args.max_attempts,
+                    )
+                if not claimed:
+                    with self._database as session:
+                        status = self._database.queue_status(session, job_name)
+                    if not status[FetchQueue.LEASED] and not self._args.wait:
+                        break
+                    # Wait for the other workers, to take over their domains
+                    # if they die, or for new domains.
+                    time.sleep(self._args.poll)
+                    continue
+
+                for domain_name, search_names, covered in planner.plan(claimed):
+                    fetched_all = self._database.fetch_domain(
+                        job_name, domain_name, fetcher_arguments, search_names, covered
+                    )
+                    status = (
+                        FetchQueue.FAILED if fetched_all is False else FetchQueue.DONE
+                    )
+                    with self._database as session:
+                        released = self._database.release_fetch(
+                            session, job_name, domain_name, worker, status
+                        )
+                    if not released:
+                        self._logger.warning(
+                            f"The lease of {domain_name} expired before it was fetched."
+                        )
+                    if status == FetchQueue.DONE:
+                        fetched += 1
+                    else:
+                        failed += 1
+        except KeyboardInterrupt:
+            self._logger.info("Worker stopped.")
+        finally:
+            stop.set()
+            heartbeat.join()
+            with self._database as session:
+                released = self._database.release_leases(session, job_name, worker)
+            self._logger.info(
+                f"Worker {worker}: {fetched} domains fetched, {failed} failed, "
+                f"{released} given back to the queue."
+            )
+
+    def _status(self):
+        with self._database as session:
+            status = self._database.queue_status(session, self._args.job)
+        self._logger.info(
+            f"Job '{self._args.job}': "
+            + ", ".join(f"{count} {name}" for name, count in status.items())
+        )
+
+    def execute(self, command: str):
+        """Execute the command."""
+        if command == "enqueue":
+            self._enqueue()
+        elif command == "run":
+            with self._open_archive() as archive:
+                self._run(archive)
+        elif command == "status":
+            self._status()
@@ -0,0 +1,118 @@
+"""@package urlautomation.cli.emitter
+This module contains the structured output emitters of the CLI.
+Commands build plain dictionaries and lists, and an emitter renders them
+either for humans (text) or for other tools (JSON, NDJSON).
+"""
+
+from urlautomation.export.serialization import json_default, write_ndjson
+
+from typing import Any, TextIO
+
+import json
+import sys
+
+
+class Emitter:
+    """Base class for the structured output emitters."""
+
+    def __init__(self, stream: TextIO = None):
+        """Class constructor for Emitter.
+        @param stream The stream to write to, defaults to stdout.
+        """
+        self._stream = stream if stream is not None else sys.stdout
+
+    def emit(self, record: Any) -> None:
+        """Write a single record to the output stream."""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Flush any pending output."""
+        self._stream.flush()
+
+    def __enter__(self) -> "Emitter":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+class TextEmitter(Emitter):
+    """Renders records as an indented, human readable tree."""
+
+    INDENT = "  "
+    ACRONYMS = {
+        "id": "ID",
+        "ip": "IP",
+        "ips": "IPs",
+        "dns": "DNS",
+        "ns": "NS",
+        "ssl": "SSL",
+    }
+
+    @classmethod
+    def _label(cls, key: str) -> str:
+        label = " ".join(cls.ACRONYMS.get(word, word) for word in key.split("_"))
+        return label[:1].upper() + label[1:]
+
+    def _write_value(self, value: Any, depth: int) -> None:
+        if isinstance(value, dict):
+            for key, item in value.items():
+                self._write_item(self._label(key), item, depth)
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict) and item:
+                    # Render the first field on the bullet line, then the rest
+                    # of the fields nested below it.
+                    (key, first), *rest = item.items()
+                    self._write_item(self._label(key), first, depth)
+                    self._write_value(dict(rest), depth + 1)
+                else:
+                    self._write_item(None, item, depth)
+        else:
+            self._write_item(None, value, depth)
+
+    def _write_item(self, label: str, value: Any, depth: int) -> None:
+        prefix = f"{self.INDENT * depth}- " + (f"{label}:" if label else "")
+        if isinstance(value, (dict, list)):
+            if not value:
+                self._stream.write(f"{prefix} None\n")
+                return
+            self._stream.write(f"{prefix}\n")
+            self._write_value(value, depth + 1)
+        else:
+            self._stream.write(f"{prefix} {value}\n" if label else f"{prefix}{value}\n")
+
+    def emit(self, record: Any) -> None:
+        self._write_value(record, 0)
+
+
+class PlainEmitter(Emitter):
+    """Renders each record as a single line of tab separated values."""
+
+    def emit(self, record: Any) -> None:
+        values = record.values() if isinstance(record, dict) else [record]
+        self._stream.write("\t".join("" if v is None else str(v) for v in values))
+        self._stream.write("\n")
+
+
+class JsonEmitter(Emitter):
+    """Renders each record as a pretty-printed JSON document."""
+
+    def emit(self, record: Any) -> None:
+        json.dump(record, self._stream, indent=2, default=json_default)
+        self._stream.write("\n")
+
+
+class NdjsonEmitter(Emitter):
+    """Renders each record as a single line of JSON (newline delimited JSON)."""
+
+    def emit(self, record: Any) -> None:
+        write_ndjson(self._stream, record)
+
+
+ALL_EMITTERS = {
+    "text": TextEmitter,
+    "plain": PlainEmitter,
+    "json": JsonEmitter,
+    "ndjson": NdjsonEmitter,
+}
@@ -0,0 +1,150 @@
+"""@package urlautomation.cli.server
+Query server of the URL Automation project.
+A long-lived process keeps a warm DatabaseManager (engine, schema checks and
+SQLite page cache) and runs the read-only CLI commands sent to it over HTTP,
+so that tools asking many small questions do not pay the CLI startup cost on
+each of them. Requests are handled one at a time, in the order they arrive.
+"""
+
+from urlautomation.cli import LOG_DATE_FORMAT, LOG_FORMAT, CommandLine
+from urlautomation.cli.client import database_path, is_served
+from urlautomation.cli.commands import ALL_SUBCOMMANDS
+from urlautomation.metrics import METRICS
+
+from contextlib import redirect_stderr, redirect_stdout
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Any, Dict, List
+
+import io
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _MessageHandler(logging.Handler):
+    """Collects the formatted log messages of a command."""
+
+    def __init__(self, messages: List[str]):
+        super().__init__()
+        self.setFormatter(logging.Formatter(LOG_FORMAT, LOG_DATE_FORMAT))
+        self._messages = messages
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self._messages.append(self.format(record))
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of the query server.
+    - GET /health answers whether the server is up.
+    - GET /metrics exports the metrics of the server in the Prometheus format.
+    - POST /run runs a command, given as {"argv": [...], "db_path": ...} (the
+      command line arguments after the global options, and the resolved path
+      of the client's database), and answers with its exit code, output and
+      log messages. Commands for another database than the server's are
+      rejected with a 409 status.
+    """
+
+    server: "QueryServer"
+
+    def _send_json(self, status: int, body: Dict[str, Any]) -> None:
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            payload = METRICS.to_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/run":
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            argv, db_path = request["argv"], request["db_path"]
+            if not isinstance(argv, list) or not all(
+                isinstance(arg, str) for arg in argv
+            ):
+                raise TypeError("argv must be a list of strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Invalid request: {e}"})
+            return
+        if db_path != self.server.db_path:
+            self._send_json(409, {"error": f"The server serves {self.server.db_path}."})
+            return
+        self._send_json(200, self.server.run_command(argv))
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format, *args)
+
+
+class QueryServer(HTTPServer):
+    """HTTP server running read-only commands against a warm database."""
+
+    def __init__(self, address, config: dict, database):
+        """Class constructor for QueryServer.
+        @param address The (host, port) tuple to listen on.
+        @param config The loaded configuration.
+        @param database The DatabaseManager to run the commands against.
+        """
+        super().__init__(address, QueryRequestHandler)
+        self.db_path = database_path(config)
+        self._command_line = CommandLine(config, database)
+        self._parser = CommandLine.build_parser()
+
+    def run_command(self, argv: List[str]) -> Dict[str, Any]:
+        """Runs a command, capturing its output and log messages.
+        @param argv The command line arguments, after the global options.
+        @return A dictionary with the exit code, output and messages.
+        """
+        output = io.StringIO()
+        errors = io.StringIO()
+        messages = []
+        handler = _MessageHandler(messages)
+        logging.getLogger().addHandler(handler)
+        exit_code = 0
+        try:
+            with redirect_stdout(output), redirect_stderr(errors):
+                args = self._parser.parse_args(argv)
+                command_class = ALL_SUBCOMMANDS[args.command]
+                subcommand = getattr(args, command_class.__name__, None)
+                if not is_served(args.command, subcommand):
+                    logger.error(
+                        f"Command '{args.command} {subcommand}' is not served, run it locally."
+                    )
+                    exit_code = 2
+                elif getattr(args, "output", "-") != "-":
+                    logger.error("The server can only write to its response.")
+                    exit_code = 2
+                else:
+                    self._command_line.execute(args)
+        except SystemExit as e:
+            # Raised by argparse for --help and invalid arguments.
+            exit_code = e.code if isinstance(e.code, int) else 2
+        except Exception as e:
+            logger.exception(e)
+            exit_code = 1
+        finally:
+            logging.getLogger().removeHandler(handler)
+
+        if errors.getvalue():
+            messages.extend(errors.getvalue().rstrip("\n").split("\n"))
+        return {
+            "exit_code": exit_code,
+            "output": output.getvalue(),
+            "messages": messages,
+        }
@@ -5,25 +5,142 @@ This package contains the code for the Command Line Interface (CLI)
 
 from argparse import ArgumentParser, Namespace
 
-from urlautomation.database.manager import DatabaseManager
+from urlautomation.database.fetchers import ALL_DATAFETCHERS, CRTSH_MATCH_MODES
+
+from contextlib import nullcontext
+from typing import Iterator
 
 import logging
+import re
+import sys
+
+DOMAIN_NAME_REGEX = re.compile(
+    r"^(?:[a-zA-Z0-9-]+\.)+(?:[a-zA-Z]{2,}|xn--[a-zA-Z0-9-]+)$"
+)
 
 
 class SubCommand:
-    """Class to represent a subcommand in the CLI."""
+    """Class to represent a subcommand in the CLI.
+    The database modules (and with them SQLAlchemy) are imported by the methods
+    using them, so that building the parser does not import them.
+    """
 
     @classmethod
     def add_arguments(cls: "SubCommand", parser: ArgumentParser):
         raise NotImplementedError
 
-    def __init__(self, arguments: Namespace, config: dict, database: DatabaseManager):
-        """Class constructor for DomainCommand."""
+    def __init__(self, arguments: Namespace, config: dict, database):
+        """Class constructor for DomainCommand.
+        @param database The DatabaseManager to run the command against.
+        """
         self._args = arguments
         self._config = config
         self._database = database
         self._logger = logging.getLogger(__name__)
 
+    @staticmethod
+    def _add_crtsh_arguments(parser: ArgumentParser):
+        """Adds the options of the crt.sh searches to a fetching command."""
+        parser.add_argument(
+            "--crtsh-match",
+            choices=CRTSH_MATCH_MODES,
+            default="contains",
+            help="How crt.sh matches the domain: anywhere in the certificates (contains, default), in the identities of its subdomains (subdomains, i.e. %%.domain), or the exact identity (exact).",
+        )
+        parser.add_argument(
+            "--crtsh-exclude-expired",
+            action="store_true",
+            help="Do not fetch the expired certificates from crt.sh.",
+        )
+        parser.add_argument(
+            "--crtsh-deduplicate",
+            action="store_true",
+            help="Have crt.sh skip the precertificates of the certificates that were logged as well.",
+        )
+
+    def _open_archive(self):
+        """Opens the capture archive of the --archive option, to be used in a
+        with statement closing it: the archive, or None without --archive.
+        """
+        archive_path = getattr(self._args, "archive", None)
+        if not archive_path:
+            return nullcontext()
+        from urlautomation.database.archive import CaptureArchive
+
+        return CaptureArchive(archive_path)
+
+    def _all_fetcher_arguments(self, archive=None) -> dict:
+        """Returns the keyword arguments of each data fetcher, by fetcher name,
+        from the fetch options of the command (--dump, --simulate, --quick and
+        the crt.sh search options).
+        @param archive The capture archive opened by _open_archive(), or None.
+        """
+        arguments = {}
+        for fetcher in ALL_DATAFETCHERS:
+            arguments[fetcher] = {
+                "dump": getattr(self._args, "dump", False),
+                "simulate": getattr(self._args, "simulate", False),
+                "quick": getattr(self._args, "quick", False),
+                "archive": archive,
+            }
+        arguments["crtsh"].update(
+            match=getattr(self._args, "crtsh_match", "contains"),
+            exclude_expired=getattr(self._args, "crtsh_exclude_expired", False),
+            deduplicate=getattr(self._args, "crtsh_deduplicate", False),
+        )
+        arguments["securitytrails"]["apikey"] = self._config["securitytrails_api_key"]
+        return arguments
+
+    def _iter_fetch_names(self) -> Iterator[str]:
+        """Streams the domain names to fetch from the arguments, then from the
+        input file (or stdin), without reading the whole input first.
+        """
+        yield from self._args.names
+        if self._args.from_file is None:
+            return
+        if self._args.from_file == "-":
+            input_file = nullcontext(sys.stdin)
+        else:
+            input_file = open(self._args.from_file, "r", encoding="utf-8")
+        with input_file as lines:
+            for line in lines:
+                name = line.strip()
+                if name and not name.startswith("#"):
+                    yield name
+
+    @staticmethod
+    def _normalize_name(name: str) -> str:
+        """Returns the normalized form of a domain name given by the user, or
+        the name as is if it cannot be normalized (it is then invalid).
+        """
+        from urlautomation.database.domainnames import normalize_domain_name
+
+        try:
+            return normalize_domain_name(name)
+        except ValueError:
+            return name
+
+    def _valid_fetch_names(self, names: Iterator[str]) -> Iterator[str]:
+        """Normalizes the domain names (see normalize_domain_name()), and skips
+        the invalid ones with a warning.
+        """
+        for name in names:
+            domain_name = self._normalize_name(name)
+            if not DOMAIN_NAME_REGEX.match(domain_name):
+                self._logger.warning(
+                    f"Invalid domain name provided (skipping): {domain_name}"
+                )
+                continue
+            yield domain_name
+
+    def _warm_entity_cache(self) -> None:
+        """Loads the entity cache of the database before a bulk fetch, so that
+        the entities shared by many domains are linked without queries.
+        """
+        with self._database as session:
+            count = self._database.entities.warm(session)
+        self._logger.debug(f"Loaded {count} entities in the entity cache.")
+
     def execute(self, command: str):
         """Execute the command."""
         raise NotImplementedError
@@ -1,5 +1,6 @@
 """@package urlautomation.database
 This module contains implementations for interacting with the database.
+The DatabaseManager is imported from urlautomation.database.manager rather
+than from this package, so that the modules which do not use the database
+(e.g. domainnames or archive) can be imported without SQLAlchemy.
 """
-
-from urlautomation.database.manager import DatabaseManager as DatabaseManager
@@ -0,0 +1,173 @@
+"""@package urlautomation.database.archive
+This module contains the capture archive of the fetchers' responses.
+A capture archive stores the responses of a whole investigation in a single
+file, so that it can be replayed (--simulate) without opening and parsing one
+JSON file per domain and per certificate. The file is append-only: after a
+magic header, each record is made of its key length and payload length, its
+key ("<provider>/<request>", e.g. "crtsh/search/example.com") and its payload,
+JSON compressed with zlib. When an archive is opened, the offset index of the
+records is built by walking the record headers of the memory-mapped file, and
+responses are then decompressed straight from the mapping. A key appended
+again replaces its previous record, and a record truncated by an interrupted
+write is ignored.
+"""
+
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import zlib
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"UACAP1\n\x00"
+# Key length, payload length.
+RECORD_HEADER = struct.Struct("<HI")
+
+
+class CaptureArchive:
+    """A single-file, append-only archive of captured responses."""
+
+    def __init__(self, path: str):
+        """Class constructor for CaptureArchive. The archive is created if it
+        does not exist.
+        @param path The path to the archive file.
+        """
+        self._path = path
+        self._index: Dict[str, Tuple[int, int]] = {}
+        self._map: Optional[mmap.mmap] = None
+        self._writer = None
+        self._size = 0
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            with open(path, "wb") as f:
+                f.write(MAGIC)
+        self._file = open(path, "rb")
+        if self._file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture archive.")
+        self._end = self._scan(len(MAGIC))
+
+    def _remap(self) -> None:
+        """Maps the file again if it grew since it was mapped."""
+        size = os.fstat(self._file.fileno()).st_size
+        if size != self._size:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._size = size
+
+    def _scan(self, offset: int) -> int:
+        """Adds the records starting at an offset to the index.
+        @return The offset of the end of the last complete record.
+        """
+        self._remap()
+        while offset + RECORD_HEADER.size <= self._size:
+            key_length, payload_length = RECORD_HEADER.unpack_from(self._map, offset)
+            key_offset = offset + RECORD_HEADER.size
+            end = key_offset + key_length + payload_length
+            if end > self._size:
+                logger.warning(
+                    f"Ignoring a truncated record at the end of {self._path}."
+                )
+                break
+            key = self._map[key_offset : key_offset + key_length].decode("utf-8")
+            self._index[key] = (key_offset + key_length, payload_length)
+            offset = end
+        return offset
+
+    @staticmethod
+    def key(provider: str, request: str) -> str:
+        return f"{provider}/{request}"
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def keys(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def get(self, provider: str, request: str) -> Any:
+        """Returns a captured response.
+        @param provider The name of the fetcher that captured the response.
+        @param request The request, e.g. "search/example.com".
+        @return The decoded response, or None if it was not captured.
+        """
+        location = self._index.get(self.key(provider, request))
+        if location is None:
+            return None
+        offset, length = location
+        if offset + length > self._size:
+            self._remap()
+        return json.loads(zlib.decompress(self._map[offset : offset + length]))
+
+    def put(self, provider: str, request: str, data: Any) -> None:
+        """Appends a captured response, replacing any previous capture of the
+        same request.
+        @param provider The name of the fetcher that captured the response.
+        @param request The request, e.g. "search/example.com".
+        @param data The response, serializable to JSON.
+        """
+        key = self.key(provider, request).encode("utf-8")
+        payload = zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        if self._writer is None:
+            self._writer = open(self._path, "r+b")
+            # Drop a truncated record left by an interrupted write.
+            self._writer.truncate(self._end)
+            self._writer.seek(self._end)
+        self._writer.write(RECORD_HEADER.pack(len(key), len(payload)) + key + payload)
+        self._writer.flush()
+        offset = self._end + RECORD_HEADER.size + len(key)
+        self._index[key.decode("utf-8")] = (offset, len(payload))
+        self._end = offset + len(payload)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # Archives are passed to worker processes by path, and reopened there.
+        return {"path": self._path}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__init__(state["path"])
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self) -> "CaptureArchive":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+# Names of the JSON files written by --dump (and read by --simulate), with
+# the (provider, request) they are stored under in a capture archive.
+DUMP_FILE_NAMES = [
+    (re.compile(r"crtsh_(\d+)_parsed\.json"), "crtsh", "certificate/{0}"),
+    (re.compile(r"crtsh_(.+)\.json"), "crtsh", "search/{0}"),
+    (re.compile(r"(.+)_(a|ns)\.json"), "securitytrails", "{1}/{0}"),
+]
+
+
+def pack_directory(archive: CaptureArchive, directory: str) -> int:
+    """Appends the JSON files written by --dump in a directory (e.g. testdata)
+    to a capture archive.
+    @return The number of files appended.
+    """
+    count = 0
+    for file_name in sorted(os.listdir(directory)):
+        for pattern, provider, request in DUMP_FILE_NAMES:
+            if match := pattern.fullmatch(file_name):
+                with open(os.path.join(directory, file_name), "r") as f:
+                    archive.put(provider, request.format(*match.groups()), json.load(f))
+                count += 1
+                break
+    return count
@@ -1,13 +1,104 @@
-from typing import Union, List
+from urlautomation.metrics import METRICS
 
+from typing import Any, Iterator, Union, List
+
+import json
 import logging
+import requests
 
 
 class DataFetcher:
+    # The name of the fetcher in ALL_DATAFETCHERS, used to label its metrics.
+    NAME = None
+
     def __init__(self, database):
         """Class constructor for DataFetcher."""
         self._database = database
         self._logger = logging.getLogger(__name__)
 
-    def fetch_data(self, domains: Union[str, List[str]], **kwargs) -> None:
+    def _http_get(self, url: str, endpoint: str, **kwargs) -> requests.Response:
+        """Makes an HTTP GET request, recording its duration and response size.
+        @param url The URL to request.
+        @param endpoint The kind of request, used to label the metrics.
+        @param kwargs The keyword arguments of requests.get().
+        """
+        METRICS.count("api_requests", fetcher=self.NAME)
+        with METRICS.timer("http_request", fetcher=self.NAME, endpoint=endpoint):
+            response = requests.get(url, **kwargs)
+        METRICS.count(
+            "http_response_bytes",
+            len(response.content),
+            fetcher=self.NAME,
+            endpoint=endpoint,
+        )
+        METRICS.count(
+            "http_responses",
+            fetcher=self.NAME,
+            endpoint=endpoint,
+            status=response.status_code,
+        )
+        return response
+
+    def _replay(self, request: str, file_name: str, archive=None) -> Any:
+        """Loads a captured response, for --simulate.
+        @param request The request, e.g. "search/example.com".
+        @param file_name The name of the JSON file of the response in testdata.
+        @param archive The CaptureArchive to replay from instead of testdata.
+        """
+        # Counted as the request it replays, e.g. for the refresh budget.
+        METRICS.count("api_requests", fetcher=self.NAME, simulated=True)
+        if archive is not None:
+            response = archive.get(self.NAME, request)
+            if response is None:
+                raise KeyError(f"{self.NAME}/{request} is not in the capture archive.")
+            return response
+        with open(f"testdata/{file_name}", "r") as f:
+            return json.load(f)
+
+    def _capture(
+        self, request: str, file_name: str, response: Any, archive=None, indent=2
+    ) -> None:
+        """Saves a response, for --dump.
+        @param request The request, e.g. "search/example.com".
+        @param file_name The name of the JSON file to write the response to.
+        @param response The response to save.
+        @param archive The CaptureArchive to append to instead of a file.
+        """
+        if archive is not None:
+            archive.put(self.NAME, request, response)
+            return
+        with open(file_name, "w") as f:
+            json.dump(response, f, indent=indent)
+
+    def collect(self, domains: Union[str, List[str]], **kwargs) -> Any:
+        """Requests (or replays) and parses the data of domains, without
+        writing to the database, so that it can run in a worker process.
+        @param domains The domains to fetch data for.
+        @param kwargs The fetch options (dump, simulate, quick, archive...).
+        @return A batch of normalized records for ingest(), made of plain
+        (picklable) values.
+        """
         raise NotImplementedError("Subclasses should implement this method.")
+
+    def ingest(self, session, batch: Any) -> None:
+        """Writes a batch returned by collect() to the database. The session
+        is only flushed, the caller commits.
+        """
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def split(self, batch: Any, size: int) -> Iterator[Any]:
+        """Splits a batch returned by collect() into smaller batches of about
+        size records, so that long ingests are written a chunk at a time.
+        Each chunk must be ingestable on its own, after the previous ones.
+        Batches are not split by default.
+        """
+        yield batch
+
+    def count_records(self, batch: Any) -> int:
+        """Returns the number of records of a batch, see split()."""
+        return 1
+
+    def fetch_data(self, domains: Union[str, List[str]], **kwargs) -> None:
+        """Fetches the data of domains and writes it to the database."""
+        batch = self.collect(domains, **kwargs)
+        self._database.ingest_data(self.NAME, batch)
@@ -0,0 +1,120 @@
+"""@package urlautomation.database.domainnames
+This module contains the normalization of domain names and their grouping by
+registrable domain (e.g. "pokerkg.com" for "game.pokerkg.com").
+Registrable domains are found with the Public Suffix List bundled with the
+package (public_suffix_list.dat, both its ICANN and private sections), loaded
+on first use into a trie of reversed labels, so that the public suffix of a
+name is found by walking its labels from the TLD, one dictionary lookup per
+label.
+"""
+
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional
+
+import os
+
+PUBLIC_SUFFIX_LIST = os.path.join(os.path.dirname(__file__), "public_suffix_list.dat")
+
+# Key of the rule flag in the trie nodes (no label is empty).
+RULE = ""
+NORMAL, EXCEPTION = 1, 2
+
+
+def normalize_domain_name(name: str) -> str:
+    """Normalizes a domain name: surrounding spaces and trailing dot removed,
+    internationalized labels encoded to their ASCII (punycode) form, and
+    lowercase, e.g. "Bücher.Example." becomes "xn--bcher-kva.example".
+    @raise ValueError If the name has empty or too long labels.
+    """
+    name = name.strip().rstrip(".")
+    try:
+        return name.encode("idna").decode("ascii").lower()
+    except UnicodeError as e:
+        raise ValueError(f"Invalid domain name: {name}") from e
+
+
+class SuffixTrie:
+    """A trie of the Public Suffix List rules, keyed by reversed labels."""
+
+    def __init__(self, rules: Iterable[str]):
+        """Class constructor for SuffixTrie.
+        @param rules The rules, e.g. "co.uk", "*.ck" or "!www.ck".
+        """
+        self._root: Dict[str, dict] = {}
+        for rule in rules:
+            kind = EXCEPTION if rule.startswith("!") else NORMAL
+            node = self._root
+            for label in reversed(rule.lstrip("!").split(".")):
+                if label == "*":
+                    # A wildcard rule implies its parent is a public suffix.
+                    node.setdefault(RULE, NORMAL)
+                node = node.setdefault(label, {})
+            node[RULE] = kind
+
+    @classmethod
+    def load(cls, path: str = PUBLIC_SUFFIX_LIST) -> "SuffixTrie":
+        """Loads the rules of a Public Suffix List file. Internationalized
+        rules are added in their ASCII form, the form of normalized names.
+        """
+        rules = []
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                rule = line.strip()
+                if not rule or rule.startswith("//"):
+                    continue
+                if not rule.isascii():
+                    prefix = "!" if rule.startswith("!") else ""
+                    try:
+                        rule = prefix + normalize_domain_name(rule.lstrip("!"))
+                    except ValueError:
+                        continue
+                rules.append(rule)
+        return cls(rules)
+
+    def suffix_length(self, labels: List[str]) -> int:
+        """Returns the number of labels of the public suffix of a name. Names
+        under no rule have their TLD as public suffix.
+        @param labels The labels of the (normalized) name.
+        """
+        node = self._root
+        length = 1
+        for depth, label in enumerate(reversed(labels), 1):
+            if "*" in node:
+                # Wildcards are always the leftmost label of their rule.
+                length = depth
+            node = node.get(label)
+            if node is None:
+                break
+            rule = node.get(RULE)
+            if rule == EXCEPTION:
+                # An exception rule's suffix is the rule without its label.
+                return depth - 1
+            if rule == NORMAL:
+                length = depth
+        return length
+
+
+@lru_cache(maxsize=1)
+def public_suffixes() -> SuffixTrie:
+    """Returns the trie of the bundled Public Suffix List."""
+    return SuffixTrie.load()
+
+
+def public_suffix(domain_name: str) -> str:
+    """Returns the public suffix of a normalized domain name, e.g. "co.uk"
+    for "www.example.co.uk".
+    """
+    labels = domain_name.split(".")
+    return ".".join(labels[-public_suffixes().suffix_length(labels) :])
+
+
+def registrable_domain(domain_name: str) -> Optional[str]:
+    """Returns the registrable domain of a normalized domain name, e.g.
+    "example.co.uk" for "www.example.co.uk".
+    @return The registrable domain, or None if the name is a public suffix.
+    """
+    labels = domain_name.split(".")
+    length = public_suffixes().suffix_length(labels) + 1
+    if len(labels) < length:
+        return None
+    return ".".join(labels[-length:])
@@ -0,0 +1,208 @@
+"""@package urlautomation.database.entitycache
+This module contains the entity cache shared by the data fetchers.
+Domains, certificates, identities, organizations, IP addresses and nameservers
+are interned: each natural key (e.g. a domain name) is stored once, and every
+fetch looks its row up before linking it. The cache maps these natural keys to
+primary keys, so that repeated lookups across fetches and fetchers are
+answered by a primary key lookup (from the identity map of the session when
+the row is already loaded) instead of a query on the natural key.
+The cache is bounded, evicting the least recently used keys. Interned rows are
+never deleted, so a cached key can only become wrong when the transaction that
+inserted its row is rolled back, or when the database is changed behind the
+process. Every rollback starts a new cache generation, which invalidates all
+the entries at once (they are dropped lazily), and so does a commit by another
+connection (e.g. another process), detected with PRAGMA data_version at the
+start of each unit of work. Rows inserted by other processes are otherwise
+found by a query on the first miss.
+"""
+
+from urlautomation.database.types import (
+    ARecordIP,
+    Domain,
+    EntityDegree,
+    NSRecordNameserver,
+    Organization,
+    SSLCertificate,
+    SSLCertificateIdentity,
+)
+from urlautomation.metrics import METRICS
+
+from sqlalchemy import and_, inspect, select
+
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# The columns making the natural key of each interned entity.
+ENTITY_KEYS: Dict[type, Tuple[str, ...]] = {
+    Domain: ("domain_name",),
+    SSLCertificate: ("serial_number", "issuer_ca_id"),
+    SSLCertificateIdentity: ("certificate_id", "identity"),
+    Organization: ("organization_name",),
+    ARecordIP: ("ip_address",),
+    NSRecordNameserver: ("nameserver",),
+}
+
+# Entities warmed by degree (the hubs linked to many domains first), with the
+# column of their ID in EntityDegree.
+DEGREE_TYPES = {
+    ARecordIP: EntityDegree.IP,
+    NSRecordNameserver: EntityDegree.NAMESERVER,
+    Organization: EntityDegree.ORGANIZATION,
+}
+
+
+def _primary_key(model: type) -> str:
+    """Returns the name of the primary key attribute of an entity type."""
+    return inspect(model).primary_key[0].key
+
+
+class EntityCache:
+    """A bounded LRU cache of the primary keys of interned entities."""
+
+    def __init__(self, max_size: int = 100000):
+        """Class constructor for EntityCache.
+        @param max_size The maximum number of cached keys.
+        """
+        self._max_size = max_size
+        self._generation = 0
+        # The number of commits made by this process, to tell its own commits
+        # apart from the ones of other processes (see check_data_version()).
+        self._commits = 0
+        # (entity type, natural key) -> (primary key, generation)
+        self._entries: "OrderedDict[tuple, Tuple[Any, int]]" = OrderedDict()
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def invalidate(self) -> None:
+        """Invalidates every cached key, e.g. after a rollback."""
+        self._generation += 1
+
+    def check_data_version(self, connection) -> None:
+        """Invalidates the cache if another connection committed to the
+        database since the given connection last checked it, at the start of a
+        unit of work. SQLite changes the data version of a connection on the
+        commits of every other connection, including the other connections of
+        this process: when this process committed through another connection
+        in the meantime, the change cannot be told apart from its own and the
+        cache is kept.
+        @param connection The connection the unit of work runs in.
+        """
+        version = connection.exec_driver_sql("PRAGMA data_version").scalar()
+        seen = connection.info.get("data_version")
+        if seen is not None and seen != (version, self._commits):
+            if seen[0] != version and seen[1] == self._commits:
+                METRICS.count("entity_cache_invalidations", reason="data_version")
+                self.invalidate()
+        connection.info["data_version"] = (version, self._commits)
+
+    def after_commit(self, connection) -> None:
+        """Counts a commit of this process. Its own commits do not change the
+        data version of the connection they are made through.
+        @param connection The connection committing.
+        """
+        self._commits += 1
+        seen = connection.info.get("data_version")
+        if seen is not None and seen[1] == self._commits - 1:
+            connection.info["data_version"] = (seen[0], self._commits)
+
+    @staticmethod
+    def natural_key(entity) -> Any:
+        """Returns the natural key of an interned entity: the value of its key
+        column, or a tuple of values for keys made of several columns.
+        """
+        values = tuple(getattr(entity, column) for column in ENTITY_KEYS[type(entity)])
+        return values if len(values) > 1 else values[0]
+
+    def get(self, model: type, key: Any) -> Optional[Any]:
+        """Returns the cached primary key of an entity, or None."""
+        entry = self._entries.get((model, key))
+        if entry is None or entry[1] != self._generation:
+            METRICS.count(
+                "entity_cache_lookups", entity=model.__tablename__, result="miss"
+            )
+            return None
+        self._entries.move_to_end((model, key))
+        METRICS.count("entity_cache_lookups", entity=model.__tablename__, result="hit")
+        return entry[0]
+
+    def put(self, model: type, key: Any, primary_key: Any) -> None:
+        """Caches the primary key of an entity."""
+        self._entries[(model, key)] = (primary_key, self._generation)
+        self._entries.move_to_end((model, key))
+        if len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+    def discard(self, model: type, key: Any) -> None:
+        self._entries.pop((model, key), None)
+
+    def find(self, session, model: type, key: Any):
+        """Returns the entity of a natural key, from the cache or from the
+        database.
+        @param model The type of the entity, one of ENTITY_KEYS.
+        @param key The natural key: a value, or a tuple of values for keys
+        made of several columns.
+        @return The entity, or None if it is not in the database.
+        """
+        primary_key = self.get(model, key)
+        if primary_key is not None:
+            entity = session.get(model, primary_key)
+            if entity is not None:
+                return entity
+            self.discard(model, key)
+        columns = ENTITY_KEYS[model]
+        values = key if len(columns) > 1 else (key,)
+        entity = session.query(model).filter_by(**dict(zip(columns, values))).first()
+        if entity is not None:
+            self.put(model, key, inspect(entity).identity[0])
+        return entity
+
+    def after_flush(self, session) -> None:
+        """Caches the entities inserted by a flush, and drops the deleted ones."""
+        for entity in session.new:
+            if type(entity) in ENTITY_KEYS:
+                # The identity key is only set once the flush completes, but
+                # the primary key is already fetched.
+                primary_key = getattr(entity, _primary_key(type(entity)))
+                if primary_key is not None:
+                    self.put(type(entity), self.natural_key(entity), primary_key)
+        for entity in session.deleted:
+            if type(entity) in ENTITY_KEYS:
+                self.discard(type(entity), self.natural_key(entity))
+
+    def warm(self, session, limit: Optional[int] = None) -> int:
+        """Loads the keys the next fetches are most likely to look up, e.g. at
+        the start of a bulk fetch: the most shared IP addresses, nameservers
+        and organizations, and the most recent domains, certificates and
+        identities, the cache being split evenly between them.
+        @param limit The maximum number of keys to load, by default the size
+        of the cache.
+        @return The number of keys loaded.
+        """
+        per_type = (limit or self._max_size) // len(ENTITY_KEYS)
+        count = 0
+        with METRICS.timer("entity_cache_warm"):
+            for model, columns in ENTITY_KEYS.items():
+                primary_key = inspect(model).primary_key[0]
+                query = select(primary_key, *(getattr(model, c) for c in columns))
+                if model in DEGREE_TYPES:
+                    query = query.outerjoin(
+                        EntityDegree,
+                        and_(
+                            EntityDegree.entity_type == DEGREE_TYPES[model],
+                            EntityDegree.entity_id == primary_key,
+                        ),
+                    ).order_by(EntityDegree.degree.desc().nulls_last())
+                else:
+                    query = query.order_by(primary_key.desc())
+                rows = session.execute(query.limit(per_type)).all()
+                # Least likely first, so that they are evicted first.
+                for row in reversed(rows):
+                    key = tuple(row[1:]) if len(columns) > 1 else row[1]
+                    self.put(model, key, row[0])
+                count += len(rows)
+        return count
@@ -1,7 +1,25 @@
-from urlautomation.database.fetchers.securitytrails import SecurityTrailsDataFetcher
-from urlautomation.database.fetchers.crtsh import CrtshDataFetcher
+from importlib import import_module
 
+# The fetchers are only imported when they are used, so that commands which do
+# not fetch anything do not pay for importing requests and lxml.
 ALL_DATAFETCHERS = {
-    "crtsh": CrtshDataFetcher,
-    "securitytrails": SecurityTrailsDataFetcher,
+    "crtsh": "urlautomation.database.fetchers.crtsh.CrtshDataFetcher",
+    "securitytrails": "urlautomation.database.fetchers.securitytrails.SecurityTrailsDataFetcher",
 }
+
+# The minimum number of API requests fetching one domain costs, per fetcher
+# (crt.sh also requests a detail page per new certificate, unless --quick).
+REQUEST_COSTS = {"crtsh": 1, "securitytrails": 2}
+
+# How crt.sh searches match a domain: anywhere in the certificates (the
+# default), in the identities of its subdomains, or the exact identity.
+CRTSH_MATCH_MODES = ["contains", "subdomains", "exact"]
+
+
+def load_datafetcher(name: str) -> type:
+    """Imports and returns the class of a data fetcher.
+    @param name The name of the fetcher, one of ALL_DATAFETCHERS.
+    @return The DataFetcher subclass.
+    """
+    module_name, _, class_name = ALL_DATAFETCHERS[name].rpartition(".")
+    return getattr(import_module(module_name), class_name)
@@ -4,31 +4,96 @@ This module contains the implementation datafetcher for crt.sh.
 
 from urlautomation.database.datafetcher import DataFetcher
 from urlautomation.database.types import Domain, SSLCertificate, SSLCertificateIdentity
+from urlautomation.metrics import METRICS
 
-from typing import Union, Dict, List, Any
+from typing import Union, Dict, Iterator, List, Any
 from collections import defaultdict
 from datetime import datetime
 from lxml import html
+from sqlalchemy import select
 
 import requests
-import json
 import re
 
 
 class CrtshDataFetcher(DataFetcher):
     """This class is responsible for fetching data from crt.sh.
-    It inherits from the DataFetcher class and implements the fetch_data method.
+    It inherits from the DataFetcher class and implements the collect and ingest
+    methods.
     """
 
+    NAME = "crtsh"
     CRTSH_URL = "https://crt.sh"
 
-    @classmethod
-    def _crtsh_request(cls, **kwargs: Dict[str, Any]) -> requests.Response:
+    def _crtsh_request(self, **kwargs: Dict[str, Any]) -> requests.Response:
         """Make a request to the crt.sh API."""
-        response = requests.get(cls.CRTSH_URL, params=kwargs)
+        endpoint = "certificate" if "c" in kwargs else "search"
+        response = self._http_get(self.CRTSH_URL, endpoint, params=kwargs)
         response.raise_for_status()
         return response
 
+    @staticmethod
+    def _search_params(
+        domain: str, match: str, exclude_expired: bool, deduplicate: bool
+    ) -> Dict[str, str]:
+        """Returns the parameters of the crt.sh search of a domain, so that
+        crt.sh filters the results instead of sending all of them.
+        @param match The match mode, one of CRTSH_MATCH_MODES.
+        @param exclude_expired Skip the expired certificates.
+        @param deduplicate Skip the precertificates of the certificates that
+        were logged as well.
+        """
+        if match == "contains":
+            params = {"q": f"%{domain}%"}
+        elif match == "subdomains":
+            params = {"identity": f"%.{domain}"}
+        elif match == "exact":
+            params = {"identity": domain, "match": "="}
+        else:
+            raise ValueError(f"Unknown crt.sh match mode: {match}")
+        if exclude_expired:
+            params["exclude"] = "expired"
+        if deduplicate:
+            params["deduplicate"] = "Y"
+        params["output"] = "json"
+        return params
+
+    @staticmethod
+    def _reduce_results(
+        results: List[Dict[str, Any]],
+        domain: str,
+        match: str,
+        exclude_expired: bool,
+    ) -> List[Dict[str, Any]]:
+        """Applies the match mode and expiry filter to search results, for
+        replayed responses that were captured without them.
+        """
+        domain = domain.lower()
+        if match == "subdomains":
+            suffix = f".{domain}"
+            results = [
+                result
+                for result in results
+                if any(
+                    name.lower().endswith(suffix)
+                    for name in result["name_value"].splitlines()
+                )
+            ]
+        elif match == "exact":
+            results = [
+                result
+                for result in results
+                if domain in result["name_value"].lower().splitlines()
+            ]
+        if exclude_expired:
+            now = datetime.now()
+            results = [
+                result
+                for result in results
+                if datetime.fromisoformat(result["not_after"]) >= now
+            ]
+        return results
+
     def _deduplicate_results(
         self, results: List[Dict[str, Any]]
     ) -> List[Dict[str, Any]]:
@@ -43,6 +108,10 @@ class CrtshDataFetcher(DataFetcher):
         return deduplicated_results
 
     def _parse_certificate_data_string(self, cert_text: str) -> dict:
+        with METRICS.timer("parse", fetcher=self.NAME, format="certificate_text"):
+            return self._parse_certificate_text(cert_text)
+
+    def _parse_certificate_text(self, cert_text: str) -> dict:
         cert_text = cert_text.replace("\xa0", " ")
         cert_text = re.sub(r"\s+", " ", cert_text).strip()
 
@@ -177,93 +246,173 @@ class CrtshDataFetcher(DataFetcher):
     def _fetch_and_parse_certificate_html(self, cert_id: int) -> dict:
         """Fetch and parse certificate details from the crt.sh HTML page."""
         response = self._crtsh_request(c=cert_id)
-        tree = html.fromstring(response.content.decode("utf-8"))
-        # Get the second <table>
-        tables = tree.xpath("//table")
-        if len(tables) < 2:
-            return {}
-        cert_table = tables[1]
-        cert_data_element = cert_table.xpath(
-            ".//tr[td[contains(., 'Certificate:')]]/td"
-        )
-        if not cert_data_element:
-            return {}
-        raw_text = cert_data_element[0].text_content().strip()
+        with METRICS.timer("parse", fetcher=self.NAME, format="html"):
+            tree = html.fromstring(response.content.decode("utf-8"))
+            # Get the second <table>
+            tables = tree.xpath("//table")
+            if len(tables) < 2:
+                return {}
+            cert_table = tables[1]
+            cert_data_element = cert_table.xpath(
+                ".//tr[td[contains(., 'Certificate:')]]/td"
+            )
+            if not cert_data_element:
+                return {}
+            raw_text = cert_data_element[0].text_content().strip()
         return self._parse_certificate_data_string(raw_text)
 
-    def fetch_data(self, domains: Union[str, List[str]], **kwargs) -> None:
+    @staticmethod
+    def _known_certificates(session, results: List[Dict[str, Any]]) -> set:
+        """Returns the (serial number, issuer CA ID) of the certificates of
+        search results that are already in the database.
+        """
+        serial_numbers = sorted({result["serial_number"] for result in results})
+        known = set()
+        for i in range(0, len(serial_numbers), 500):
+            known.update(
+                session.execute(
+                    select(
+                        SSLCertificate.serial_number, SSLCertificate.issuer_ca_id
+                    ).where(
+                        SSLCertificate.serial_number.in_(serial_numbers[i : i + 500])
+                    )
+                ).tuples()
+            )
+        return known
+
+    def collect(self, domains: Union[str, List[str]], **kwargs) -> Dict[str, Any]:
         dump = kwargs.get("dump", False)
         simulate = kwargs.get("simulate", False)
+        archive = kwargs.get("archive")
         quick_fetch = kwargs.get("quick", False)
+        match = kwargs.get("match", "contains")
+        exclude_expired = kwargs.get("exclude_expired", False)
+        deduplicate = kwargs.get("deduplicate", False)
         domains = domains if isinstance(domains, list) else [domains]
         responses = []
 
         # First, fetch the data for the requested domains from crt.sh
         if simulate:
             for domain in domains:
-                with open(f"testdata/crtsh_{domain}.json", "r") as f:
-                    response_json = json.load(f)
+                with METRICS.timer("parse", fetcher=self.NAME, format="json"):
+                    response_json = self._replay(
+                        f"search/{domain}", f"crtsh_{domain}.json", archive
+                    )
+                response_json = self._reduce_results(
+                    response_json, domain, match, exclude_expired
+                )
                 responses.extend(self._deduplicate_results(response_json))
         else:
             for domain in domains:
-                response = self._crtsh_request(q=f"%{domain}%", output="json")
-                response_json = response.json()
+                response = self._crtsh_request(
+                    **self._search_params(domain, match, exclude_expired, deduplicate)
+                )
+                with METRICS.timer("parse", fetcher=self.NAME, format="json"):
+                    response_json = response.json()
                 if dump:
                     try:
-                        with open(f"crtsh_{domain}.json", "w") as f:
-                            json.dump(response_json, f, indent=2)
+                        self._capture(
+                            f"search/{domain}",
+                            f"crtsh_{domain}.json",
+                            response_json,
+                            archive,
+                        )
                     except:
                         self._logger.exception(f"Failed to dump response for {domain}")
                         self._logger.info(f"{response_json}")
 
                 responses.extend(self._deduplicate_results(response_json))
 
-        cached_domains = {}
-        cached_certs = {}
+        # Then get the extended data of the certificates not in the database
+        certificates = {}
+        if not quick_fetch:
+            with self._database as session:
+                known = self._known_certificates(session, responses)
+            for response in responses:
+                cert_key = (response["serial_number"], response["issuer_ca_id"])
+                if cert_key in known:
+                    continue
+                known.add(cert_key)
+                cert_id = response["id"]
+                try:
+                    if simulate:
+                        parsed = self._replay(
+                            f"certificate/{cert_id}",
+                            f"crtsh_{cert_id}_parsed.json",
+                            archive,
+                        )
+                    else:
+                        parsed = self._fetch_and_parse_certificate_html(cert_id)
+                except:
+                    self._logger.warning(
+                        f"Could not get extended data for ID {cert_id}",
+                        exc_info=True,
+                    )
+                    continue
+                if dump:
+                    self._capture(
+                        f"certificate/{cert_id}",
+                        f"crtsh_{cert_id}_parsed.json",
+                        parsed,
+                        archive,
+                    )
+                certificates[cert_id] = parsed
+
+        return {"results": responses, "certificates": certificates}
+
+    def split(self, batch: Dict[str, Any], size: int) -> Iterator[Dict[str, Any]]:
+        """Splits a batch into batches of size search results, each with the
+        extended data of its certificates.
+        """
+        results = batch["results"]
+        for start in range(0, len(results) or 1, size):
+            chunk = results[start : start + size]
+            yield {
+                "results": chunk,
+                "certificates": {
+                    response["id"]: batch["certificates"][response["id"]]
+                    for response in chunk
+                    if response["id"] in batch["certificates"]
+                },
+            }
+
+    def count_records(self, batch: Dict[str, Any]) -> int:
+        return len(batch["results"])
+
+    def ingest(self, session, batch: Dict[str, Any]) -> None:
+        new_domains = []
         cert_stat = defaultdict(int)
+        entities = self._database.entities
 
         # Process responses, add new records to the database
-        with self._database as session:
-            for response in responses:
+        with METRICS.timer("ingest", fetcher=self.NAME):
+            for response in batch["results"]:
                 for name_value in response["name_value"].splitlines():
                     if name_value.startswith("*."):
                         continue
 
-                    # Fetch or create domain
-                    if (domain := cached_domains.get(name_value)) is None:
-                        domain = (
-                            session.query(Domain)
-                            .filter_by(domain_name=name_value)
-                            .first()
+                    # Fetch or create domain. New domains are flushed right
+                    # away, so that the entity cache knows them when they
+                    # appear again in the batch.
+                    domain = entities.find(session, Domain, name_value)
+                    if domain is None:
+                        self._logger.debug(
+                            f"Creating new domain {name_value} in the database."
                         )
-                        if domain is None:
-                            self._logger.debug(
-                                f"Creating new domain {name_value} in the database."
-                            )
-                            domain = Domain(domain_name=name_value)
-                            session.add(domain)
-                        cached_domains[name_value] = domain
+                        domain = Domain(domain_name=name_value)
+                        session.add(domain)
+                        session.flush()
+                        new_domains.append(domain)
 
                     cert_key = (response["serial_number"], response["issuer_ca_id"])
-                    if (ssl_cert := cached_certs.get(cert_key)) is None:
-                        ssl_cert = (
-                            session.query(SSLCertificate)
-                            .filter_by(
-                                serial_number=response["serial_number"],
-                                issuer_ca_id=response["issuer_ca_id"],
-                            )
-                            .first()
-                        )
+                    ssl_cert = entities.find(session, SSLCertificate, cert_key)
 
                     if ssl_cert:
                         # Ensure the certificate identity is associated with the domain
-                        identity = (
-                            session.query(SSLCertificateIdentity)
-                            .filter_by(
-                                certificate_id=ssl_cert.certificate_id,
-                                identity=name_value,
-                            )
-                            .first()
+                        identity = entities.find(
+                            session,
+                            SSLCertificateIdentity,
+                            (ssl_cert.certificate_id, name_value),
                         )
 
                         if identity is None:
@@ -277,24 +426,7 @@ class CrtshDataFetcher(DataFetcher):
 
                         continue
                     else:
-                        parsed = None
-                        if not quick_fetch:
-                            cert_id = response["id"]
-                            try:
-                                if simulate:
-                                    with open(
-                                        f"testdata/crtsh_{cert_id}_parsed.json", "r"
-                                    ) as f:
-                                        parsed = json.load(f)
-                                else:
-                                    parsed = self._fetch_and_parse_certificate_html(
-                                        cert_id
-                                    )
-                            except:
-                                self._logger.warning(
-                                    f"Could not get extended data for ID {cert_id}",
-                                    exc_info=True,
-                                )
+                        parsed = batch["certificates"].get(response["id"])
 
                         # Create new SSL certificate
                         ssl_cert = SSLCertificate(
@@ -308,10 +440,6 @@ class CrtshDataFetcher(DataFetcher):
                             serial_number=response["serial_number"],
                         )
                         if parsed is not None:
-                            if dump:
-                                with open(f"crtsh_{cert_id}_parsed.json", "w") as f:
-                                    json.dump(parsed, f, indent=2)
-
                             ssl_cert.subject_key_identifier = parsed[
                                 "subject_key_identifier"
                             ]
@@ -333,7 +461,7 @@ class CrtshDataFetcher(DataFetcher):
                             )
 
                         session.add(ssl_cert)
-                        session.commit()
+                        session.flush()
 
                         identity = SSLCertificateIdentity(
                             identity=name_value, certificate=ssl_cert
@@ -342,11 +470,16 @@ class CrtshDataFetcher(DataFetcher):
 
                         session.add(identity)
 
-                        # Cache certificate to prevent future redundant queries
-                        cached_certs[cert_key] = ssl_cert
-
                     cert_stat[name_value] += 1
 
+            session.flush()
+            self._database.index_new_domains(session, new_domains)
+
+            METRICS.count("domains_added", len(new_domains), fetcher=self.NAME)
+            METRICS.count(
+                "certificates_added", sum(cert_stat.values()), fetcher=self.NAME
+            )
+
             # Log new certificates added per domain
             for name_value, count in cert_stat.items():
                 self._logger.info(
@@ -11,21 +11,23 @@ from urlautomation.database.types import (
     NSRecordNameserver,
     NSRecordValue,
     Organization,
+    EntityDegree,
 )
+from urlautomation.metrics import METRICS
 
-from typing import Union, Dict, List
+from typing import Union, Dict, Iterator, List
 from datetime import datetime
 from collections import defaultdict
 
-import json
-import requests
-
 
 class SecurityTrailsDataFetcher(DataFetcher):
     """This class is responsible for fetching data from the SecurityTrails API.
-    It inherits from the DataFetcher class and implements the fetch_data method.
+    It inherits from the DataFetcher class and implements the collect and ingest
+    methods.
     """
 
+    NAME = "securitytrails"
+
     def _make_request(self, apikey: str, domain: str, record_type: str) -> List[dict]:
         """Make a request to the SecurityTrails API."""
         url = f"https://api.securitytrails.com/v1/history/{domain}/dns/{record_type}"
@@ -33,12 +35,13 @@ class SecurityTrailsDataFetcher(DataFetcher):
             "Content-Type": "application/json",
             "APIKEY": apikey,
         }
-        response = requests.get(url, headers=headers)
+        response = self._http_get(url, record_type, headers=headers)
         response.raise_for_status()
 
-        return response.json()["records"]
+        with METRICS.timer("parse", fetcher=self.NAME, format="json"):
+            return response.json()["records"]
 
-    def fetch_data(self, domains: Union[str, List[str]], **kwargs) -> None:
+    def collect(self, domains: Union[str, List[str]], **kwargs) -> Dict[str, list]:
         # Currently we only fetch A and NS records.
         request_responses = defaultdict(list)
 
@@ -48,8 +51,12 @@ class SecurityTrailsDataFetcher(DataFetcher):
         if kwargs.get("simulate", False):
             for domain in domains:
                 for record_type in ["a", "ns"]:
-                    with open(f"testdata/{domain}_{record_type}.json", "r") as f:
-                        response_json = json.load(f)
+                    with METRICS.timer("parse", fetcher=self.NAME, format="json"):
+                        response_json = self._replay(
+                            f"{record_type}/{domain}",
+                            f"{domain}_{record_type}.json",
+                            kwargs.get("archive"),
+                        )
                     request_responses[domain].extend(response_json)
         else:
             for domain in domains:
@@ -57,8 +64,13 @@ class SecurityTrailsDataFetcher(DataFetcher):
                     response = self._make_request(kwargs["apikey"], domain, record_type)
                     if kwargs.get("dump", False):
                         try:
-                            with open(f"{domain}_{record_type}.json", "w") as f:
-                                json.dump(response, f, indent=4)
+                            self._capture(
+                                f"{record_type}/{domain}",
+                                f"{domain}_{record_type}.json",
+                                response,
+                                kwargs.get("archive"),
+                                indent=4,
+                            )
                         except:
                             self._logger.exception(
                                 f"Failed to dump response for {domain}"
@@ -68,26 +80,43 @@ class SecurityTrailsDataFetcher(DataFetcher):
 
         if not request_responses:
             self._logger.warning(f"No data found for domains: {domains}")
-            return
-
+        return dict(request_responses)
+
+    def split(self, batch: Dict[str, list], size: int) -> Iterator[Dict[str, list]]:
+        """Splits a batch into batches of size responses (one record type of
+        a domain each). The responses of a domain may span several batches.
+        """
+        chunk, records = {}, 0
+        for domain_name, responses in batch.items():
+            chunk.setdefault(domain_name, [])
+            for response in responses:
+                if records >= size:
+                    yield chunk
+                    chunk, records = {domain_name: []}, 0
+                chunk[domain_name].append(response)
+                records += 1
+        yield chunk
+
+    def count_records(self, batch: Dict[str, list]) -> int:
+        return sum(len(responses) for responses in batch.values())
+
+    def ingest(self, session, batch: Dict[str, list]) -> None:
         # welcome to hell
-        cached_domains = {}
-        with self._database as session:
-            for domain_name, responses in request_responses.items():
+        new_domains = []
+        linked_ips, linked_nameservers, linked_organizations = set(), set(), set()
+        entities = self._database.entities
+        with METRICS.timer("ingest", fetcher=self.NAME):
+            for domain_name, responses in batch.items():
                 # Fetch or create domain
-                domain = cached_domains.get(domain_name)
+                domain = entities.find(session, Domain, domain_name)
                 if domain is None:
-                    domain = (
-                        session.query(Domain).filter_by(domain_name=domain_name).first()
+                    self._logger.debug(
+                        f"Creating new domain {domain_name} in the database."
                     )
-                    if domain is None:
-                        self._logger.debug(
-                            f"Creating new domain {domain_name} in the database."
-                        )
-                        domain = Domain(domain_name=domain_name)
-                        session.add(domain)
-                        session.commit()  # Get domain_id
-                    cached_domains[domain_name] = domain
+                    domain = Domain(domain_name=domain_name)
+                    session.add(domain)
+                    session.flush()  # Get domain_id
+                    new_domains.append(domain)
 
                 domain_id = domain.domain_id
 
@@ -96,8 +125,8 @@ class SecurityTrailsDataFetcher(DataFetcher):
                 if record is None:
                     record = DNSRecord(domain_id=domain_id)
                     session.add(record)
-                    # Commit to get a record_id associated.
-                    session.commit()
+                    # Flush to get a record_id associated.
+                    session.flush()
 
                 dns_stat = defaultdict(int)
 
@@ -131,40 +160,32 @@ class SecurityTrailsDataFetcher(DataFetcher):
                         session.add(sub_record)
 
                     for organization in response["organizations"]:
-                        db_org = (
-                            session.query(Organization)
-                            .filter_by(organization_name=organization)
-                            .first()
-                        )
+                        db_org = entities.find(session, Organization, organization)
                         if db_org is None:
                             db_org = Organization(organization_name=organization)
                             session.add(db_org)
 
                         if db_org not in sub_record.organizations:
                             sub_record.organizations.append(db_org)
+                            linked_organizations.add(db_org)
 
                     if record_type == "a":
                         for ip in response["values"]:
                             ip_address = ip["ip"]
-                            db_ip = (
-                                session.query(ARecordIP)
-                                .filter_by(ip_address=ip_address)
-                                .first()
-                            )
+                            db_ip = entities.find(session, ARecordIP, ip_address)
                             if db_ip is None:
                                 db_ip = ARecordIP(ip_address=ip_address)
                                 session.add(db_ip)
 
                             if db_ip not in sub_record.ip_addresses:
                                 sub_record.ip_addresses.append(db_ip)
+                                linked_ips.add(db_ip)
                                 dns_stat["a"] += 1
                     elif record_type == "ns":
                         for ns in response["values"]:
                             nameserver = ns["nameserver"]
-                            db_ns = (
-                                session.query(NSRecordNameserver)
-                                .filter_by(nameserver=nameserver)
-                                .first()
+                            db_ns = entities.find(
+                                session, NSRecordNameserver, nameserver
                             )
                             if db_ns is None:
                                 db_ns = NSRecordNameserver(nameserver=nameserver)
@@ -172,8 +193,34 @@ class SecurityTrailsDataFetcher(DataFetcher):
 
                             if db_ns not in sub_record.nameservers:
                                 sub_record.nameservers.append(db_ns)
+                                linked_nameservers.add(db_ns)
                                 dns_stat["ns"] += 1
 
+                for record_type, count in dns_stat.items():
+                    METRICS.count(
+                        "dns_values_added",
+                        count,
+                        fetcher=self.NAME,
+                        record_type=record_type,
+                    )
                 self._logger.info(
                     f"Discovered {dns_stat['a']} new A records and {dns_stat['ns']} NS records for domain {domain_name}"
                 )
+
+            # Keep the derived indexes up to date
+            session.flush()
+            self._database.index_new_domains(session, new_domains)
+            METRICS.count("domains_added", len(new_domains), fetcher=self.NAME)
+            self._database.update_degrees(
+                session, EntityDegree.IP, [ip.ip_id for ip in linked_ips]
+            )
+            self._database.update_degrees(
+                session,
+                EntityDegree.NAMESERVER,
+                [ns.nameserver_id for ns in linked_nameservers],
+            )
+            self._database.update_degrees(
+                session,
+                EntityDegree.ORGANIZATION,
+                [org.organization_id for org in linked_organizations],
+            )
@@ -0,0 +1,286 @@
+"""@package urlautomation.database.lookalike
+This module contains the lookalike domain index and generator.
+The registrable labels of the domains (e.g. "pokerkg" for "game.pokerkg.com")
+are folded into a skeleton (homoglyphs replaced by the character they look
+like) and stored in a BK-tree persisted in the lookalike_labels table. A
+search for all labels within an edit distance of a brand then only visits the
+few branches of the tree that can contain matches, instead of the full table.
+"""
+
+from urlautomation.database.domainnames import registrable_domain
+from urlautomation.database.types import (
+    Domain,
+    LookalikeLabel,
+    lookalike_label_domains,
+)
+
+from sqlalchemy import and_, or_, select, insert
+
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Characters that look alike, mapped to the character they are folded to.
+HOMOGLYPHS = {
+    "0": "o",
+    "1": "l",
+    "i": "l",
+    "3": "e",
+    "5": "s",
+    # Cyrillic and Greek letters that look like latin ones.
+    "а": "a",
+    "е": "e",
+    "о": "o",
+    "р": "p",
+    "с": "c",
+    "у": "y",
+    "х": "x",
+    "і": "l",
+    "ο": "o",
+    "α": "a",
+    "ν": "v",
+}
+# Character sequences that look like a single character.
+MULTI_HOMOGLYPHS = {"rn": "m", "vv": "w", "cl": "d"}
+
+KEYBOARD_ROWS = ["1234567890", "qwertyuiop", "asdfghjkl", "zxcvbnm"]
+
+
+def _keyboard_neighbours() -> Dict[str, str]:
+    neighbours = {}
+    for row_index, row in enumerate(KEYBOARD_ROWS):
+        for column, char in enumerate(row):
+            adjacent = []
+            for other_row in KEYBOARD_ROWS[max(row_index - 1, 0) : row_index + 2]:
+                adjacent.extend(other_row[max(column - 1, 0) : column + 2])
+            neighbours[char] = "".join(c for c in adjacent if c != char)
+    return neighbours
+
+
+KEYBOARD_NEIGHBOURS = _keyboard_neighbours()
+
+
+def registrable_label(domain_name: str) -> Optional[str]:
+    """Returns the label of the registrable domain of a domain name, e.g.
+    "pokerkg" for "game.pokerkg.com" or "example" for "www.example.co.uk".
+    @return The label, or None if the name has no registrable label.
+    """
+    registrable = registrable_domain(domain_name.lower().rstrip("."))
+    if registrable is None:
+        return None
+    return registrable.split(".", 1)[0]
+
+
+def brand_label(name: str) -> str:
+    """Returns the label to search lookalikes of, given either a brand label
+    (e.g. "pokerkg") or a domain name (e.g. "pokerkg.com").
+    """
+    return (registrable_label(name) if "." in name else None) or name.lower()
+
+
+def skeleton(label: str) -> str:
+    """Folds the homoglyphs of a label, so that "p0kerkg" and "pokerkg" have
+    the same skeleton. Punycode (IDNA) labels are decoded first.
+    """
+    label = label.lower()
+    if label.startswith("xn--"):
+        try:
+            label = label.encode("ascii").decode("idna")
+        except UnicodeError:
+            pass
+    for sequence, char in MULTI_HOMOGLYPHS.items():
+        label = label.replace(sequence, char)
+    return "".join(HOMOGLYPHS.get(char, char) for char in label)
+
+
+def levenshtein(first: str, second: str) -> int:
+    """Returns the edit distance (insertions, deletions and substitutions)
+    between two strings.
+    """
+    if len(first) < len(second):
+        first, second = second, first
+    previous = list(range(len(second) + 1))
+    for i, first_char in enumerate(first, 1):
+        current = [i]
+        for j, second_char in enumerate(second, 1):
+            current.append(
+                min(
+                    previous[j] + 1,
+                    current[j - 1] + 1,
+                    previous[j - 1] + (first_char != second_char),
+                )
+            )
+        previous = current
+    return previous[-1]
+
+
+def generate_variants(label: str) -> Iterator[Tuple[str, str]]:
+    """Generates typosquatting variants of a label.
+    @return An iterator of (variant, kind of variant) tuples, without duplicates.
+    """
+    label = label.lower()
+    seen = {label}
+
+    def variants() -> Iterator[Tuple[str, str]]:
+        folded = {}
+        for char, target in {**HOMOGLYPHS, **MULTI_HOMOGLYPHS}.items():
+            folded.setdefault(target, []).append(char)
+        for i, char in enumerate(label):
+            for replacement in folded.get(char, []):
+                yield label[:i] + replacement + label[i + 1 :], "homoglyph"
+        for i, char in enumerate(label):
+            for replacement in KEYBOARD_NEIGHBOURS.get(char, ""):
+                yield label[:i] + replacement + label[i + 1 :], "keyboard"
+        for i in range(len(label)):
+            yield label[:i] + label[i + 1 :], "omission"
+            yield label[:i] + label[i] + label[i:], "repetition"
+        for i in range(len(label) - 1):
+            yield label[:i] + label[i + 1] + label[i] + label[i + 2 :], "transposition"
+
+    for variant, kind in variants():
+        if variant and variant not in seen:
+            seen.add(variant)
+            yield variant, kind
+
+
+def classify(brand: str, label: str) -> str:
+    """Describes how a label differs from a brand label."""
+    brand, label = brand.lower(), label.lower()
+    if brand == label:
+        return "exact"
+    if skeleton(brand) == skeleton(label):
+        return "homoglyph"
+    for variant, kind in generate_variants(brand):
+        if variant == label:
+            return kind
+    return "edit distance"
+
+
+def add_domains(session, domains: Iterable[Domain]) -> None:
+    """Adds the registrable labels of the given domains to the BK-tree.
+    The domains must have been flushed (i.e. have an ID).
+    """
+    for domain in domains:
+        label = registrable_label(domain.domain_name)
+        if not label:
+            continue
+        node = _insert_label(session, skeleton(label))
+        session.execute(
+            insert(lookalike_label_domains)
+            .prefix_with("OR IGNORE")
+            .values(label_id=node.label_id, domain_id=domain.domain_id)
+        )
+
+
+def _insert_label(session, label: str) -> LookalikeLabel:
+    """Returns the node of a label, inserting it in the BK-tree if needed."""
+    node = session.query(LookalikeLabel).filter_by(label=label).first()
+    if node is not None:
+        return node
+
+    parent = (
+        session.query(LookalikeLabel).filter(LookalikeLabel.parent_id.is_(None)).first()
+    )
+    distance = None
+    while parent is not None:
+        distance = levenshtein(label, parent.label)
+        child = (
+            session.query(LookalikeLabel)
+            .filter_by(parent_id=parent.label_id, distance=distance)
+            .first()
+        )
+        if child is None:
+            break
+        parent = child
+
+    node = LookalikeLabel(
+        label=label,
+        parent_id=parent.label_id if parent is not None else None,
+        distance=distance,
+    )
+    session.add(node)
+    session.flush()
+    return node
+
+
+def rebuild(session, batch_size: int = 1000) -> None:
+    """Rebuilds the BK-tree from all the domains in the database."""
+    session.execute(lookalike_label_domains.delete())
+    session.query(LookalikeLabel).delete()
+
+    last_id = 0
+    while True:
+        domains = (
+            session.query(Domain)
+            .filter(Domain.domain_id > last_id)
+            .order_by(Domain.domain_id)
+            .limit(batch_size)
+            .all()
+        )
+        if not domains:
+            break
+        add_domains(session, domains)
+        last_id = domains[-1].domain_id
+        session.expunge_all()
+
+
+def find_lookalikes(
+    session, name: str, max_distance: int = 2
+) -> List[Tuple[str, str, int, str]]:
+    """Finds the stored domains whose registrable label is within an edit
+    distance of the given name, after folding homoglyphs.
+    The BK-tree is searched one level at a time: a node at distance d from the
+    name can only have matches below children at distance d +/- max_distance.
+    @param name A brand label (e.g. "pokerkg") or a domain name.
+    @param max_distance The maximum edit distance between the label skeletons.
+    @return A list of (domain name, label, distance, kind of variant) tuples,
+    sorted by distance.
+    """
+    brand = brand_label(name)
+    target = skeleton(brand)
+
+    matches = {}
+    frontier = session.execute(
+        select(LookalikeLabel.label_id, LookalikeLabel.label).where(
+            LookalikeLabel.parent_id.is_(None)
+        )
+    ).all()
+    while frontier:
+        ranges = []
+        for label_id, label in frontier:
+            distance = levenshtein(target, label)
+            if distance <= max_distance:
+                matches[label_id] = distance
+            ranges.append(
+                and_(
+                    LookalikeLabel.parent_id == label_id,
+                    LookalikeLabel.distance.between(
+                        distance - max_distance, distance + max_distance
+                    ),
+                )
+            )
+        frontier = []
+        for i in range(0, len(ranges), 200):
+            frontier.extend(
+                session.execute(
+                    select(LookalikeLabel.label_id, LookalikeLabel.label).where(
+                        or_(*ranges[i : i + 200])
+                    )
+                ).all()
+            )
+
+    results = []
+    for i in range(0, len(matches), 500):
+        label_ids = list(matches)[i : i + 500]
+        for domain_name, label_id in session.execute(
+            select(Domain.domain_name, lookalike_label_domains.c.label_id)
+            .join(
+                lookalike_label_domains,
+                lookalike_label_domains.c.domain_id == Domain.domain_id,
+            )
+            .where(lookalike_label_domains.c.label_id.in_(label_ids))
+        ):
+            label = registrable_label(domain_name)
+            results.append(
+                (domain_name, label, matches[label_id], classify(brand, label))
+            )
+    results.sort(key=lambda result: (result[2], result[0]))
+    return results
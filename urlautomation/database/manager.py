@@ -4,6 +4,7 @@ This module contains the implementation of the DatabaseManager class.
 
 from urlautomation.database.types import (
     Base,
+    SCHEMA_VERSION,
     Domain,
     Organization,
     DNSRecord,
@@ -11,15 +12,74 @@ from urlautomation.database.types import (
     NSRecordValue,
     NSRecordNameserver,
     ARecordIP,
+    DomainRefresh,
+    EntityDegree,
+    FetchJournal,
+    FetchQueue,
+    SSLCertificate,
+    SSLCertificateIdentity,
+    a_record_ip_association,
+    a_record_organizations,
+    ns_record_nameserver_association,
+    ns_record_organizations,
+    ssl_identity_domains,
+    Case,
+    CaseDomain,
+)
+from urlautomation.database.entitycache import EntityCache
+from urlautomation.database.fetchers import ALL_DATAFETCHERS, load_datafetcher
+from urlautomation.database import lookalike
+from urlautomation.database.sqlmonitor import SQLMonitor
+from urlautomation.metrics import METRICS
+from urlautomation.database.textindex import (
+    create_text_index,
+    has_text_index,
+    rebuild_text_index,
+    search_names,
 )
-from urlautomation.database.fetchers import ALL_DATAFETCHERS
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, Session, aliased
+from sqlalchemy import (
+    String,
+    case,
+    cast,
+    create_engine,
+    exists,
+    and_,
+    or_,
+    delete,
+    distinct,
+    event,
+    func,
+    insert,
+    literal,
+    select,
+    text,
+    true,
+    union,
+    union_all,
+    update,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import sessionmaker, Session, aliased, joinedload, selectinload
 
-from typing import List, Tuple, Union, Optional
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+    Optional,
+)
 
+import json
+import logging
+import math
 import os.path
+import time
 
 
 class DatabaseManager:
@@ -29,36 +89,249 @@ class DatabaseManager:
     with the idea that it can be easily modified to support other engines.
     """
 
-    def __init__(self, db_path: str) -> None:
+    # The fields of each kind of record produced by iter_case_report().
+    # Node records are identified by their "id", edge records link the "id"
+    # of their "source" and "target" nodes.
+    CASE_REPORT_FIELDS = {
+        "domain": ["id", "domain", "in_case"],
+        "ip": ["id", "ip_address", "degree"],
+        "nameserver": ["id", "nameserver", "degree"],
+        "certificate": [
+            "id",
+            "certificate_id",
+            "issuer",
+            "serial_number",
+            "not_before",
+            "not_after",
+        ],
+        "a_record": ["source", "target", "first_seen", "last_seen"],
+        "ns_record": ["source", "target", "first_seen", "last_seen"],
+        "identity": ["source", "target", "identity"],
+        "relationship": ["source", "target", "relationship", "via"],
+    }
+
+    # Prior of the change rate of a domain that has not been fetched often yet:
+    # one change (new certificate or DNS record) every 30 days.
+    STALENESS_PRIOR_CHANGES = 1
+    STALENESS_PRIOR_DAYS = 30
+
+    # Finds the domains one hop away from a frontier of domains (:frontier, a
+    # JSON array of IDs) through shared IP addresses and nameservers, except
+    # the domains already visited (:visited, a JSON array of IDs). IP
+    # addresses and nameservers with a degree above :max_degree are skipped,
+    # and at most :fanout domains are followed through each of them: the first
+    # ones by ID other than the frontier domain, found among the first
+    # :fanout + 1 domains of the entity. Each domain found is returned once,
+    # with one of the links (frontier domain and shared entity) it was found
+    # through.
+    PIVOT_HOP_QUERY = """
+        WITH
+        frontier(domain_id) AS (SELECT value FROM json_each(:frontier)),
+        ip_domains(entity_id, domain_id) AS NOT MATERIALIZED (
+            SELECT aia.ip_id, dr.domain_id
+            FROM a_record_ip_association aia
+            JOIN a_record_values av ON av.a_record_value_id = aia.a_record_value_id
+            JOIN dns_records dr ON dr.record_id = av.dns_record_id
+            LEFT JOIN entity_degrees ed
+                ON ed.entity_type = 'ip' AND ed.entity_id = aia.ip_id
+            WHERE :max_degree IS NULL OR ed.degree IS NULL OR ed.degree <= :max_degree
+        ),
+        nameserver_domains(entity_id, domain_id) AS NOT MATERIALIZED (
+            SELECT nna.nameserver_id, dr.domain_id
+            FROM ns_record_nameserver_association nna
+            JOIN ns_record_values nv ON nv.ns_record_value_id = nna.ns_record_value_id
+            JOIN dns_records dr ON dr.record_id = nv.dns_record_id
+            LEFT JOIN entity_degrees ed
+                ON ed.entity_type = 'nameserver' AND ed.entity_id = nna.nameserver_id
+            WHERE :max_degree IS NULL OR ed.degree IS NULL OR ed.degree <= :max_degree
+        ),
+        parents(kind, entity_id, parent_id) AS MATERIALIZED (
+            SELECT 'ip', entity_id, domain_id FROM ip_domains
+            WHERE domain_id IN (SELECT domain_id FROM frontier)
+            UNION
+            SELECT 'nameserver', entity_id, domain_id FROM nameserver_domains
+            WHERE domain_id IN (SELECT domain_id FROM frontier)
+        ),
+        members(kind, entity_id, domain_id) AS (
+            SELECT 'ip', entity_id, domain_id FROM ip_domains
+            WHERE entity_id IN (SELECT entity_id FROM parents WHERE kind = 'ip')
+            UNION
+            SELECT 'nameserver', entity_id, domain_id FROM nameserver_domains
+            WHERE entity_id IN (
+                SELECT entity_id FROM parents WHERE kind = 'nameserver'
+            )
+        ),
+        ranked_members AS MATERIALIZED (
+            SELECT kind, entity_id, domain_id,
+                ROW_NUMBER() OVER (
+                    PARTITION BY kind, entity_id ORDER BY domain_id
+                ) AS member_rank
+            FROM members
+        ),
+        links AS (
+            SELECT ranked_members.domain_id, parents.parent_id, parents.kind,
+                parents.entity_id,
+                ROW_NUMBER() OVER (
+                    PARTITION BY parents.kind, parents.entity_id, parents.parent_id
+                    ORDER BY ranked_members.domain_id
+                ) AS fanout_rank
+            FROM parents
+            JOIN ranked_members
+                ON ranked_members.kind = parents.kind
+                AND ranked_members.entity_id = parents.entity_id
+            WHERE ranked_members.member_rank <= :fanout + 1
+                AND ranked_members.domain_id != parents.parent_id
+        ),
+        ranked_links AS (
+            SELECT domain_id, parent_id, kind, entity_id,
+                ROW_NUMBER() OVER (
+                    PARTITION BY domain_id ORDER BY parent_id, kind, entity_id
+                ) AS link_rank
+            FROM links
+            WHERE fanout_rank <= :fanout
+                AND domain_id NOT IN (SELECT value FROM json_each(:visited))
+        )
+        SELECT ranked_links.domain_id, domains.domain_name,
+            ranked_links.parent_id, ranked_links.kind,
+            CASE ranked_links.kind
+                WHEN 'ip' THEN (
+                    SELECT ip_address FROM a_record_ips
+                    WHERE a_record_ips.ip_id = ranked_links.entity_id
+                )
+                WHEN 'nameserver' THEN (
+                    SELECT nameserver FROM ns_record_nameservers
+                    WHERE ns_record_nameservers.nameserver_id = ranked_links.entity_id
+                )
+            END AS entity
+        FROM ranked_links
+        JOIN domains ON domains.domain_id = ranked_links.domain_id
+        WHERE ranked_links.link_rank = 1
+        ORDER BY domains.domain_name
+    """
+
+    def __init__(
+        self,
+        db_path: str,
+        slow_query_ms: Optional[float] = None,
+        entity_cache_size: int = 100000,
+        ingest_chunk_size: int = 5000,
+    ) -> None:
         """Initializes the DatabaseManager with a database connection.
         @param db_path The path to the database file.
+        @param slow_query_ms Log the SQL statements slower than this many
+        milliseconds with their query plan, or None.
+        @param entity_cache_size The maximum number of natural keys (domain
+        names, certificates, IP addresses...) in the entity cache.
+        @param ingest_chunk_size The number of records ingested between two
+        commits, see ingest_data().
         """
         self._engine = create_engine(f"sqlite:///{db_path}", echo=False)
         self._Session = sessionmaker(bind=self._engine)
-        self._session: Session = None
-        self._datafetchers = {
-            name: fetcher_cls(self) for name, fetcher_cls in ALL_DATAFETCHERS.items()
-        }
-        Base.metadata.create_all(self._engine)
+        self._instrument(slow_query_ms)
+        self._cache_entities(entity_cache_size)
+        # The sessions of the units of work in progress, innermost last.
+        self._sessions: List[Session] = []
+        self._ingest_chunk_size = ingest_chunk_size
+        self._logger = logging.getLogger(__name__)
+        self._datafetchers = {}
+        with self._engine.begin() as connection:
+            version = connection.exec_driver_sql("PRAGMA user_version").scalar()
+            if version == SCHEMA_VERSION:
+                # The schema is up to date, skip the reflection queries.
+                self._text_index = has_text_index(connection)
+            else:
+                self._create_schema(connection)
+
+    def _instrument(self, slow_query_ms: Optional[float]) -> None:
+        """Records the duration of the SQL statements (by operation) and of the
+        commits, and the number of rows written, in the process metrics.
+        @param slow_query_ms Log the statements slower than this many
+        milliseconds with their query plan, or None.
+        """
+        self.sql_monitor = SQLMonitor(self._engine, slow_query_ms)
+
+        @event.listens_for(self._Session, "before_commit")
+        def before_commit(session):
+            session.info["commit_start"] = time.perf_counter()
+
+        @event.listens_for(self._Session, "after_commit")
+        def after_commit(session):
+            start = session.info.pop("commit_start", None)
+            if start is not None:
+                METRICS.observe("db_commit", time.perf_counter() - start)
+
+    def _cache_entities(self, max_size: int) -> None:
+        """Creates the entity cache shared by the data fetchers. The entities
+        inserted by the sessions are cached when flushed, and every rollback
+        (of a transaction or of a savepoint) invalidates the cache, as the
+        rows it inserted no longer exist. So do the commits of other processes,
+        checked at the start of each unit of work.
+        @param max_size The maximum number of cached keys.
+        """
+        self.entities = EntityCache(max_size)
 
-    def _get_session(self) -> Session:
-        """Returns the current session.
-        @return The current session.
+        @event.listens_for(self._Session, "after_begin")
+        def after_begin(session, transaction, connection):
+            self.entities.check_data_version(connection)
+
+        @event.listens_for(self._engine, "commit")
+        def commit(connection):
+            self.entities.after_commit(connection)
+
+        @event.listens_for(self._Session, "after_flush")
+        def after_flush(session, flush_context):
+            self.entities.after_flush(session)
+
+        @event.listens_for(self._Session, "after_soft_rollback")
+        def after_soft_rollback(session, previous_transaction):
+            self.entities.invalidate()
+
+    def _create_schema(self, connection) -> None:
+        """Creates the missing tables, indexes and text index, then stores the
+        schema version so that this is skipped on the next start.
+        @param connection The connection to create the schema with.
         """
-        if self._session is None:
-            self._session = self._Session()
-        return self._session
+        Base.metadata.create_all(connection)
+        # create_all() only creates the indexes of the tables it creates, make
+        # sure indexes added to existing tables are created as well.
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(connection, checkfirst=True)
+        self._text_index = create_text_index(connection)
+        connection.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def new_session(self) -> Session:
+        """Returns a new session, independent from the current one, e.g. for
+        another thread. The caller commits and closes it.
+        """
+        return self._Session()
 
     def __enter__(self) -> Session:
-        self._session = self._get_session()
-        return self._session
+        """Starts a unit of work, in a new session that is committed (or
+        rolled back on error) and closed when it ends, so that no entity
+        outlives it.
+        """
+        session = self._Session()
+        self._sessions.append(session)
+        return session
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
-        if exc_type:
-            self._session.rollback()
-        else:
-            self._session.commit()
-        self._session.close()
+        session = self._sessions.pop()
+        try:
+            if exc_type:
+                session.rollback()
+            else:
+                session.commit()
+        finally:
+            session.close()
+
+    def _datafetcher(self, fetcher: str) -> Any:
+        """Returns the data fetcher of the given name, loading it if needed."""
+        if fetcher not in ALL_DATAFETCHERS:
+            raise ValueError(f"Fetcher {fetcher} not found.")
+        if fetcher not in self._datafetchers:
+            self._datafetchers[fetcher] = load_datafetcher(fetcher)(self)
+        return self._datafetchers[fetcher]
 
     def fetch_data(
         self, fetcher: str, domains: Union[str, List[str]], **kwargs
@@ -67,12 +340,1179 @@ class DatabaseManager:
         @param fetcher The name of the fetcher to use.
         @param domains The domains to fetch data for.
         """
-        if fetcher not in self._datafetchers:
-            raise ValueError(f"Fetcher {fetcher} not found.")
-        self._datafetchers[fetcher].fetch_data(domains, **kwargs)
+        self._datafetcher(fetcher).fetch_data(domains, **kwargs)
+
+    def collect_data(
+        self, fetcher: str, domains: Union[str, List[str]], **kwargs
+    ) -> Any:
+        """Requests and parses data with the specified fetcher, without writing
+        it to the database, see DataFetcher.collect().
+        @return The batch of records to pass to ingest_data().
+        """
+        return self._datafetcher(fetcher).collect(domains, **kwargs)
+
+    def ingest_data(self, fetcher: str, batch: Any) -> None:
+        """Writes a batch returned by collect_data() to the database, a chunk
+        of about ingest_chunk_size records at a time (see DataFetcher.split()).
+        Each chunk is written in its own unit of work, committed and closed
+        once written, so that the memory used stays bounded however long the
+        ingest. If a chunk fails, the chunks committed before it are kept:
+        ingesting is idempotent, so fetching again completes them.
+        SQLite allows a single writer: the caller must not be in a unit of
+        work that has used the database yet.
+        """
+        datafetcher = self._datafetcher(fetcher)
+        for chunk in datafetcher.split(batch, self._ingest_chunk_size):
+            with self as session:
+                datafetcher.ingest(session, chunk)
+            METRICS.count("ingest_chunk_commits")
+
+    def ingest_batches(self, domain_name: str, batches: Dict[str, Any]) -> List[str]:
+        """Writes the batches collected for a domain (see ingest_data()), so
+        that a failing batch does not roll back the others.
+        @param domain_name The fetched domain.
+        @param batches The batch collected by each fetcher that succeeded.
+        @return The fetchers whose batch failed to be written.
+        """
+        failed = []
+        for fetcher, batch in batches.items():
+            try:
+                self.ingest_data(fetcher, batch)
+            except Exception as e:
+                self._logger.exception(
+                    f"Failed to ingest {fetcher} data for domain {domain_name}: {e}"
+                )
+                failed.append(fetcher)
+        return failed
+
+    def fetch_domain(
+        self,
+        job_name: str,
+        domain_name: str,
+        fetcher_arguments: Dict[str, dict],
+        search_names: Optional[Dict[str, str]] = None,
+        covered: Optional[Dict[str, str]] = None,
+    ) -> Optional[bool]:
+        """Fetches a domain with every data fetcher the job has not completed
+        it with yet, recording the outcome in the fetch journal, and whether
+        the fetch found new certificates or DNS records in DomainRefresh.
+        @param job_name The name of the fetch job.
+        @param domain_name The domain to fetch.
+        @param fetcher_arguments The keyword arguments of each fetcher, by name.
+        @param search_names The name each fetcher searches instead of the
+        domain, if any (see FetchPlanner).
+        @param covered The fetchers whose data about the domain was fetched
+        along with another domain, with that domain (see FetchPlanner). They
+        are journaled with the outcome of the other domain's fetch.
+        @return None if the job had already completed the domain, otherwise
+        whether every fetcher succeeded.
+        """
+        with self as session:
+            fetchers = self.start_fetch(
+                session, job_name, domain_name, list(ALL_DATAFETCHERS)
+            )
+            before = self._domain_fingerprint(session, domain_name)
+        if not fetchers:
+            return None
+
+        search_names, covered = search_names or {}, covered or {}
+        batches, failed = {}, []
+        for fetcher in fetchers:
+            if fetcher in covered:
+                continue
+            try:
+                batches[fetcher] = self.collect_data(
+                    fetcher,
+                    search_names.get(fetcher, domain_name),
+                    **fetcher_arguments[fetcher],
+                )
+            except Exception as e:
+                self._logger.exception(
+                    f"Failed to fetch {fetcher} data for domain {domain_name}: {e}"
+                )
+                failed.append(fetcher)
+
+        failed += self.ingest_batches(domain_name, batches)
+        with self as session:
+            return self.journal_fetched(
+                session,
+                job_name,
+                domain_name,
+                [fetcher for fetcher in batches if fetcher not in failed],
+                failed,
+                before,
+                {
+                    fetcher: leader
+                    for fetcher, leader in covered.items()
+                    if fetcher in fetchers
+                },
+            )
+
+    def journal_fetched(
+        self,
+        session,
+        job_name: str,
+        domain_name: str,
+        done: List[str],
+        failed: List[str],
+        before: Optional[Tuple[int, ...]],
+        covered: Optional[Dict[str, str]] = None,
+    ) -> bool:
+        """Records the outcome of each fetcher of a domain fetched by a job in
+        the fetch journal, once its batches are written (see ingest_batches()).
+        @param job_name The name of the fetch job.
+        @param domain_name The fetched domain.
+        @param done The fetchers whose batch was written.
+        @param failed The fetchers that failed to collect the domain, or whose
+        batch failed to be written.
+        @param before The fingerprint of the domain before the fetch.
+        @param covered The fetchers whose data was fetched along with another
+        domain of the job, with that domain. They are journaled with the
+        outcome of the other domain's fetch, or left pending if it is not
+        finished yet (see copy_fetch_status()).
+        @return Whether every fetcher succeeded.
+        """
+        succeeded = not failed
+        for fetcher, leader in (covered or {}).items():
+            status = self.copy_fetch_status(
+                session, job_name, leader, fetcher, [domain_name]
+            )
+            if status == FetchJournal.FAILED:
+                succeeded = False
+        for fetcher in failed:
+            self.finish_fetch(
+                session, job_name, domain_name, fetcher, FetchJournal.FAILED
+            )
+        for fetcher in done:
+            self.finish_fetch(
+                session, job_name, domain_name, fetcher, FetchJournal.DONE
+            )
+
+        if succeeded:
+            self._record_refresh(session, domain_name, before)
+        return succeeded
+
+    @staticmethod
+    def _domain_fingerprint(session, domain_name: str) -> Optional[Tuple[int, ...]]:
+        """Returns the number of certificates, A record values and NS record
+        values of a domain, used to detect whether a fetch found anything new.
+        @return The counts, or None if the domain does not exist.
+        """
+        domain_id = (
+            select(Domain.domain_id)
+            .where(Domain.domain_name == domain_name)
+            .scalar_subquery()
+        )
+        certificates = (
+            select(func.count(distinct(SSLCertificateIdentity.certificate_id)))
+            .join(
+                ssl_identity_domains,
+                ssl_identity_domains.c.identity_id
+                == SSLCertificateIdentity.identity_id,
+            )
+            .where(ssl_identity_domains.c.domain_id == domain_id)
+            .scalar_subquery()
+        )
+        a_values, ns_values = (
+            select(func.count())
+            .select_from(record_cls)
+            .join(DNSRecord, DNSRecord.record_id == record_cls.dns_record_id)
+            .where(DNSRecord.domain_id == domain_id)
+            .scalar_subquery()
+            for record_cls in (ARecordValue, NSRecordValue)
+        )
+        row = session.execute(
+            select(domain_id, certificates, a_values, ns_values)
+        ).one()
+        return None if row[0] is None else tuple(row[1:])
+
+    @staticmethod
+    def _record_refresh(session, domain_name: str, before) -> None:
+        """Updates the fetch statistics of a domain after a successful fetch.
+        @param before The fingerprint of the domain before the fetch.
+        """
+        after = DatabaseManager._domain_fingerprint(session, domain_name)
+        if after is None:
+            return
+        domain_id = session.execute(
+            select(Domain.domain_id).where(Domain.domain_name == domain_name)
+        ).scalar()
+        now = datetime.now()
+        refresh = session.get(DomainRefresh, domain_id)
+        if refresh is None:
+            refresh = DomainRefresh(
+                domain_id=domain_id, first_fetched=now, fetch_count=0, change_count=0
+            )
+            session.add(refresh)
+        refresh.last_fetched = now
+        refresh.fetch_count += 1
+        # The first fetch of a domain always finds something, it is not a change.
+        if before is not None and after != before:
+            refresh.change_count += 1
 
     @staticmethod
-    def _find_ip_associations(session, domain: Domain) -> List[Tuple[str, str, str]]:
+    def _staleness(
+        now: datetime,
+        first_fetched: Optional[datetime],
+        last_fetched: Optional[datetime],
+        change_count: int,
+        open_cases: int,
+    ) -> float:
+        """Scores how likely a domain is to have changed since it was last
+        fetched, weighted by the number of open cases it is in.
+        Changes are modelled as a Poisson process whose rate is estimated from
+        the changes found by past fetches, so the probability of at least one
+        change grows with the time since the last fetch, faster for domains
+        that change often.
+        """
+        if last_fetched is None:
+            probability = 1.0
+        else:
+            observed_days = (last_fetched - first_fetched).total_seconds() / 86400
+            rate = (change_count + DatabaseManager.STALENESS_PRIOR_CHANGES) / (
+                observed_days + DatabaseManager.STALENESS_PRIOR_DAYS
+            )
+            age_days = max((now - last_fetched).total_seconds(), 0) / 86400
+            probability = 1 - math.exp(-rate * age_days)
+        return probability * (1 + math.log1p(open_cases))
+
+    @staticmethod
+    def score_staleness(session, include_all: bool = False) -> List[Tuple[str, float]]:
+        """Computes and stores the staleness score of the domains to refresh.
+        Cases are open while they have no closing date and their status is not
+        "closed".
+        @param include_all Also score the domains that are in no open case.
+        @return A list of (domain name, score) tuples, stalest first.
+        """
+        now = datetime.now()
+        open_cases = (
+            select(CaseDomain.domain_id, func.count().label("open_cases"))
+            .join(Case, Case.case_id == CaseDomain.case_id)
+            .where(
+                Case.date_closed.is_(None),
+                or_(
+                    Case.case_status.is_(None),
+                    func.lower(Case.case_status) != "closed",
+                ),
+            )
+            .group_by(CaseDomain.domain_id)
+            .subquery()
+        )
+        query = (
+            select(
+                Domain.domain_id,
+                Domain.domain_name,
+                func.coalesce(open_cases.c.open_cases, 0),
+                DomainRefresh.first_fetched,
+                DomainRefresh.last_fetched,
+                func.coalesce(DomainRefresh.change_count, 0),
+            )
+            .outerjoin(open_cases, open_cases.c.domain_id == Domain.domain_id)
+            .outerjoin(DomainRefresh, DomainRefresh.domain_id == Domain.domain_id)
+        )
+        if not include_all:
+            query = query.where(open_cases.c.open_cases.is_not(None))
+
+        scores = []
+        for domain_id, domain_name, cases, first, last, changes in session.execute(
+            query
+        ):
+            score = DatabaseManager._staleness(now, first, last, changes, cases)
+            scores.append((domain_id, domain_name, score))
+
+        upsert = sqlite_insert(DomainRefresh)
+        upsert = upsert.on_conflict_do_update(
+            index_elements=[DomainRefresh.domain_id],
+            set_={
+                "staleness": upsert.excluded.staleness,
+                "scored_at": upsert.excluded.scored_at,
+            },
+        )
+        for i in range(0, len(scores), 500):
+            session.execute(
+                upsert,
+                [
+                    {
+                        "domain_id": domain_id,
+                        "fetch_count": 0,
+                        "change_count": 0,
+                        "staleness": score,
+                        "scored_at": now,
+                    }
+                    for domain_id, _, score in scores[i : i + 500]
+                ],
+            )
+
+        scores.sort(key=lambda score: (-score[2], score[1]))
+        return [(domain_name, score) for _, domain_name, score in scores]
+
+    @staticmethod
+    def last_fetch_job(session) -> Optional[str]:
+        """Returns the name of the most recently updated fetch job, or None."""
+        return session.execute(
+            select(FetchJournal.job_name)
+            .order_by(FetchJournal.updated_at.desc())
+            .limit(1)
+        ).scalar()
+
+    @staticmethod
+    def start_fetch(
+        session, job_name: str, domain_name: str, providers: List[str]
+    ) -> List[str]:
+        """Records that a domain is being fetched by a job.
+        @param job_name The name of the fetch job.
+        @param domain_name The domain to fetch.
+        @param providers The providers (fetchers) to fetch the domain with.
+        @return The providers that have not completed the domain yet, in order.
+        """
+        done = set(
+            session.execute(
+                select(FetchJournal.provider).where(
+                    FetchJournal.job_name == job_name,
+                    FetchJournal.domain_name == domain_name,
+                    FetchJournal.status == FetchJournal.DONE,
+                )
+            ).scalars()
+        )
+        pending = [provider for provider in providers if provider not in done]
+        now = datetime.now()
+        for provider in pending:
+            session.execute(
+                insert(FetchJournal)
+                .prefix_with("OR IGNORE")
+                .values(
+                    job_name=job_name,
+                    domain_name=domain_name,
+                    provider=provider,
+                    status=FetchJournal.PENDING,
+                    attempts=0,
+                    updated_at=now,
+                )
+            )
+        return pending
+
+    @staticmethod
+    def copy_fetch_status(
+        session,
+        job_name: str,
+        leader: str,
+        provider: str,
+        domain_names: List[str],
+    ) -> Optional[str]:
+        """Records the outcome of fetching a domain with a provider as the
+        outcome for the domains its fetch covered (see FetchPlanner), so that
+        they are fetched again with it if it failed.
+        @param leader The domain whose fetch covered the others.
+        @param domain_names The covered domains.
+        @return The status copied, or None if the leader's fetch is not
+        finished yet, the covered domains being left pending.
+        """
+        status = session.execute(
+            select(FetchJournal.status).where(
+                FetchJournal.job_name == job_name,
+                FetchJournal.domain_name == leader,
+                FetchJournal.provider == provider,
+            )
+        ).scalar()
+        if status not in (FetchJournal.DONE, FetchJournal.FAILED):
+            return None
+        for domain_name in domain_names:
+            DatabaseManager.finish_fetch(
+                session, job_name, domain_name, provider, status
+            )
+        return status
+
+    @staticmethod
+    def finish_fetch(
+        session, job_name: str, domain_name: str, provider: str, status: str
+    ) -> None:
+        """Records the outcome of fetching a domain with a provider.
+        @param status FetchJournal.DONE or FetchJournal.FAILED.
+        """
+        session.query(FetchJournal).filter_by(
+            job_name=job_name, domain_name=domain_name, provider=provider
+        ).update(
+            {
+                FetchJournal.status: status,
+                FetchJournal.attempts: FetchJournal.attempts + 1,
+                FetchJournal.updated_at: datetime.now(),
+            }
+        )
+
+    @staticmethod
+    def unfinished_fetches(session, job_name: str) -> List[str]:
+        """Returns the domains of a fetch job that are pending or failed for at
+        least one provider, in the order they were first journaled.
+        """
+        return list(
+            session.execute(
+                select(FetchJournal.domain_name)
+                .where(
+                    FetchJournal.job_name == job_name,
+                    FetchJournal.status != FetchJournal.DONE,
+                )
+                .group_by(FetchJournal.domain_name)
+                .order_by(func.min(text("fetch_journal.rowid")))
+            ).scalars()
+        )
+
+    @staticmethod
+    def enqueue_fetches(session, job_name: str, domain_names: Iterable[str]) -> int:
+        """Adds domains to the shared fetch queue of a job. Domains already in
+        the queue of the job are left as they are.
+        @return The number of domains added.
+        """
+        now = datetime.now()
+        added = 0
+        for domain_name in domain_names:
+            added += session.execute(
+                insert(FetchQueue)
+                .prefix_with("OR IGNORE")
+                .values(
+                    job_name=job_name,
+                    domain_name=domain_name,
+                    status=FetchQueue.QUEUED,
+                    attempts=0,
+                    updated_at=now,
+                )
+            ).rowcount
+        return added
+
+    @staticmethod
+    def claim_fetches(
+        session,
+        job_name: str,
+        worker: str,
+        count: int,
+        lease_seconds: float,
+        max_attempts: int = 3,
+    ) -> List[str]:
+        """Leases queued domains of a job to a worker. Domains whose lease
+        expired (i.e. whose worker died) are claimed again, up to max_attempts
+        times, after which they are marked as failed.
+        The domains are selected and leased by a single UPDATE statement, so
+        that concurrent workers never claim the same domain.
+        @param worker The unique name of the worker.
+        @param count The maximum number of domains to claim.
+        @param lease_seconds The duration of the lease.
+        @return The claimed domains, in the order they were queued.
+        """
+        now = datetime.now()
+        expired = and_(
+            FetchQueue.status == FetchQueue.LEASED, FetchQueue.lease_expires < now
+        )
+        session.execute(
+            update(FetchQueue)
+            .where(
+                FetchQueue.job_name == job_name,
+                expired,
+                FetchQueue.attempts >= max_attempts,
+            )
+            .values(status=FetchQueue.FAILED, lease_owner=None, updated_at=now)
+        )
+        claimable = (
+            select(FetchQueue.domain_name)
+            .where(
+                FetchQueue.job_name == job_name,
+                or_(FetchQueue.status == FetchQueue.QUEUED, expired),
+            )
+            .order_by(text("fetch_queue.rowid"))
+            .limit(count)
+        )
+        claimed = session.execute(
+            update(FetchQueue)
+            .where(
+                FetchQueue.job_name == job_name,
+                FetchQueue.domain_name.in_(claimable.scalar_subquery()),
+            )
+            .values(
+                status=FetchQueue.LEASED,
+                lease_owner=worker,
+                lease_expires=now + timedelta(seconds=lease_seconds),
+                attempts=FetchQueue.attempts + 1,
+                updated_at=now,
+            )
+            .returning(FetchQueue.domain_name, text("fetch_queue.rowid"))
+        ).all()
+        return [domain_name for domain_name, _ in sorted(claimed, key=lambda r: r[1])]
+
+    @staticmethod
+    def renew_leases(session, job_name: str, worker: str, lease_seconds: float) -> int:
+        """Extends the leases held by a worker (its heartbeat).
+        @return The number of leases renewed.
+        """
+        now = datetime.now()
+        return session.execute(
+            update(FetchQueue)
+            .where(
+                FetchQueue.job_name == job_name,
+                FetchQueue.lease_owner == worker,
+                FetchQueue.status == FetchQueue.LEASED,
+            )
+            .values(lease_expires=now + timedelta(seconds=lease_seconds))
+        ).rowcount
+
+    @staticmethod
+    def release_fetch(
+        session, job_name: str, domain_name: str, worker: str, status: str
+    ) -> bool:
+        """Records the outcome of a leased domain.
+        @param status FetchQueue.DONE, FetchQueue.FAILED, or FetchQueue.QUEUED
+        to give the domain back to the queue.
+        @return False if the worker no longer held the lease (it expired and
+        another worker claimed the domain).
+        """
+        return (
+            session.execute(
+                update(FetchQueue)
+                .where(
+                    FetchQueue.job_name == job_name,
+                    FetchQueue.domain_name == domain_name,
+                    FetchQueue.lease_owner == worker,
+                    FetchQueue.status == FetchQueue.LEASED,
+                )
+                .values(
+                    status=status,
+                    lease_owner=None,
+                    lease_expires=None,
+                    updated_at=datetime.now(),
+                )
+            ).rowcount
+            == 1
+        )
+
+    @staticmethod
+    def release_leases(session, job_name: str, worker: str) -> int:
+        """Gives the domains leased by a worker back to the queue, e.g. when
+        the worker stops.
+        @return The number of domains given back.
+        """
+        return session.execute(
+            update(FetchQueue)
+            .where(
+                FetchQueue.job_name == job_name,
+                FetchQueue.lease_owner == worker,
+                FetchQueue.status == FetchQueue.LEASED,
+            )
+            .values(
+                status=FetchQueue.QUEUED,
+                lease_owner=None,
+                lease_expires=None,
+                attempts=FetchQueue.attempts - 1,
+                updated_at=datetime.now(),
+            )
+        ).rowcount
+
+    @staticmethod
+    def queue_status(session, job_name: str) -> Dict[str, int]:
+        """Returns the number of domains of a job by status, along with the
+        number of leases that expired.
+        """
+        counts = {
+            status: 0
+            for status in (
+                FetchQueue.QUEUED,
+                FetchQueue.LEASED,
+                FetchQueue.DONE,
+                FetchQueue.FAILED,
+            )
+        }
+        counts.update(
+            session.execute(
+                select(FetchQueue.status, func.count())
+                .where(FetchQueue.job_name == job_name)
+                .group_by(FetchQueue.status)
+            )
+            .tuples()
+            .all()
+        )
+        counts["expired"] = session.execute(
+            select(func.count()).where(
+                FetchQueue.job_name == job_name,
+                FetchQueue.status == FetchQueue.LEASED,
+                FetchQueue.lease_expires < datetime.now(),
+            )
+        ).scalar()
+        return counts
+
+    @staticmethod
+    def _earliest(first, second):
+        """Returns a SQL expression for the earliest of two nullable times."""
+        return case(
+            (first.is_(None), second),
+            (second.is_(None), first),
+            (first < second, first),
+            else_=second,
+        )
+
+    @staticmethod
+    def _domain_first_seen():
+        """Returns a SQL expression for the first time a domain was observed,
+        either in its DNS history or as the start of a certificate's validity.
+        """
+        a_first_seen = (
+            select(func.min(ARecordValue.first_seen))
+            .join(DNSRecord, DNSRecord.record_id == ARecordValue.dns_record_id)
+            .where(DNSRecord.domain_id == Domain.domain_id)
+            .correlate(Domain)
+            .scalar_subquery()
+        )
+        ns_first_seen = (
+            select(func.min(NSRecordValue.first_seen))
+            .join(DNSRecord, DNSRecord.record_id == NSRecordValue.dns_record_id)
+            .where(DNSRecord.domain_id == Domain.domain_id)
+            .correlate(Domain)
+            .scalar_subquery()
+        )
+        cert_first_seen = (
+            select(func.min(SSLCertificate.not_before))
+            .select_from(ssl_identity_domains)
+            .join(
+                SSLCertificateIdentity,
+                SSLCertificateIdentity.identity_id
+                == ssl_identity_domains.c.identity_id,
+            )
+            .join(
+                SSLCertificate,
+                SSLCertificate.certificate_id == SSLCertificateIdentity.certificate_id,
+            )
+            .where(ssl_identity_domains.c.domain_id == Domain.domain_id)
+            .correlate(Domain)
+            .scalar_subquery()
+        )
+        return DatabaseManager._earliest(
+            DatabaseManager._earliest(a_first_seen, ns_first_seen), cert_first_seen
+        )
+
+    @staticmethod
+    def iter_domains(
+        session,
+        after: Optional[str] = None,
+        limit: Optional[int] = None,
+        case_name: Optional[str] = None,
+        first_seen_after: Optional[datetime] = None,
+        first_seen_before: Optional[datetime] = None,
+        has_certs: Optional[bool] = None,
+        has_dns: Optional[bool] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Tuple[int, str]]:
+        """Streams the domains in the database, ordered by name.
+        Rows are fetched in batches using keyset pagination on the domain name,
+        so memory use is constant regardless of the size of the database.
+        @param after Only return domains sorted after this name (a cursor).
+        @param limit The maximum number of domains to return, or None.
+        @param case_name Only return domains in this case.
+        @param first_seen_after Only return domains first seen at or after this time.
+        @param first_seen_before Only return domains first seen before this time.
+        @param has_certs If set, only return domains with (or without) certificates.
+        @param has_dns If set, only return domains with (or without) DNS records.
+        @param batch_size The number of rows fetched per query.
+        @return An iterator of (domain ID, domain name) tuples.
+        """
+        query = select(Domain.domain_id, Domain.domain_name).order_by(
+            Domain.domain_name
+        )
+        if case_name is not None:
+            query = query.where(
+                exists()
+                .where(CaseDomain.domain_id == Domain.domain_id)
+                .where(CaseDomain.case_id == Case.case_id)
+                .where(Case.case_name == case_name)
+            )
+        if first_seen_after is not None or first_seen_before is not None:
+            first_seen = DatabaseManager._domain_first_seen()
+            if first_seen_after is not None:
+                query = query.where(first_seen >= first_seen_after)
+            if first_seen_before is not None:
+                query = query.where(first_seen < first_seen_before)
+        if has_certs is not None:
+            certs = exists().where(ssl_identity_domains.c.domain_id == Domain.domain_id)
+            query = query.where(certs if has_certs else ~certs)
+        if has_dns is not None:
+            dns = exists().where(DNSRecord.domain_id == Domain.domain_id)
+            query = query.where(dns if has_dns else ~dns)
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            batch_query = query
+            if after is not None:
+                batch_query = batch_query.where(Domain.domain_name > after)
+            count = batch_size if remaining is None else min(batch_size, remaining)
+            rows = session.execute(batch_query.limit(count)).all()
+            for row in rows:
+                yield row.domain_id, row.domain_name
+            if len(rows) < count:
+                return
+            after = rows[-1].domain_name
+            if remaining is not None:
+                remaining -= len(rows)
+
+    @staticmethod
+    def index_new_domains(session, domains: Iterable[Domain]) -> None:
+        """Adds newly created domains to the derived indexes that are not
+        maintained by the database itself (i.e. the lookalike BK-tree).
+        The domains must have been flushed.
+        """
+        lookalike.add_domains(session, domains)
+
+    @staticmethod
+    def rebuild_lookalikes(session) -> None:
+        """Rebuilds the lookalike BK-tree from all the domains."""
+        lookalike.rebuild(session)
+
+    @staticmethod
+    def find_lookalikes(
+        session, name: str, max_distance: int = 2
+    ) -> List[Tuple[str, str, int, str]]:
+        """Finds the stored domains whose registrable label looks like the
+        given name, see urlautomation.database.lookalike.find_lookalikes().
+        """
+        return lookalike.find_lookalikes(session, name, max_distance)
+
+    def rebuild_text_index(self, session) -> None:
+        """Rebuilds the text index over domain names and identities."""
+        if self._text_index:
+            rebuild_text_index(session)
+
+    def search_names(
+        self, session, term: str, fuzzy: bool = False, limit: int = 50
+    ) -> List[Tuple[str, List[str], float]]:
+        """Searches domain names and certificate identities by substring or
+        similarity, see urlautomation.database.textindex.search_names().
+        """
+        if not self._text_index:
+            raise RuntimeError("The database does not support text searches.")
+        return search_names(session, term, fuzzy, limit)
+
+    @staticmethod
+    def load_domain_profile(
+        session, domain_name: str, limit: Optional[int] = None
+    ) -> Optional[Dict[str, Any]]:
+        """Loads everything known about a domain in a fixed number of queries.
+        The DNS records, their IP addresses, nameservers and organizations, and
+        the certificate identities with their certificates and associated
+        domains are bulk loaded, instead of lazily loading each relationship
+        of each object.
+        @param domain_name The name of the domain to load.
+        @param limit The maximum number of certificate identities to load, most
+        recently issued first, or None for no limit.
+        @return A dictionary describing the domain, or None if it is unknown.
+        """
+        domain = session.query(Domain).filter(Domain.domain_name == domain_name).first()
+        if domain is None:
+            return None
+
+        a_records = (
+            session.query(ARecordValue)
+            .join(DNSRecord, DNSRecord.record_id == ARecordValue.dns_record_id)
+            .filter(DNSRecord.domain_id == domain.domain_id)
+            .options(
+                selectinload(ARecordValue.ip_addresses),
+                selectinload(ARecordValue.organizations),
+            )
+            .order_by(ARecordValue.first_seen)
+            .all()
+        )
+        ns_records = (
+            session.query(NSRecordValue)
+            .join(DNSRecord, DNSRecord.record_id == NSRecordValue.dns_record_id)
+            .filter(DNSRecord.domain_id == domain.domain_id)
+            .options(
+                selectinload(NSRecordValue.nameservers),
+                selectinload(NSRecordValue.organizations),
+            )
+            .order_by(NSRecordValue.first_seen)
+            .all()
+        )
+
+        identity_ids = (
+            select(ssl_identity_domains.c.identity_id)
+            .join(
+                SSLCertificateIdentity,
+                SSLCertificateIdentity.identity_id
+                == ssl_identity_domains.c.identity_id,
+            )
+            .join(
+                SSLCertificate,
+                SSLCertificate.certificate_id == SSLCertificateIdentity.certificate_id,
+            )
+            .where(ssl_identity_domains.c.domain_id == domain.domain_id)
+            .order_by(SSLCertificate.not_before.desc(), SSLCertificate.certificate_id)
+        )
+        total_identities = session.execute(
+            select(func.count()).select_from(identity_ids.subquery())
+        ).scalar()
+        if limit is not None:
+            identity_ids = identity_ids.limit(limit)
+
+        identities = (
+            session.query(SSLCertificateIdentity)
+            .join(
+                SSLCertificate,
+                SSLCertificate.certificate_id == SSLCertificateIdentity.certificate_id,
+            )
+            .filter(
+                SSLCertificateIdentity.identity_id.in_(identity_ids.scalar_subquery())
+            )
+            .options(joinedload(SSLCertificateIdentity.certificate))
+            .order_by(SSLCertificate.not_before.desc(), SSLCertificate.certificate_id)
+            .all()
+        )
+        associated_domains = defaultdict(list)
+        for identity_id, associated_name in session.execute(
+            select(ssl_identity_domains.c.identity_id, Domain.domain_name)
+            .join(Domain, Domain.domain_id == ssl_identity_domains.c.domain_id)
+            .where(
+                ssl_identity_domains.c.identity_id.in_(identity_ids.scalar_subquery())
+            )
+            .order_by(Domain.domain_name)
+        ):
+            associated_domains[identity_id].append(associated_name)
+
+        return {
+            "domain": domain.domain_name,
+            "id": domain.domain_id,
+            "dns_records": {
+                "a_records": [
+                    {
+                        "id": a_record.a_record_value_id,
+                        "first_seen": a_record.first_seen,
+                        "last_seen": a_record.last_seen,
+                        "ip_addresses": [ip.ip_address for ip in a_record.ip_addresses],
+                        "organizations": [
+                            org.organization_name for org in a_record.organizations
+                        ],
+                    }
+                    for a_record in a_records
+                ],
+                "ns_records": [
+                    {
+                        "id": ns_record.ns_record_value_id,
+                        "first_seen": ns_record.first_seen,
+                        "last_seen": ns_record.last_seen,
+                        "nameservers": [ns.nameserver for ns in ns_record.nameservers],
+                        "organizations": [
+                            org.organization_name for org in ns_record.organizations
+                        ],
+                    }
+                    for ns_record in ns_records
+                ],
+            },
+            "identities": [
+                {
+                    "identity": identity.identity,
+                    "ssl_certificate": {
+                        "certificate_id": identity.certificate.certificate_id,
+                        "issuer": identity.certificate.issuer_name,
+                        "valid_from": identity.certificate.not_before,
+                        "valid_to": identity.certificate.not_after,
+                        "serial_number": identity.certificate.serial_number,
+                        "subject_key_identifier": identity.certificate.subject_key_identifier,
+                        "authority_key_identifier": identity.certificate.authority_key_identifier,
+                        "public_key_algorithm": identity.certificate.public_key_algorithm,
+                        "public_key_size": identity.certificate.public_key_size,
+                        "public_key_modulus": identity.certificate.public_key_modulus,
+                        "public_key_exponent": identity.certificate.public_key_exponent,
+                        "signature_algorithm": identity.certificate.signature_algorithm,
+                        "signature": identity.certificate.signature,
+                    },
+                    "associated_domains": associated_domains[identity.identity_id],
+                }
+                for identity in identities
+            ],
+            "total_identities": total_identities,
+        }
+
+    @staticmethod
+    def _degree_filter(entity_type: str, entity_id, max_degree: Optional[int]):
+        """Returns the join condition and filter used to prune hub entities.
+        Entities without a stored degree are never pruned.
+        @param entity_type The EntityDegree type of the entity.
+        @param entity_id The column holding the ID of the entity.
+        @param max_degree The maximum number of linked domains, or None.
+        @return A tuple of (join condition, filter condition).
+        """
+        onclause = and_(
+            EntityDegree.entity_type == entity_type,
+            EntityDegree.entity_id == entity_id,
+        )
+        if max_degree is None:
+            return onclause, true()
+        return onclause, or_(
+            EntityDegree.degree.is_(None), EntityDegree.degree <= max_degree
+        )
+
+    @staticmethod
+    def _entity_domain_pairs(entity_type: str):
+        """Returns a select of distinct (entity_id, domain_id) pairs for the
+        given entity type, following the DNS record and certificate identity
+        association tables.
+        @param entity_type "certificate" or one of the EntityDegree entity types.
+        """
+        if entity_type == "certificate":
+            return (
+                select(
+                    SSLCertificateIdentity.certificate_id.label("entity_id"),
+                    ssl_identity_domains.c.domain_id.label("domain_id"),
+                )
+                .join_from(
+                    ssl_identity_domains,
+                    SSLCertificateIdentity,
+                    SSLCertificateIdentity.identity_id
+                    == ssl_identity_domains.c.identity_id,
+                )
+                .distinct()
+            )
+        if entity_type == EntityDegree.IP:
+            return (
+                select(
+                    a_record_ip_association.c.ip_id.label("entity_id"),
+                    DNSRecord.domain_id.label("domain_id"),
+                )
+                .join_from(
+                    a_record_ip_association,
+                    ARecordValue,
+                    ARecordValue.a_record_value_id
+                    == a_record_ip_association.c.a_record_value_id,
+                )
+                .join(DNSRecord, DNSRecord.record_id == ARecordValue.dns_record_id)
+                .distinct()
+            )
+        if entity_type == EntityDegree.NAMESERVER:
+            return (
+                select(
+                    ns_record_nameserver_association.c.nameserver_id.label("entity_id"),
+                    DNSRecord.domain_id.label("domain_id"),
+                )
+                .join_from(
+                    ns_record_nameserver_association,
+                    NSRecordValue,
+                    NSRecordValue.ns_record_value_id
+                    == ns_record_nameserver_association.c.ns_record_value_id,
+                )
+                .join(DNSRecord, DNSRecord.record_id == NSRecordValue.dns_record_id)
+                .distinct()
+            )
+        if entity_type == EntityDegree.ORGANIZATION:
+            return union(
+                select(
+                    a_record_organizations.c.organization_id.label("entity_id"),
+                    DNSRecord.domain_id.label("domain_id"),
+                )
+                .join_from(
+                    a_record_organizations,
+                    ARecordValue,
+                    ARecordValue.a_record_value_id
+                    == a_record_organizations.c.a_record_value_id,
+                )
+                .join(DNSRecord, DNSRecord.record_id == ARecordValue.dns_record_id),
+                select(
+                    ns_record_organizations.c.organization_id.label("entity_id"),
+                    DNSRecord.domain_id.label("domain_id"),
+                )
+                .join_from(
+                    ns_record_organizations,
+                    NSRecordValue,
+                    NSRecordValue.ns_record_value_id
+                    == ns_record_organizations.c.ns_record_value_id,
+                )
+                .join(DNSRecord, DNSRecord.record_id == NSRecordValue.dns_record_id),
+            )
+        raise ValueError(f"Unknown entity type: {entity_type}")
+
+    @staticmethod
+    def update_degrees(
+        session, entity_type: str, entity_ids: Optional[Iterable[int]] = None
+    ) -> None:
+        """Recomputes the stored degree of the given entities.
+        The counts are computed and written by the database itself, so this is
+        cheap to call after each ingest with the IDs that gained new links.
+        @param entity_type One of the EntityDegree entity types.
+        @param entity_ids The IDs of the entities to update, or None for all.
+        """
+        pairs = DatabaseManager._entity_domain_pairs(entity_type).subquery()
+        counts = select(
+            literal(entity_type),
+            pairs.c.entity_id,
+            func.count(distinct(pairs.c.domain_id)),
+        ).group_by(pairs.c.entity_id)
+        remove = delete(EntityDegree).where(EntityDegree.entity_type == entity_type)
+
+        if entity_ids is None:
+            batches = [None]
+        else:
+            entity_ids = sorted(set(entity_ids))
+            batches = [entity_ids[i : i + 500] for i in range(0, len(entity_ids), 500)]
+
+        for batch in batches:
+            batch_counts, batch_remove = counts, remove
+            if batch is not None:
+                batch_counts = counts.where(pairs.c.entity_id.in_(batch))
+                batch_remove = remove.where(EntityDegree.entity_id.in_(batch))
+            session.execute(batch_remove)
+            session.execute(
+                insert(EntityDegree).from_select(
+                    ["entity_type", "entity_id", "degree"], batch_counts
+                )
+            )
+
+    @staticmethod
+    def rebuild_degrees(session) -> None:
+        """Recomputes the stored degree of every IP address, nameserver and
+        organization in the database.
+        """
+        for entity_type in (
+            EntityDegree.IP,
+            EntityDegree.NAMESERVER,
+            EntityDegree.ORGANIZATION,
+        ):
+            DatabaseManager.update_degrees(session, entity_type)
+
+    @staticmethod
+    def _entity_columns(entity_type: str):
+        """Returns the (value column, ID column) of the given entity type.
+        @param entity_type One of the EntityDegree entity types.
+        """
+        return {
+            EntityDegree.IP: (ARecordIP.ip_address, ARecordIP.ip_id),
+            EntityDegree.NAMESERVER: (
+                NSRecordNameserver.nameserver,
+                NSRecordNameserver.nameserver_id,
+            ),
+            EntityDegree.ORGANIZATION: (
+                Organization.organization_name,
+                Organization.organization_id,
+            ),
+        }[entity_type]
+
+    @staticmethod
+    def _find_entity_associations(
+        session, domain: Domain, entity_type: str, max_degree: Optional[int] = None
+    ) -> List[Tuple[str, str, Optional[int]]]:
+        """Finds domains sharing an IP address, nameserver or organization
+        with the given domain.
+        @return A list of (domain name, shared entity, entity degree) tuples.
+        """
+        value, value_id = DatabaseManager._entity_columns(entity_type)
+        pairs = DatabaseManager._entity_domain_pairs(entity_type).subquery()
+        pairs1 = aliased(pairs)
+        pairs2 = aliased(pairs)
+        onclause, degree_filter = DatabaseManager._degree_filter(
+            entity_type, pairs1.c.entity_id, max_degree
+        )
+
+        return (
+            session.query(Domain.domain_name, value, EntityDegree.degree)
+            .select_from(pairs1)
+            .outerjoin(EntityDegree, onclause)
+            .join(pairs2, pairs2.c.entity_id == pairs1.c.entity_id)
+            .join(Domain, Domain.domain_id == pairs2.c.domain_id)
+            .join(value.class_, value_id == pairs1.c.entity_id)
+            .filter(pairs1.c.domain_id == domain.domain_id)
+            .filter(pairs2.c.domain_id != domain.domain_id)
+            .filter(degree_filter)
+            .all()
+        )
+
+    @staticmethod
+    def score_associations(
+        session, domain: Domain, max_degree: Optional[int] = None
+    ) -> List[Tuple[str, float, List[Tuple[str, str, Optional[int]]]]]:
+        """Scores the domains linked to the given domain.
+        Every shared IP address, nameserver and organization contributes an
+        IDF-style weight of log((1 + N) / (1 + degree)), where N is the number
+        of domains with DNS records, so that links through hub entities count
+        for little and links through rare entities count for a lot.
+        @return A list of (domain name, score, shared entities) tuples, where
+        shared entities are (entity type, entity, degree) tuples, sorted by
+        descending score.
+        """
+        total = session.query(func.count(DNSRecord.record_id)).scalar() or 0
+        scores = defaultdict(float)
+        shared = defaultdict(list)
+
+        for entity_type in (
+            EntityDegree.IP,
+            EntityDegree.NAMESERVER,
+            EntityDegree.ORGANIZATION,
+        ):
+            for (
+                domain_name,
+                entity,
+                degree,
+            ) in DatabaseManager._find_entity_associations(
+                session, domain, entity_type, max_degree
+            ):
+                scores[domain_name] += math.log((1 + total) / (1 + (degree or 1)))
+                shared[domain_name].append((entity_type, entity, degree))
+
+        return sorted(
+            (
+                (domain_name, score, shared[domain_name])
+                for domain_name, score in scores.items()
+            ),
+            key=lambda result: (-result[1], result[0]),
+        )
+
+    @staticmethod
+    def pivot_search(
+        session,
+        domain: Domain,
+        depth: int,
+        fanout: int = 100,
+        max_degree: Optional[int] = None,
+    ) -> List[Tuple[str, int, List[Tuple[str, str, str, str]]]]:
+        """Finds the domains up to a number of hops away from a domain, through
+        shared IP addresses and nameservers, breadth first: one query per hop,
+        each domain being only expanded from the hop it is first reached at.
+        @param domain The domain to start from.
+        @param depth The maximum number of hops.
+        @param fanout The maximum number of domains followed through each
+        shared IP address or nameserver.
+        @param max_degree Skip IP addresses and nameservers shared by more than
+        this many domains, or None.
+        @return A list of (domain name, hops, path) tuples ordered by hops, where
+        path is the list of (from domain, entity type, shared entity, to domain)
+        links from the starting domain.
+        """
+        # The reached domains, by ID: (domain name, link), the link being the
+        # (parent ID, entity type, shared entity) the domain was reached by.
+        reached = {domain.domain_id: (domain.domain_name, None)}
+        results = []
+        frontier = [domain.domain_id]
+        for hops in range(1, depth + 1):
+            if not frontier:
+                break
+            rows = session.execute(
+                text(DatabaseManager.PIVOT_HOP_QUERY),
+                {
+                    "frontier": json.dumps(frontier),
+                    "visited": json.dumps(list(reached)),
+                    "fanout": fanout,
+                    "max_degree": max_degree,
+                },
+            ).all()
+            for row in rows:
+                reached[row.domain_id] = (
+                    row.domain_name,
+                    (row.parent_id, row.kind, row.entity),
+                )
+                path = []
+                domain_id = row.domain_id
+                while (link := reached[domain_id][1]) is not None:
+                    parent_id, kind, entity = link
+                    path.append(
+                        (reached[parent_id][0], kind, entity, reached[domain_id][0])
+                    )
+                    domain_id = parent_id
+                results.append((row.domain_name, hops, path[::-1]))
+            frontier = [row.domain_id for row in rows]
+        return results
+
+    @staticmethod
+    def _find_ip_associations(
+        session, domain: Domain, max_degree: Optional[int] = None
+    ) -> List[Tuple[str, str, str]]:
         domain1 = aliased(Domain)
         domain2 = aliased(Domain)
         dns_record1 = aliased(DNSRecord)
@@ -80,6 +1520,9 @@ class DatabaseManager:
         a_record1 = aliased(ARecordValue)
         a_record2 = aliased(ARecordValue)
         ip_address = aliased(ARecordIP)
+        onclause, degree_filter = DatabaseManager._degree_filter(
+            EntityDegree.IP, ip_address.ip_id, max_degree
+        )
 
         return (
             session.query(
@@ -88,6 +1531,8 @@ class DatabaseManager:
             .join(dns_record1, domain1.dns_records)
             .join(a_record1, dns_record1.a_records)
             .join(ip_address, a_record1.ip_addresses)
+            .outerjoin(EntityDegree, onclause)
+            .filter(degree_filter)
             .join(a_record2, ip_address.a_records)
             .join(dns_record2, a_record2.dns_record)
             .join(domain2, dns_record2.domain)
@@ -97,7 +1542,9 @@ class DatabaseManager:
         )
 
     @staticmethod
-    def _find_nameserver_associations(session, domain: Domain) -> List[Tuple[str, str]]:
+    def _find_nameserver_associations(
+        session, domain: Domain, max_degree: Optional[int] = None
+    ) -> List[Tuple[str, str]]:
         domain1 = aliased(Domain)
         domain2 = aliased(Domain)
         dns_record1 = aliased(DNSRecord)
@@ -105,12 +1552,17 @@ class DatabaseManager:
         ns_record1 = aliased(NSRecordValue)
         ns_record2 = aliased(NSRecordValue)
         nameserver = aliased(NSRecordNameserver)
+        onclause, degree_filter = DatabaseManager._degree_filter(
+            EntityDegree.NAMESERVER, nameserver.nameserver_id, max_degree
+        )
 
         return (
             session.query(domain2.domain_name, nameserver.nameserver)
             .join(dns_record1, domain1.dns_records)
             .join(ns_record1, dns_record1.ns_records)
             .join(nameserver, ns_record1.nameservers)
+            .outerjoin(EntityDegree, onclause)
+            .filter(degree_filter)
             .join(ns_record2, nameserver.ns_records)
             .join(dns_record2, ns_record2.dns_record)
             .join(domain2, dns_record2.domain)
@@ -118,3 +1570,319 @@ class DatabaseManager:
             .filter(domain1.domain_id != domain2.domain_id)
             .all()
         )
+
+    @staticmethod
+    def _case_relationships(
+        case_domain_ids, entity_type: str, max_degree: Optional[int]
+    ):
+        """Returns a select of the links between the domains of a case and any
+        other domain through a shared IP address, nameserver or certificate.
+        Links between two domains of the case are only returned once.
+        @param case_domain_ids A select of the IDs of the domains in the case.
+        @param entity_type "certificate" or one of the EntityDegree entity types.
+        @param max_degree The maximum degree of the shared entity, or None.
+        """
+        pairs = DatabaseManager._entity_domain_pairs(entity_type).subquery()
+        pairs1 = aliased(pairs)
+        pairs2 = aliased(pairs)
+        domain1 = aliased(Domain)
+        domain2 = aliased(Domain)
+
+        query = (
+            select(
+                domain1.domain_name.label("source"),
+                domain2.domain_id.label("target_id"),
+                domain2.domain_name.label("target"),
+                literal(entity_type).label("relationship"),
+            )
+            .select_from(pairs1)
+            .join(pairs2, pairs2.c.entity_id == pairs1.c.entity_id)
+            .join(domain1, domain1.domain_id == pairs1.c.domain_id)
+            .join(domain2, domain2.domain_id == pairs2.c.domain_id)
+            .where(pairs1.c.domain_id.in_(case_domain_ids))
+            .where(pairs2.c.domain_id != pairs1.c.domain_id)
+            .where(
+                or_(
+                    pairs2.c.domain_id.not_in(case_domain_ids),
+                    pairs1.c.domain_id < pairs2.c.domain_id,
+                )
+            )
+        )
+        if entity_type == "certificate":
+            return query.add_columns(cast(pairs1.c.entity_id, String).label("via"))
+
+        value, value_id = DatabaseManager._entity_columns(entity_type)
+        onclause, degree_filter = DatabaseManager._degree_filter(
+            entity_type, pairs1.c.entity_id, max_degree
+        )
+        return (
+            query.add_columns(value.label("via"))
+            .join(value.class_, value_id == pairs1.c.entity_id)
+            .outerjoin(EntityDegree, onclause)
+            .where(degree_filter)
+        )
+
+    @staticmethod
+    def iter_case_report(
+        session,
+        case_name: str,
+        max_degree: Optional[int] = None,
+        batch_size: int = 1000,
+    ) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        """Streams everything known about the domains of a case as a graph.
+        Node records (domains, IP addresses, nameservers, certificates) are
+        produced first, followed by edge records (DNS history, certificate
+        identities and the relationships between domains). Every kind of record
+        is read with a single streamed query, so memory use is constant
+        regardless of the size of the case.
+        @param case_name The name of the case to report on.
+        @param max_degree Ignore IP addresses and nameservers shared by more
+        than this many domains, or None.
+        @param batch_size The number of rows fetched at a time.
+        @return An iterator of (kind, record) tuples, see CASE_REPORT_FIELDS.
+        """
+
+        def stream(query):
+            return session.execute(query.execution_options(yield_per=batch_size))
+
+        case_domain_ids = (
+            select(CaseDomain.domain_id)
+            .join(Case, Case.case_id == CaseDomain.case_id)
+            .where(Case.case_name == case_name)
+        )
+        relationships = union_all(
+            *(
+                DatabaseManager._case_relationships(
+                    case_domain_ids, entity_type, max_degree
+                )
+                for entity_type in (
+                    EntityDegree.IP,
+                    EntityDegree.NAMESERVER,
+                    "certificate",
+                )
+            )
+        ).subquery()
+
+        # Nodes
+        for (domain_name,) in stream(
+            select(Domain.domain_name)
+            .where(Domain.domain_id.in_(case_domain_ids))
+            .order_by(Domain.domain_name)
+        ):
+            yield "domain", {
+                "id": f"domain:{domain_name}",
+                "domain": domain_name,
+                "in_case": True,
+            }
+        for (domain_name,) in stream(
+            select(relationships.c.target)
+            .where(relationships.c.target_id.not_in(case_domain_ids))
+            .distinct()
+            .order_by(relationships.c.target)
+        ):
+            yield "domain", {
+                "id": f"domain:{domain_name}",
+                "domain": domain_name,
+                "in_case": False,
+            }
+        for entity_type in (EntityDegree.IP, EntityDegree.NAMESERVER):
+            pairs = DatabaseManager._entity_domain_pairs(entity_type).subquery()
+            value, value_id = DatabaseManager._entity_columns(entity_type)
+            onclause, _ = DatabaseManager._degree_filter(
+                entity_type, value_id, max_degree
+            )
+            for entity, degree in stream(
+                select(value, EntityDegree.degree)
+                .join(pairs, pairs.c.entity_id == value_id)
+                .outerjoin(EntityDegree, onclause)
+                .where(pairs.c.domain_id.in_(case_domain_ids))
+                .distinct()
+                .order_by(value)
+            ):
+                yield entity_type, {
+                    "id": f"{entity_type}:{entity}",
+                    value.key: entity,
+                    "degree": degree,
+                }
+        for certificate in stream(
+            select(
+                SSLCertificate.certificate_id,
+                SSLCertificate.issuer_name,
+                SSLCertificate.serial_number,
+                SSLCertificate.not_before,
+                SSLCertificate.not_after,
+            )
+            .join(
+                SSLCertificateIdentity,
+                SSLCertificateIdentity.certificate_id == SSLCertificate.certificate_id,
+            )
+            .join(
+                ssl_identity_domains,
+                ssl_identity_domains.c.identity_id
+                == SSLCertificateIdentity.identity_id,
+            )
+            .where(ssl_identity_domains.c.domain_id.in_(case_domain_ids))
+            .distinct()
+            .order_by(SSLCertificate.certificate_id)
+        ):
+            yield "certificate", {
+                "id": f"certificate:{certificate.certificate_id}",
+                "certificate_id": certificate.certificate_id,
+                "issuer": certificate.issuer_name,
+                "serial_number": certificate.serial_number,
+                "not_before": certificate.not_before,
+                "not_after": certificate.not_after,
+            }
+
+        # Edges
+        for kind, entity_type, record_cls, association in (
+            ("a_record", EntityDegree.IP, ARecordValue, a_record_ip_association),
+            (
+                "ns_record",
+                EntityDegree.NAMESERVER,
+                NSRecordValue,
+                ns_record_nameserver_association,
+            ),
+        ):
+            value, value_id = DatabaseManager._entity_columns(entity_type)
+            record_id = record_cls.__mapper__.primary_key[0]
+            for row in stream(
+                select(
+                    Domain.domain_name,
+                    value,
+                    record_cls.first_seen,
+                    record_cls.last_seen,
+                )
+                .join(DNSRecord, DNSRecord.domain_id == Domain.domain_id)
+                .join(record_cls, record_cls.dns_record_id == DNSRecord.record_id)
+                .join(association, association.c[record_id.key] == record_id)
+                .join(value.class_, value_id == association.c[value_id.key])
+                .where(Domain.domain_id.in_(case_domain_ids))
+                .order_by(Domain.domain_name, record_cls.first_seen)
+            ):
+                yield kind, {
+                    "source": f"domain:{row[0]}",
+                    "target": f"{entity_type}:{row[1]}",
+                    "first_seen": row.first_seen,
+                    "last_seen": row.last_seen,
+                }
+        for domain_name, certificate_id, identity in stream(
+            select(
+                Domain.domain_name,
+                SSLCertificateIdentity.certificate_id,
+                SSLCertificateIdentity.identity,
+            )
+            .join(
+                ssl_identity_domains,
+                ssl_identity_domains.c.domain_id == Domain.domain_id,
+            )
+            .join(
+                SSLCertificateIdentity,
+                SSLCertificateIdentity.identity_id
+                == ssl_identity_domains.c.identity_id,
+            )
+            .where(Domain.domain_id.in_(case_domain_ids))
+            .order_by(Domain.domain_name, SSLCertificateIdentity.certificate_id)
+        ):
+            yield "identity", {
+                "source": f"domain:{domain_name}",
+                "target": f"certificate:{certificate_id}",
+                "identity": identity,
+            }
+        for row in stream(
+            select(
+                relationships.c.source,
+                relationships.c.target,
+                relationships.c.relationship,
+                relationships.c.via,
+            )
+            .distinct()
+            .order_by(relationships.c.relationship, relationships.c.source)
+        ):
+            yield "relationship", {
+                "source": f"domain:{row.source}",
+                "target": f"domain:{row.target}",
+                "relationship": row.relationship,
+                "via": row.via,
+            }
+
+    @staticmethod
+    def case_overlap(
+        session,
+        max_degree: Optional[int] = None,
+        min_shared: int = 1,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Computes which cases share infrastructure with each other.
+        For each kind of shared entity, a single aggregate query joins the
+        (case, entity) pairs with themselves and counts the shared entities of
+        every pair of cases, so only pairs of cases that overlap are produced.
+        @param max_degree Ignore IP addresses and nameservers shared by more
+        than this many domains, or None.
+        @param min_shared The minimum number of shared entities of a pair.
+        @param limit The maximum number of pairs to return, or None.
+        @return A list of pairs of cases with the number of shared domains, IP
+        addresses, nameservers and certificates, most overlapping first.
+        """
+        kinds = {
+            "domains": None,
+            "ips": EntityDegree.IP,
+            "nameservers": EntityDegree.NAMESERVER,
+            "certificates": "certificate",
+        }
+        overlap = defaultdict(lambda: dict.fromkeys(kinds, 0))
+
+        for kind, entity_type in kinds.items():
+            if entity_type is None:
+                case_entities = select(
+                    CaseDomain.case_id, CaseDomain.domain_id.label("entity_id")
+                )
+            else:
+                pairs = DatabaseManager._entity_domain_pairs(entity_type).subquery()
+                case_entities = (
+                    select(CaseDomain.case_id, pairs.c.entity_id)
+                    .join(pairs, pairs.c.domain_id == CaseDomain.domain_id)
+                    .distinct()
+                )
+                if entity_type != "certificate" and max_degree is not None:
+                    onclause, degree_filter = DatabaseManager._degree_filter(
+                        entity_type, pairs.c.entity_id, max_degree
+                    )
+                    case_entities = case_entities.outerjoin(
+                        EntityDegree, onclause
+                    ).where(degree_filter)
+            case_entities = case_entities.cte(f"shared_{kind}")
+            first = aliased(case_entities)
+            second = aliased(case_entities)
+
+            for first_id, second_id, shared in session.execute(
+                select(first.c.case_id, second.c.case_id, func.count())
+                .join(
+                    second,
+                    and_(
+                        second.c.entity_id == first.c.entity_id,
+                        second.c.case_id > first.c.case_id,
+                    ),
+                )
+                .group_by(first.c.case_id, second.c.case_id)
+            ):
+                overlap[first_id, second_id][kind] = shared
+
+        case_names = dict(session.execute(select(Case.case_id, Case.case_name)).all())
+        results = []
+        for (first_id, second_id), shared in overlap.items():
+            total = sum(shared.values())
+            if total < min_shared:
+                continue
+            results.append(
+                {
+                    "case": case_names[first_id],
+                    "other_case": case_names[second_id],
+                    **shared,
+                    "total": total,
+                }
+            )
+        results.sort(
+            key=lambda result: (-result["total"], result["case"], result["other_case"])
+        )
+        return results[:limit]
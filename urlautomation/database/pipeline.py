@@ -0,0 +1,272 @@
+"""@package urlautomation.database.pipeline
+This module contains the multi-process fetch pipeline.
+SQLite allows a single writer, so the pipeline splits fetching in two stages:
+worker processes request (or replay) and parse the data of the domains with
+DataFetcher.collect(), and send the resulting batches of records over a queue
+to the process running the pipeline, which is the only one writing to the
+database. It writes the batches of many domains a chunk of records per
+transaction, then their fetch journal entries in a single transaction. The number of domains handed to the
+workers and not written yet is bounded, so that slow writes hold back the
+workers (and the reading of the input) instead of filling the memory.
+"""
+
+from urlautomation.database.fetchers import ALL_DATAFETCHERS
+from urlautomation.database.planner import FetchPlanner
+from urlautomation.database.types import FetchJournal
+from urlautomation.metrics import METRICS
+
+from typing import Any, Dict, Iterable, List, Tuple
+
+import logging
+import multiprocessing
+import queue
+
+logger = logging.getLogger(__name__)
+
+LOG_FORMAT = "%(asctime)s - %(levelname)s [%(processName)s]: %(message)s"
+
+
+def _worker(
+    db_path: str,
+    fetcher_arguments: Dict[str, dict],
+    tasks: multiprocessing.Queue,
+    results: multiprocessing.Queue,
+    log_level: int,
+) -> None:
+    """Entry point of the worker processes: collects the domains received on
+    the task queue until it receives None.
+    Each result is a (domain name, batches by fetcher, failed fetchers,
+    metrics snapshot) tuple.
+    """
+    # Imported here, the workers are spawned in fresh interpreters.
+    from urlautomation.database.manager import DatabaseManager
+
+    logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    # The workers only read from the database (e.g. to skip the certificates
+    # already known), the batches are written by the pipeline process.
+    database = DatabaseManager(db_path)
+    while (task := tasks.get()) is not None:
+        domain_name, fetchers, search_names = task
+        batches, failed = {}, []
+        for fetcher in fetchers:
+            try:
+                batches[fetcher] = database.collect_data(
+                    fetcher,
+                    search_names.get(fetcher, domain_name),
+                    **fetcher_arguments[fetcher],
+                )
+            except Exception as e:
+                logger.exception(
+                    f"Failed to fetch {fetcher} data for domain {domain_name}: {e}"
+                )
+                failed.append(fetcher)
+        results.put((domain_name, batches, failed, METRICS.snapshot()))
+        METRICS.reset()
+
+
+class FetchPipeline:
+    """Fetches domains with worker processes and a single writer."""
+
+    def __init__(self, database, workers: int, batch_size: int = 50):
+        """Class constructor for FetchPipeline.
+        @param database The DatabaseManager to write to.
+        @param workers The number of worker processes.
+        @param batch_size The number of domains written per transaction.
+        """
+        self._database = database
+        self._workers = workers
+        self._batch_size = batch_size
+        # Domains sent to the workers and not written yet.
+        self._max_in_flight = max(2 * workers, batch_size)
+        self._before: Dict[str, Any] = {}
+        # Fetchers of the domains in flight whose data comes from the search
+        # of another domain (see FetchPlanner).
+        self._covered: Dict[str, Dict[str, str]] = {}
+        # The covered fetchers waiting for the domain whose fetch covers them
+        # to be written, by domain: (covered domain, fetcher) pairs.
+        self._waiting: Dict[str, List[Tuple[str, str]]] = {}
+        self._fetched_waiting = set()
+
+    def _start(self, job_name: str, plans: List[tuple]) -> Tuple[List[tuple], int]:
+        """Journals a chunk of planned domains, in a single transaction.
+        @param plans The (domain, search names, covered fetchers) plans.
+        @return The (domain, fetchers, search names) tasks to send to the
+        workers, and the number of domains the job had already completed.
+        """
+        tasks, skipped = [], 0
+        with self._database as session:
+            for domain_name, search_names, covered in plans:
+                if domain_name in self._before:
+                    # Already sent to the workers, and not written yet.
+                    skipped += 1
+                    continue
+                fetchers = self._database.start_fetch(
+                    session, job_name, domain_name, list(ALL_DATAFETCHERS)
+                )
+                if not fetchers:
+                    skipped += 1
+                    continue
+                self._before[domain_name] = self._database._domain_fingerprint(
+                    session, domain_name
+                )
+                self._covered[domain_name] = {
+                    fetcher: leader
+                    for fetcher, leader in covered.items()
+                    if fetcher in fetchers
+                }
+                tasks.append(
+                    (
+                        domain_name,
+                        [fetcher for fetcher in fetchers if fetcher not in covered],
+                        search_names,
+                    )
+                )
+        return tasks, skipped
+
+    def _write(self, job_name: str, results: List[tuple]) -> Tuple[int, int]:
+        """Writes the batches of a chunk of domains, a chunk of records per
+        transaction (see DatabaseManager.ingest_data()), then journals their
+        outcomes in a single transaction.
+        @return The numbers of domains fetched and failed.
+        """
+        with METRICS.timer("pipeline_write"):
+            for domain_name, batches, failed_fetchers, metrics in results:
+                METRICS.merge(metrics)
+                failed_fetchers += self._database.ingest_batches(domain_name, batches)
+            with self._database as session:
+                fetched, failed = self._journal(session, job_name, results)
+        METRICS.count("pipeline_domains_written", len(results))
+        return fetched, failed
+
+    def _journal(self, session, job_name: str, results: List[tuple]) -> Tuple[int, int]:
+        """Journals the outcomes of a chunk of written domains.
+        @return The numbers of domains fetched and failed.
+        """
+        fetched, failed = 0, 0
+        for domain_name, batches, failed_fetchers, _ in results:
+            covered, waiting = {}, False
+            for fetcher, leader in self._covered.pop(domain_name).items():
+                if leader in self._before:
+                    # Not written yet, its outcome is copied once it is.
+                    self._waiting.setdefault(leader, []).append((domain_name, fetcher))
+                    waiting = True
+                else:
+                    covered[fetcher] = leader
+            if self._database.journal_fetched(
+                session,
+                job_name,
+                domain_name,
+                [fetcher for fetcher in batches if fetcher not in failed_fetchers],
+                failed_fetchers,
+                self._before.pop(domain_name),
+                covered,
+            ):
+                fetched += 1
+                if waiting:
+                    self._fetched_waiting.add(domain_name)
+            else:
+                failed += 1
+            for covered_name, fetcher in self._waiting.pop(domain_name, []):
+                status = self._database.copy_fetch_status(
+                    session, job_name, domain_name, fetcher, [covered_name]
+                )
+                if (
+                    status == FetchJournal.FAILED
+                    and covered_name in self._fetched_waiting
+                ):
+                    # Counted as fetched before its outcome was known.
+                    fetched, failed = fetched - 1, failed + 1
+                self._fetched_waiting.discard(covered_name)
+        return fetched, failed
+
+    @staticmethod
+    def _receive(results: multiprocessing.Queue, processes: list) -> tuple:
+        """Waits for the next result, failing if a worker died."""
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in processes):
+                    raise RuntimeError("A fetch worker process died unexpectedly.")
+
+    def run(
+        self,
+        job_name: str,
+        names: Iterable[str],
+        fetcher_arguments: Dict[str, dict],
+    ) -> Tuple[int, int, int]:
+        """Fetches domains as part of a fetch job.
+        @param job_name The name of the fetch job.
+        @param names The (valid) domain names to fetch, read as needed.
+        @param fetcher_arguments The keyword arguments of each fetcher, by name.
+        @return The numbers of domains fetched, failed, and already done.
+        """
+        context = multiprocessing.get_context("spawn")
+        tasks, results = context.Queue(), context.Queue()
+        db_path = self._database._engine.url.database
+        processes = [
+            context.Process(
+                target=_worker,
+                args=(
+                    db_path,
+                    fetcher_arguments,
+                    tasks,
+                    results,
+                    logging.getLogger().getEffectiveLevel(),
+                ),
+                name=f"fetch-worker-{i}",
+                daemon=True,
+            )
+            for i in range(self._workers)
+        ]
+        for process in processes:
+            process.start()
+
+        fetched, failed, skipped = 0, 0, 0
+        in_flight, received = 0, []
+
+        def receive():
+            nonlocal in_flight, fetched, failed
+            received.append(self._receive(results, processes))
+            in_flight -= 1
+            if len(received) >= self._batch_size:
+                chunk_fetched, chunk_failed = self._write(job_name, received)
+                fetched, failed = fetched + chunk_fetched, failed + chunk_failed
+                received.clear()
+
+        try:
+            chunk = []
+            plans = FetchPlanner.from_arguments(fetcher_arguments).plan(names)
+            while True:
+                plan = next(plans, None)
+                if plan is not None:
+                    chunk.append(plan)
+                    if len(chunk) < self._batch_size:
+                        continue
+                if chunk:
+                    chunk_tasks, chunk_skipped = self._start(job_name, chunk)
+                    skipped += chunk_skipped
+                    chunk = []
+                    for task in chunk_tasks:
+                        while in_flight >= self._max_in_flight:
+                            receive()
+                        tasks.put(task)
+                        in_flight += 1
+                if plan is None:
+                    break
+            while in_flight:
+                receive()
+            if received:
+                chunk_fetched, chunk_failed = self._write(job_name, received)
+                fetched, failed = fetched + chunk_fetched, failed + chunk_failed
+            for _ in processes:
+                tasks.put(None)
+            for process in processes:
+                process.join()
+        finally:
+            # On errors (or interruptions), stop the workers right away: the
+            # unwritten domains are still pending in the journal.
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+        return fetched, failed, skipped
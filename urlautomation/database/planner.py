@@ -0,0 +1,109 @@
+"""@package urlautomation.database.planner
+This module contains the fetch planner, which collapses redundant crt.sh
+searches. The crt.sh search of a domain ("%pokerkg.com%", or "%.pokerkg.com"
+in subdomains mode) also returns the certificates of its subdomains, so when
+several names of the same registrable domain are fetched, a single search of
+the registrable domain covers all of them, while the DNS records are still
+fetched for each name. Names are planned a chunk at a time, so that inputs of
+any size are streamed, and searches made for earlier chunks keep covering the
+names of later ones, as long as they are among the most recently used
+searches (the planner is kept across the claims of a worker or the cycles of
+a refresh, so the searches it remembers are bounded). The fetchers of a name covered by another's search share
+the outcome of that search (see DatabaseManager.journal_fetched()).
+"""
+
+from urlautomation.database.domainnames import registrable_domain
+
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+CRTSH = "crtsh"
+
+
+class FetchPlanner:
+    """Plans the fetches of a stream of (normalized) domain names."""
+
+    def __init__(
+        self,
+        match: str = "contains",
+        chunk_size: int = 1000,
+        max_searched: int = 100000,
+    ):
+        """Class constructor for FetchPlanner.
+        @param match The crt.sh match mode, one of CRTSH_MATCH_MODES. Exact
+        searches do not cover subdomains, so they are not grouped.
+        @param chunk_size The number of names grouped at a time.
+        @param max_searched The maximum number of searches remembered, the
+        least recently used ones being forgotten (their names are then
+        searched again if they come up).
+        """
+        self._group = match != "exact"
+        self._chunk_size = chunk_size
+        self._max_searched = max_searched
+        # The names searched so far, with the domain each was searched for,
+        # least recently used first.
+        self._searched: "OrderedDict[str, str]" = OrderedDict()
+
+    @classmethod
+    def from_arguments(cls, fetcher_arguments: Dict[str, dict]) -> "FetchPlanner":
+        """Returns a planner for the fetch options of a command."""
+        return cls(fetcher_arguments[CRTSH].get("match", "contains"))
+
+    def _covered(self, domain_name: str, group: str) -> Optional[str]:
+        """Returns the domain whose search, already planned, covers a name: a
+        search of the name itself, or of one of its parents down to its group.
+        @return The domain the covering search is made for, or None.
+        """
+        labels = domain_name.split(".")
+        searches = range(len(labels) - group.count(".")) if self._group else [0]
+        for start in searches:
+            search = ".".join(labels[start:])
+            leader = self._searched.get(search)
+            if leader is not None:
+                self._searched.move_to_end(search)
+                return leader
+        return None
+
+    def _add_search(self, search: str, domain_name: str) -> None:
+        """Remembers a planned search, forgetting the least recently used one
+        beyond max_searched.
+        """
+        self._searched[search] = domain_name
+        self._searched.move_to_end(search)
+        if len(self._searched) > self._max_searched:
+            self._searched.popitem(last=False)
+
+    def plan(
+        self, names: Iterable[str]
+    ) -> Iterator[Tuple[str, Dict[str, str], Dict[str, str]]]:
+        """Plans the fetches of domain names. The names of a registrable
+        domain are planned together, the one searching the registrable domain
+        first and the ones covered by its search after it.
+        @return (domain name, search names, covered fetchers) tuples: the
+        names some fetchers search instead of the domain name, and the
+        fetchers whose data about the domain comes from the search of another
+        domain, with that domain.
+        """
+        names = iter(names)
+        while chunk := list(islice(names, self._chunk_size)):
+            groups: Dict[str, List[str]] = {}
+            for domain_name in chunk:
+                group = registrable_domain(domain_name) or domain_name
+                groups.setdefault(group, []).append(domain_name)
+            for group, members in groups.items():
+                # The registrable domain, when fetched, leads its group.
+                members.sort(key=lambda domain_name: domain_name != group)
+                # A lone subdomain keeps its own, narrower, search.
+                shared = self._group and (len(set(members)) > 1 or group in members)
+                for domain_name in members:
+                    leader = self._covered(domain_name, group)
+                    if leader is not None:
+                        yield domain_name, {}, {CRTSH: leader}
+                        continue
+                    search = group if shared else domain_name
+                    self._add_search(search, domain_name)
+                    if search == domain_name:
+                        yield domain_name, {}, {}
+                    else:
+                        yield domain_name, {CRTSH: search}, {}
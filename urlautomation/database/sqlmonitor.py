@@ -0,0 +1,142 @@
+"""@package urlautomation.database.sqlmonitor
+This module contains the SQL instrumentation of the database engine.
+Every statement is timed (latency histogram by operation), counted, and
+reduced to its shape (the statement with literals and parameter lists
+collapsed), so that N+1 patterns show up as a shape executed many times by a
+single command. Statements slower than a threshold are logged along with their
+EXPLAIN QUERY PLAN.
+"""
+
+from urlautomation.metrics import METRICS
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from collections import Counter, defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import logging
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+# Operations whose query plan can be explained.
+EXPLAINABLE = {"select", "insert", "update", "delete", "with", "replace"}
+
+_WHITESPACE = re.compile(r"\s+")
+_PARAMETER_LIST = re.compile(r"\?(?:\s*,\s*\?)+")
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+
+
+def statement_shape(statement: str) -> str:
+    """Returns the shape of an SQL statement: identical for statements that
+    only differ by their literals or the length of their parameter lists.
+    """
+    shape = _WHITESPACE.sub(" ", statement).strip()
+    shape = _STRING.sub("'?'", shape)
+    shape = _NUMBER.sub("?", shape)
+    return _PARAMETER_LIST.sub("?, ...", shape)
+
+
+class SQLMonitor:
+    """Collects the SQL statistics of an engine, per command."""
+
+    def __init__(
+        self,
+        engine: Engine,
+        slow_query_ms: Optional[float] = None,
+        repeat_threshold: int = 25,
+    ):
+        """Class constructor for SQLMonitor.
+        @param engine The engine to instrument.
+        @param slow_query_ms Log the statements slower than this many
+        milliseconds with their query plan, or None.
+        @param repeat_threshold The number of executions of a statement shape
+        within a command above which it is flagged as repeated.
+        """
+        self.slow_query_ms = slow_query_ms
+        self.repeat_threshold = repeat_threshold
+        self.reset()
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def reset(self) -> None:
+        """Starts collecting the statistics of a new command."""
+        self.statements = 0
+        self.total_seconds = 0.0
+        self._shapes: Counter = Counter()
+        self._shape_seconds: Dict[str, float] = defaultdict(float)
+
+    def _before_execute(
+        self, conn, cursor, statement, parameters, context, executemany
+    ):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info["query_start"].pop()
+        operation = statement.lstrip().split(None, 1)[0].lower()
+        METRICS.observe("db_query", duration, operation=operation)
+        if operation in ("insert", "update", "delete") and cursor.rowcount > 0:
+            METRICS.count("db_rows", cursor.rowcount, operation=operation)
+
+        shape = statement_shape(statement)
+        self.statements += 1
+        self.total_seconds += duration
+        self._shapes[shape] += 1
+        self._shape_seconds[shape] += duration
+
+        if self.slow_query_ms is not None and duration * 1000 >= self.slow_query_ms:
+            if executemany and parameters:
+                parameters = parameters[0]
+            plan = self.explain(cursor, operation, statement, parameters)
+            logger.warning(
+                f"Slow SQL statement ({duration * 1000:.1f} ms): "
+                f"{_WHITESPACE.sub(' ', statement).strip()}\n"
+                f"Parameters: {repr(parameters)[:200]}\n"
+                f"Query plan:\n{plan}"
+            )
+
+    @staticmethod
+    def explain(cursor, operation: str, statement: str, parameters: Any) -> str:
+        """Returns the EXPLAIN QUERY PLAN of a statement as an indented tree.
+        It is run on a new cursor of the same DBAPI connection, bypassing the
+        engine so that it is not instrumented itself.
+        """
+        if operation not in EXPLAINABLE:
+            return "  (not available)"
+        try:
+            rows = (
+                cursor.connection.cursor()
+                .execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ())
+                .fetchall()
+            )
+        except Exception as e:
+            return f"  (not available: {e})"
+        depths = {0: 0}
+        lines = []
+        for node_id, parent_id, _, detail in rows:
+            depths[node_id] = depths.get(parent_id, 0) + 1
+            lines.append(f"{'  ' * depths[node_id]}{detail}")
+        return "\n".join(lines)
+
+    def repeated_shapes(self) -> List[Tuple[str, int, float]]:
+        """Returns the statement shapes executed at least repeat_threshold
+        times since the last reset, most executed first.
+        @return A list of (shape, executions, total seconds) tuples.
+        """
+        return [
+            (shape, count, self._shape_seconds[shape])
+            for shape, count in self._shapes.most_common()
+            if count >= self.repeat_threshold
+        ]
+
+    def summary(self) -> Dict[str, Any]:
+        """Returns the statistics collected since the last reset."""
+        return {
+            "statements": self.statements,
+            "total_seconds": self.total_seconds,
+            "shapes": len(self._shapes),
+            "repeated_shapes": self.repeated_shapes(),
+        }
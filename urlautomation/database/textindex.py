@@ -0,0 +1,165 @@
+"""@package urlautomation.database.textindex
+This module contains the full text (trigram) index over domain names and
+certificate identities, used for substring and fuzzy (lookalike) searches.
+The index is made of SQLite FTS5 tables using the trigram tokenizer, kept
+in sync with the indexed tables by triggers, so it is maintained on every
+insert regardless of which fetcher added the row.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import OperationalError
+
+from difflib import SequenceMatcher
+from typing import Dict, List, Tuple
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# (index table, content table, content column, content rowid, result kind)
+INDEXED_COLUMNS = [
+    ("domain_name_index", "domains", "domain_name", "domain_id", "domain"),
+    (
+        "identity_name_index",
+        "ssl_certificates_identities",
+        "identity",
+        "identity_id",
+        "identity",
+    ),
+]
+
+
+def _index_ddl(index: str, table: str, column: str, rowid: str) -> List[str]:
+    """Returns the statements creating an external content FTS5 trigram index
+    over a column, along with the triggers keeping it up to date.
+    """
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5("
+        f"{column}, content='{table}', content_rowid='{rowid}', tokenize='trigram')",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {index}(rowid, {column}) VALUES (new.{rowid}, new.{column}); "
+        f"END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, {column}) "
+        f"VALUES ('delete', old.{rowid}, old.{column}); "
+        f"END",
+        f"CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE OF {column} ON {table} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, {column}) "
+        f"VALUES ('delete', old.{rowid}, old.{column}); "
+        f"INSERT INTO {index}(rowid, {column}) VALUES (new.{rowid}, new.{column}); "
+        f"END",
+    ]
+
+
+def create_text_index(connection: Connection) -> bool:
+    """Creates the text index if it does not exist yet. Newly created indexes
+    are populated from the existing rows.
+    @param connection The connection to create the index with.
+    @return True if the index is available, False if the database does not
+    support it (e.g. SQLite built without FTS5).
+    """
+    try:
+        for index, table, column, rowid, _ in INDEXED_COLUMNS:
+            exists = connection.execute(
+                text(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"
+                ),
+                {"name": index},
+            ).first()
+            for statement in _index_ddl(index, table, column, rowid):
+                connection.execute(text(statement))
+            if not exists:
+                connection.execute(
+                    text(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+                )
+    except OperationalError:
+        logger.warning(
+            "The database does not support FTS5 trigram indexes, "
+            "fuzzy and substring searches are unavailable.",
+            exc_info=True,
+        )
+        return False
+    return True
+
+
+def has_text_index(connection: Connection) -> bool:
+    """Checks whether the text index has been created.
+    @param connection The connection to check the database with.
+    """
+    tables = connection.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'table'")
+    ).scalars()
+    return {index for index, *_ in INDEXED_COLUMNS} <= set(tables)
+
+
+def rebuild_text_index(session) -> None:
+    """Rebuilds the text index from the indexed tables."""
+    for index, *_ in INDEXED_COLUMNS:
+        session.execute(text(f"INSERT INTO {index}({index}) VALUES ('rebuild')"))
+
+
+def _quote(term: str) -> str:
+    """Quotes a term as an FTS5 string, matching it as a substring."""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def _similarity(term: str, name: str) -> float:
+    """Scores how much a name looks like the search term, between 0 and 1.
+    The term is compared to the full name and to each of its labels, so that
+    "p0kerkg" scores high against "www.pokerkg.com".
+    """
+    return max(
+        SequenceMatcher(None, term, candidate).ratio()
+        for candidate in [name, *name.split(".")]
+    )
+
+
+def search_names(
+    session, term: str, fuzzy: bool = False, limit: int = 50
+) -> List[Tuple[str, List[str], float]]:
+    """Searches the domain names and certificate identities.
+    In substring mode, names containing the term are returned. In fuzzy mode,
+    names sharing the most trigrams with the term are fetched from the index,
+    then ranked by their similarity to the term.
+    @param term The (part of the) name to search for, at least 3 characters.
+    @param fuzzy Whether to return similar names rather than substring matches.
+    @param limit The maximum number of results.
+    @return A list of (name, kinds, score) tuples, best matches first, where
+    kinds are the kinds of record ("domain", "identity") the name appears in.
+    """
+    term = term.strip().lower()
+    if len(term) < 3:
+        raise ValueError("Search terms must be at least 3 characters long.")
+
+    if fuzzy:
+        trigrams = sorted({term[i : i + 3] for i in range(len(term) - 2)})
+        match = " OR ".join(_quote(trigram) for trigram in trigrams)
+        # Fetch more candidates than needed, they are re-ranked below.
+        candidates = limit * 20
+    else:
+        match = _quote(term)
+        candidates = limit
+
+    kinds: Dict[str, List[str]] = {}
+    for index, _, column, _, kind in INDEXED_COLUMNS:
+        # Names repeat in the index (an identity once per certificate), they
+        # are deduplicated before the limit so that repeats do not use it up.
+        for (name,) in session.execute(
+            text(
+                f"SELECT {column} FROM {index} WHERE {index} MATCH :match "
+                f"GROUP BY {column} ORDER BY min(rank) LIMIT :limit"
+            ),
+            {"match": match, "limit": candidates},
+        ):
+            kinds.setdefault(name, []).append(kind)
+
+    results = [
+        (name, name_kinds, _similarity(term, name))
+        for name, name_kinds in kinds.items()
+    ]
+    results.sort(key=lambda result: (-result[2], len(result[0]), result[0]))
+    if fuzzy:
+        # Drop candidates that only share a trigram or two with the term.
+        results = [result for result in results if result[2] >= 0.5]
+    return results[:limit]
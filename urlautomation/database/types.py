@@ -4,15 +4,22 @@ from sqlalchemy import (
     String,
     Text,
     DateTime,
+    Float,
     ForeignKey,
     UniqueConstraint,
     PrimaryKeyConstraint,
     Table,
+    Index,
 )
 from sqlalchemy.orm import relationship, declarative_base
 
 Base = declarative_base()
 
+# Version of the database schema, stored in the database (PRAGMA user_version)
+# once its tables, indexes and triggers have been created. Bump it whenever a
+# table, column or index is added so existing databases get upgraded.
+SCHEMA_VERSION = 4
+
 
 ssl_identity_domains = Table(
     "ssl_identity_domains",
@@ -20,7 +27,7 @@ ssl_identity_domains = Table(
     Column(
         "identity_id", Integer, ForeignKey("ssl_certificates_identities.identity_id")
     ),
-    Column("domain_id", Integer, ForeignKey("domains.domain_id")),
+    Column("domain_id", Integer, ForeignKey("domains.domain_id"), index=True),
     PrimaryKeyConstraint("identity_id", "domain_id"),
 )
 
@@ -60,7 +67,9 @@ class CaseDomain(Base):
     __tablename__ = "case_domains"
 
     case_id = Column(Integer, ForeignKey("cases.case_id"), primary_key=True)
-    domain_id = Column(Integer, ForeignKey("domains.domain_id"), primary_key=True)
+    domain_id = Column(
+        Integer, ForeignKey("domains.domain_id"), primary_key=True, index=True
+    )
 
     # Relationships
     case = relationship("Case", back_populates="domains")
@@ -73,7 +82,12 @@ a_record_organizations = Table(
     Column(
         "a_record_value_id", Integer, ForeignKey("a_record_values.a_record_value_id")
     ),
-    Column("organization_id", Integer, ForeignKey("organizations.organization_id")),
+    Column(
+        "organization_id",
+        Integer,
+        ForeignKey("organizations.organization_id"),
+        index=True,
+    ),
     PrimaryKeyConstraint("a_record_value_id", "organization_id"),
 )
 
@@ -83,7 +97,12 @@ ns_record_organizations = Table(
     Column(
         "ns_record_value_id", Integer, ForeignKey("ns_record_values.ns_record_value_id")
     ),
-    Column("organization_id", Integer, ForeignKey("organizations.organization_id")),
+    Column(
+        "organization_id",
+        Integer,
+        ForeignKey("organizations.organization_id"),
+        index=True,
+    ),
     PrimaryKeyConstraint("ns_record_value_id", "organization_id"),
 )
 
@@ -124,9 +143,12 @@ a_record_ip_association = Table(
     "a_record_ip_association",
     Base.metadata,
     Column(
-        "a_record_value_id", Integer, ForeignKey("a_record_values.a_record_value_id")
+        "a_record_value_id",
+        Integer,
+        ForeignKey("a_record_values.a_record_value_id"),
+        index=True,
     ),
-    Column("ip_id", Integer, ForeignKey("a_record_ips.ip_id")),
+    Column("ip_id", Integer, ForeignKey("a_record_ips.ip_id"), index=True),
 )
 
 
@@ -134,7 +156,7 @@ class ARecordValue(Base):
     __tablename__ = "a_record_values"
 
     a_record_value_id = Column(Integer, primary_key=True, autoincrement=True)
-    dns_record_id = Column(Integer, ForeignKey("dns_records.record_id"))
+    dns_record_id = Column(Integer, ForeignKey("dns_records.record_id"), index=True)
     first_seen = Column(DateTime)
     last_seen = Column(DateTime)
 
@@ -162,9 +184,17 @@ ns_record_nameserver_association = Table(
     "ns_record_nameserver_association",
     Base.metadata,
     Column(
-        "ns_record_value_id", Integer, ForeignKey("ns_record_values.ns_record_value_id")
+        "ns_record_value_id",
+        Integer,
+        ForeignKey("ns_record_values.ns_record_value_id"),
+        index=True,
+    ),
+    Column(
+        "nameserver_id",
+        Integer,
+        ForeignKey("ns_record_nameservers.nameserver_id"),
+        index=True,
     ),
-    Column("nameserver_id", Integer, ForeignKey("ns_record_nameservers.nameserver_id")),
 )
 
 
@@ -172,7 +202,7 @@ class NSRecordValue(Base):
     __tablename__ = "ns_record_values"
 
     ns_record_value_id = Column(Integer, primary_key=True, autoincrement=True)
-    dns_record_id = Column(Integer, ForeignKey("dns_records.record_id"))
+    dns_record_id = Column(Integer, ForeignKey("dns_records.record_id"), index=True)
     first_seen = Column(DateTime)
     last_seen = Column(DateTime)
 
@@ -262,3 +292,107 @@ class SSLCertificateIdentity(Base):
     __table_args__ = (
         UniqueConstraint("certificate_id", "identity", name="unique_identity_per_cert"),
     )
+
+
+class EntityDegree(Base):
+    __tablename__ = "entity_degrees"
+
+    # Entity types tracked in this table.
+    IP = "ip"
+    NAMESERVER = "nameserver"
+    ORGANIZATION = "organization"
+
+    # The number of distinct domains linked to an IP address, nameserver or
+    # organization. Maintained on ingest so that hub entities (shared hosting,
+    # big registrars' nameservers) can be pruned inside association queries.
+    entity_type = Column(String, primary_key=True)
+    entity_id = Column(Integer, primary_key=True)
+    degree = Column(Integer, nullable=False, default=0)
+
+
+lookalike_label_domains = Table(
+    "lookalike_label_domains",
+    Base.metadata,
+    Column("label_id", Integer, ForeignKey("lookalike_labels.label_id")),
+    Column("domain_id", Integer, ForeignKey("domains.domain_id")),
+    PrimaryKeyConstraint("label_id", "domain_id"),
+)
+
+
+class LookalikeLabel(Base):
+    __tablename__ = "lookalike_labels"
+
+    # A node of the BK-tree over the (homoglyph folded) registrable labels of
+    # the domains, e.g. "pokerkg" for "game.pokerkg.com". Each node stores its
+    # edit distance to its parent, so that a lookalike search only needs to
+    # visit the children whose distance is within range.
+    label_id = Column(Integer, primary_key=True, autoincrement=True)
+    label = Column(String, unique=True)
+    parent_id = Column(Integer, ForeignKey("lookalike_labels.label_id"))
+    distance = Column(Integer)
+
+    domains = relationship("Domain", secondary=lookalike_label_domains)
+
+    __table_args__ = (Index("ix_lookalike_labels_children", "parent_id", "distance"),)
+
+
+class DomainRefresh(Base):
+    __tablename__ = "domain_refresh"
+
+    # How often fetching a domain finds new certificates or DNS records, and
+    # the staleness score last computed from it, used to spend the request
+    # budget of the refresh command on the domains most likely to change.
+    domain_id = Column(Integer, ForeignKey("domains.domain_id"), primary_key=True)
+    first_fetched = Column(DateTime)
+    last_fetched = Column(DateTime)
+    fetch_count = Column(Integer, nullable=False, default=0)
+    change_count = Column(Integer, nullable=False, default=0)
+    staleness = Column(Float)
+    scored_at = Column(DateTime)
+
+
+class FetchJournal(Base):
+    __tablename__ = "fetch_journal"
+
+    # Statuses of a journal entry.
+    PENDING = "pending"
+    DONE = "done"
+    FAILED = "failed"
+
+    # The progress of a bulk fetch job, per domain and per provider, so that
+    # an interrupted job can be resumed without fetching (and spending API
+    # quota on) the domains and providers it already completed.
+    job_name = Column(String, primary_key=True)
+    domain_name = Column(String, primary_key=True)
+    provider = Column(String, primary_key=True)
+    status = Column(String, nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+    __table_args__ = (Index("ix_fetch_journal_job_status", "job_name", "status"),)
+
+
+class FetchQueue(Base):
+    __tablename__ = "fetch_queue"
+
+    # Statuses of a queued domain.
+    QUEUED = "queued"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+    # The domains of a fetch campaign shared by several workers (processes or
+    # machines) against the same database. A worker leases the domains it
+    # claims until lease_expires, renewing the lease while it works on them,
+    # so that the domains of a dead worker are taken over once it expires.
+    job_name = Column(String, primary_key=True)
+    domain_name = Column(String, primary_key=True)
+    status = Column(String, nullable=False, default=QUEUED)
+    lease_owner = Column(String)
+    lease_expires = Column(DateTime)
+    attempts = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+    __table_args__ = (
+        Index("ix_fetch_queue_job_status", "job_name", "status", "lease_expires"),
+    )
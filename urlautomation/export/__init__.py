@@ -0,0 +1,4 @@
+"""@package urlautomation.export
+This package contains the exporters used to write reports to files in
+formats suitable for other tools.
+"""
@@ -0,0 +1,61 @@
+"""@package urlautomation.export.exporter
+This module contains the base class of the streaming exporters.
+"""
+
+from datetime import date, datetime
+from typing import Any, Dict, Iterable, List, TextIO, Tuple
+
+
+class Exporter:
+    """Base class for the streaming exporters.
+    Records are written as soon as they are produced, so exporters must not
+    hold on to them. Every record has a kind (e.g. "domain" or "relationship")
+    whose fields are known up front. Node records carry an "id" field, and
+    edge records carry "source" and "target" fields referring to node IDs.
+    """
+
+    def __init__(self, stream: TextIO, fields: Dict[str, List[str]]):
+        """Class constructor for Exporter.
+        @param stream The stream to write to.
+        @param fields The fields of each kind of record.
+        """
+        self._stream = stream
+        self._fields = fields
+
+    @staticmethod
+    def _format_value(value: Any) -> str:
+        """Formats a value for the text based formats."""
+        if value is None:
+            return ""
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        return str(value)
+
+    def begin(self, name: str) -> None:
+        """Write the header of the export.
+        @param name The name of the exported data set (e.g. the case name).
+        """
+
+    def write(self, kind: str, record: Dict[str, Any]) -> None:
+        """Write a single record."""
+        raise NotImplementedError("Subclasses should implement this method.")
+
+    def end(self) -> None:
+        """Write the footer of the export."""
+
+    def export(self, name: str, records: Iterable[Tuple[str, Dict[str, Any]]]) -> int:
+        """Write a complete export of the given records.
+        @param name The name of the exported data set.
+        @param records An iterable of (kind, record) tuples.
+        @return The number of records written.
+        """
+        count = 0
+        self.begin(name)
+        for kind, record in records:
+            self.write(kind, record)
+            count += 1
+        self.end()
+        self._stream.flush()
+        return count
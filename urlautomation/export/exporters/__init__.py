@@ -0,0 +1,19 @@
+from importlib import import_module
+
+# The exporters are only imported when they are used, so that the commands
+# reporting as text do not pay for importing them (GraphML needs xml.sax).
+ALL_EXPORTERS = {
+    "json": "urlautomation.export.exporters.jsondocument.JsonExporter",
+    "ndjson": "urlautomation.export.exporters.ndjson.NdjsonExporter",
+    "csv": "urlautomation.export.exporters.csvtable.CsvExporter",
+    "graphml": "urlautomation.export.exporters.graphml.GraphMLExporter",
+}
+
+
+def load_exporter(name: str) -> type:
+    """Imports and returns the class of an exporter.
+    @param name The name of the format, one of ALL_EXPORTERS.
+    @return The Exporter subclass.
+    """
+    module_name, _, class_name = ALL_EXPORTERS[name].rpartition(".")
+    return getattr(import_module(module_name), class_name)
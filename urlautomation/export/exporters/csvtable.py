@@ -0,0 +1,31 @@
+"""@package urlautomation.export.exporters.csvtable
+This module contains the exporter for CSV.
+"""
+
+from urlautomation.export.exporter import Exporter
+
+from typing import Any, Dict
+
+import csv
+
+
+class CsvExporter(Exporter):
+    """Writes a single CSV table. The columns are the "kind" of the record
+    followed by the union of the fields of all kinds of records, fields that
+    do not apply to a record are left empty.
+    """
+
+    def begin(self, name: str) -> None:
+        columns = ["kind"]
+        for fields in self._fields.values():
+            columns.extend(field for field in fields if field not in columns)
+        self._writer = csv.DictWriter(self._stream, fieldnames=columns, restval="")
+        self._writer.writeheader()
+
+    def write(self, kind: str, record: Dict[str, Any]) -> None:
+        self._writer.writerow(
+            {
+                "kind": kind,
+                **{field: self._format_value(value) for field, value in record.items()},
+            }
+        )
@@ -0,0 +1,59 @@
+"""@package urlautomation.export.exporters.graphml
+This module contains the exporter for GraphML.
+"""
+
+from urlautomation.export.exporter import Exporter
+
+from typing import Any, Dict
+from xml.sax.saxutils import escape, quoteattr
+
+
+class GraphMLExporter(Exporter):
+    """Writes a GraphML document. Records with "source" and "target" fields
+    become edges, all other records become nodes identified by their "id".
+    Every other field is written as a data attribute of the node or edge.
+    """
+
+    STRUCTURAL_FIELDS = ("id", "source", "target")
+
+    def begin(self, name: str) -> None:
+        self._stream.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+            '  <key id="kind" for="all" attr.name="kind" attr.type="string"/>\n'
+        )
+        declared = set()
+        for kind, fields in self._fields.items():
+            element = "edge" if "source" in fields else "node"
+            for field in fields:
+                if field in self.STRUCTURAL_FIELDS or (element, field) in declared:
+                    continue
+                declared.add((element, field))
+                self._stream.write(
+                    f'  <key id="{element}_{field}" for="{element}" '
+                    f'attr.name="{field}" attr.type="string"/>\n'
+                )
+        self._stream.write(f'  <graph id={quoteattr(name)} edgedefault="undirected">\n')
+
+    def write(self, kind: str, record: Dict[str, Any]) -> None:
+        if "source" in record:
+            element = "edge"
+            attributes = (
+                f"source={quoteattr(record['source'])} "
+                f"target={quoteattr(record['target'])}"
+            )
+        else:
+            element = "node"
+            attributes = f"id={quoteattr(record['id'])}"
+
+        data = [f'<data key="kind">{escape(kind)}</data>']
+        for field, value in record.items():
+            if field in self.STRUCTURAL_FIELDS or value is None:
+                continue
+            data.append(
+                f'<data key="{element}_{field}">{escape(self._format_value(value))}</data>'
+            )
+        self._stream.write(f"    <{element} {attributes}>{''.join(data)}</{element}>\n")
+
+    def end(self) -> None:
+        self._stream.write("  </graph>\n</graphml>\n")
@@ -0,0 +1,29 @@
+"""@package urlautomation.export.exporters.jsondocument
+This module contains the exporter for a single JSON document.
+"""
+
+from urlautomation.export.exporter import Exporter
+from urlautomation.export.serialization import json_default
+
+from typing import Any, Dict
+
+import json
+
+
+class JsonExporter(Exporter):
+    """Writes a single JSON document of the form
+    {"name": ..., "records": [{"kind": ..., ...}, ...]}.
+    The records array is written incrementally.
+    """
+
+    def begin(self, name: str) -> None:
+        self._first = True
+        self._stream.write(f'{{"name": {json.dumps(name)}, "records": [')
+
+    def write(self, kind: str, record: Dict[str, Any]) -> None:
+        self._stream.write("\n  " if self._first else ",\n  ")
+        self._stream.write(json.dumps({"kind": kind, **record}, default=json_default))
+        self._first = False
+
+    def end(self) -> None:
+        self._stream.write("\n]}\n")
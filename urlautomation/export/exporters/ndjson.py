@@ -0,0 +1,15 @@
+"""@package urlautomation.export.exporters.ndjson
+This module contains the exporter for newline delimited JSON.
+"""
+
+from urlautomation.export.exporter import Exporter
+from urlautomation.export.serialization import write_ndjson
+
+from typing import Any, Dict
+
+
+class NdjsonExporter(Exporter):
+    """Writes one JSON object per line, with the kind of the record in "kind"."""
+
+    def write(self, kind: str, record: Dict[str, Any]) -> None:
+        write_ndjson(self._stream, {"kind": kind, **record})
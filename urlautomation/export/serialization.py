@@ -0,0 +1,23 @@
+"""@package urlautomation.export.serialization
+This module contains the JSON serialization shared by the JSON exporters and
+the JSON output of the CLI, so that reports and command output render values
+the same way.
+"""
+
+from datetime import date, datetime
+from typing import Any, TextIO
+
+import json
+
+
+def json_default(value: Any) -> Any:
+    """Serializes values that the json module does not handle natively."""
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def write_ndjson(stream: TextIO, record: Any) -> None:
+    """Writes a record as a single line of JSON (newline delimited JSON)."""
+    stream.write(json.dumps(record, separators=(",", ":"), default=json_default))
+    stream.write("\n")
@@ -0,0 +1,279 @@
+"""@package urlautomation.export.snapshot
+This module contains the columnar snapshot export of the database.
+Each table is written to Parquet files, one directory per table, so that
+analytics can scan whole columns (e.g. with pyarrow.dataset or pandas) instead
+of reading the database row by row through the ORM. Rows are streamed from
+SQLite in chunks, without going through the ORM, and converted to Arrow arrays
+column by column. Repeated strings (issuers, identities, algorithms...) are
+dictionary encoded.
+Snapshots are incremental: the manifest of the snapshot directory records the
+highest rowid exported from each table (its watermark), and the next snapshot
+only appends the rows inserted since then as a new part file. Tables whose
+rows are updated or deleted in place (cases, degrees...) are small, and are
+written again in full by every snapshot. The watermarks are read in a single
+transaction, so a snapshot is consistent across tables.
+"""
+
+from urlautomation.database.types import SCHEMA_VERSION, Base
+
+from sqlalchemy import DateTime, Float, Integer, Table, Text
+
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import json
+import logging
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_FORMAT = 1
+
+# Exported tables. Append-only tables are exported incrementally, the others
+# are exported in full by every snapshot.
+APPEND_TABLES = [
+    "domains",
+    "ssl_certificates",
+    "ssl_certificates_identities",
+    "ssl_identity_domains",
+    "ct_log_entries",
+    "dns_records",
+    "a_record_values",
+    "a_record_ips",
+    "a_record_ip_association",
+    "a_record_organizations",
+    "ns_record_values",
+    "ns_record_nameservers",
+    "ns_record_nameserver_association",
+    "ns_record_organizations",
+    "organizations",
+]
+FULL_TABLES = ["cases", "case_domains", "entity_degrees", "domain_refresh"]
+
+
+def _arrow_type(column) -> pa.DataType:
+    """Returns the Arrow type of a column. Strings that are neither unique nor
+    long texts repeat across rows, and are dictionary encoded.
+    """
+    if isinstance(column.type, Integer):
+        return pa.int64()
+    if isinstance(column.type, Float):
+        return pa.float64()
+    if isinstance(column.type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(column.type, Text) or column.unique or column.primary_key:
+        return pa.string()
+    return pa.dictionary(pa.int32(), pa.string())
+
+
+def table_schema(table: Table) -> pa.Schema:
+    """Returns the Arrow schema of a table."""
+    return pa.schema(
+        [
+            pa.field(column.name, _arrow_type(column), nullable=column.nullable)
+            for column in table.columns
+        ]
+    )
+
+
+def _record_batch(schema: pa.Schema, rows: List[tuple]) -> pa.RecordBatch:
+    """Converts rows, as returned by SQLite, to a record batch."""
+    arrays = []
+    for field, values in zip(schema, zip(*rows)):
+        if pa.types.is_timestamp(field.type):
+            # SQLite stores timestamps as ISO strings.
+            arrays.append(pa.array(values, pa.string()).cast(field.type))
+        elif pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def _write_rows(
+    connection,
+    table: Table,
+    path: str,
+    low: int,
+    high: int,
+    chunk_size: int,
+) -> int:
+    """Writes the rows of a table with a rowid in (low, high] to a Parquet
+    file, a chunk of rows at a time.
+    @return The number of rows written.
+    """
+    schema = table_schema(table)
+    columns = ", ".join(f'"{column.name}"' for column in table.columns)
+    result = connection.exec_driver_sql(
+        f'SELECT {columns} FROM "{table.name}" '
+        "WHERE rowid > ? AND rowid <= ? ORDER BY rowid",
+        (low, high),
+    )
+    dictionary_columns = [
+        field.name for field in schema if pa.types.is_dictionary(field.type)
+    ]
+    count = 0
+    with pq.ParquetWriter(
+        path,
+        schema,
+        use_dictionary=dictionary_columns,
+        compression="zstd",
+    ) as writer:
+        while rows := result.fetchmany(chunk_size):
+            writer.write_batch(_record_batch(schema, rows))
+            count += len(rows)
+    return count
+
+
+def read_manifest(directory: str) -> Optional[Dict[str, Any]]:
+    """Returns the manifest of a snapshot directory, or None if it has none."""
+    path = os.path.join(directory, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _write_manifest(directory: str, manifest: Dict[str, Any]) -> None:
+    """Replaces the manifest of a snapshot directory atomically."""
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def export_snapshot(
+    session,
+    directory: str,
+    full: bool = False,
+    chunk_size: int = 65536,
+) -> Dict[str, Any]:
+    """Writes a snapshot of the database to a directory.
+    @param directory The snapshot directory, created if needed. If it holds a
+    previous snapshot, only the rows inserted since then are exported.
+    @param full Export every row again, replacing the previous snapshots.
+    @param chunk_size The number of rows converted at a time.
+    @return The manifest entry of the snapshot: its number, and the number of
+    rows and the watermark of each table.
+    """
+    os.makedirs(directory, exist_ok=True)
+    previous = read_manifest(directory)
+    manifest = previous
+    previous_files = set()
+    if previous is not None:
+        previous_files = {
+            file_name
+            for entry in previous["tables"].values()
+            for file_name in entry["files"]
+        }
+    if manifest is not None and manifest["schema_version"] != SCHEMA_VERSION:
+        logger.warning(
+            f"The snapshot in {directory} has schema version "
+            f"{manifest['schema_version']}, exporting a full snapshot."
+        )
+        full = True
+    if manifest is None or full:
+        manifest = {
+            "format": MANIFEST_FORMAT,
+            "schema_version": SCHEMA_VERSION,
+            "snapshots": [],
+            "tables": {},
+        }
+    # Part files are numbered after the last snapshot, even when replacing
+    # them, so that a failed export never overwrites the files of the manifest.
+    number = previous["snapshots"][-1]["snapshot"] + 1 if previous else 1
+
+    snapshot = {"snapshot": number, "created": datetime.now().isoformat(), "tables": {}}
+    connection = session.connection()
+    # The watermarks and the tables exported in full are read in a single
+    # (short) transaction. Rows of the append-only tables never change once
+    # inserted, so they are then streamed up to their watermark without
+    # blocking the writers.
+    with session.begin_nested():
+        watermarks = {
+            name: connection.exec_driver_sql(
+                f'SELECT coalesce(max(rowid), 0) FROM "{name}"'
+            ).scalar()
+            for name in APPEND_TABLES + FULL_TABLES
+        }
+        for name in FULL_TABLES:
+            _export_table(
+                connection,
+                directory,
+                manifest,
+                snapshot,
+                name,
+                0,
+                watermarks[name],
+                chunk_size,
+            )
+    for name in APPEND_TABLES:
+        entry = manifest["tables"].get(name)
+        low = entry["watermark"] if entry else 0
+        if entry and watermarks[name] <= low:
+            snapshot["tables"][name] = {"rows": 0, "watermark": low}
+            continue
+        _export_table(
+            connection,
+            directory,
+            manifest,
+            snapshot,
+            name,
+            low,
+            watermarks[name],
+            chunk_size,
+        )
+
+    manifest["snapshots"].append(snapshot)
+    _write_manifest(directory, manifest)
+    # Remove the files of the previous snapshots that were replaced.
+    current = {
+        file_name
+        for entry in manifest["tables"].values()
+        for file_name in entry["files"]
+    }
+    for file_name in previous_files - current:
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            os.remove(path)
+    return snapshot
+
+
+def _export_table(
+    connection,
+    directory: str,
+    manifest: Dict[str, Any],
+    snapshot: Dict[str, Any],
+    name: str,
+    low: int,
+    high: int,
+    chunk_size: int,
+) -> None:
+    """Writes the rows of a table with a rowid in (low, high] to a new part
+    file, and records it in the manifest. Tables exported in full replace
+    their previous files.
+    """
+    os.makedirs(os.path.join(directory, name), exist_ok=True)
+    file_name = f"{name}/part-{snapshot['snapshot']:05d}.parquet"
+    rows = _write_rows(
+        connection,
+        Base.metadata.tables[name],
+        os.path.join(directory, file_name),
+        low,
+        high,
+        chunk_size,
+    )
+    logger.debug(f"Exported {rows} rows of {name}.")
+    entry = manifest["tables"].get(name)
+    if entry is None or name in FULL_TABLES:
+        entry = {"files": [], "rows": 0, "watermark": 0}
+    manifest["tables"][name] = {
+        "files": entry["files"] + [file_name],
+        "rows": entry["rows"] + rows,
+        "watermark": high,
+    }
+    snapshot["tables"][name] = {"rows": rows, "watermark": high}
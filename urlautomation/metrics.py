@@ -0,0 +1,190 @@
+"""@package urlautomation.metrics
+This module contains the built-in instrumentation of the URL Automation project.
+Timers and counters are recorded per stage (HTTP requests, parsing, database
+queries and commits, ingestion), with optional labels, in a process-wide
+registry. They can be exported as JSON or as a Prometheus textfile (e.g. for
+the node_exporter textfile collector).
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Tuple
+
+import json
+import os
+import time
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+
+class Metrics:
+    """Registry of the timers and counters of the process."""
+
+    # Prefix of the metric names in the Prometheus export.
+    PREFIX = "urlautomation_"
+    # Upper bounds (in seconds) of the histogram buckets of the timers.
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+    def __init__(self):
+        """Class constructor for Metrics."""
+        self.reset()
+
+    def reset(self) -> None:
+        """Discards all recorded values."""
+        # (count, total seconds, max seconds, *bucket counts) of each timer.
+        self._timers: Dict[Tuple[str, LabelSet], List[float]] = {}
+        self._counters: Dict[Tuple[str, LabelSet], float] = defaultdict(int)
+        self._started = time.time()
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, LabelSet]:
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        """Records a duration of a timer.
+        @param name The name of the timer (the stage being timed).
+        @param seconds The duration to record.
+        @param labels Labels distinguishing the series of the timer.
+        """
+        timer = self._timers.setdefault(
+            self._key(name, labels), [0, 0.0, 0.0] + [0] * len(self.BUCKETS)
+        )
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+        for i, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                timer[3 + i] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        """Times the enclosed block, see observe()."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def count(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Increments a counter.
+        @param name The name of the counter.
+        @param value The value to add.
+        @param labels Labels distinguishing the series of the counter.
+        """
+        self._counters[self._key(name, labels)] += value
+
+    def total(self, name: str) -> float:
+        """Returns the value of a counter, summed over all its series."""
+        return sum(
+            value for (counter, _), value in self._counters.items() if counter == name
+        )
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Returns all the recorded values as a JSON serializable dictionary."""
+        return {
+            "started": self._started,
+            "duration_seconds": time.time() - self._started,
+            "timers": [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": count,
+                    "total_seconds": total,
+                    "max_seconds": maximum,
+                    "buckets": dict(zip(map(str, self.BUCKETS), buckets)),
+                }
+                for (name, labels), (count, total, maximum, *buckets) in sorted(
+                    self._timers.items()
+                )
+            ],
+            "counters": [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in sorted(self._counters.items())
+            ],
+        }
+
+    def merge(self, snapshot: Dict[str, Any]) -> None:
+        """Adds the values of a snapshot (e.g. of a worker process) to the
+        recorded values.
+        @param snapshot A dictionary returned by snapshot().
+        """
+        for timer in snapshot["timers"]:
+            values = self._timers.setdefault(
+                self._key(timer["name"], timer["labels"]),
+                [0, 0.0, 0.0] + [0] * len(self.BUCKETS),
+            )
+            values[0] += timer["count"]
+            values[1] += timer["total_seconds"]
+            values[2] = max(values[2], timer["max_seconds"])
+            for i, bound in enumerate(self.BUCKETS):
+                values[3 + i] += timer["buckets"][str(bound)]
+        for counter in snapshot["counters"]:
+            self._counters[self._key(counter["name"], counter["labels"])] += counter[
+                "value"
+            ]
+
+    @staticmethod
+    def _labels(labels: LabelSet) -> str:
+        if not labels:
+            return ""
+        escaped = (
+            (key, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for key, value in labels
+        )
+        return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+    def to_prometheus(self) -> str:
+        """Returns all the recorded values in the Prometheus text format.
+        Timers are exported as histograms (cumulative _bucket, _sum and _count)
+        and a _max gauge, counters with a _total suffix.
+        """
+        lines = []
+        timers = defaultdict(list)
+        for (name, labels), values in sorted(self._timers.items()):
+            timers[name].append((labels, values))
+        for name, series in timers.items():
+            metric = f"{self.PREFIX}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for labels, (count, total, _, *buckets) in series:
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    bucket_labels = self._labels(labels + (("le", str(bound)),))
+                    lines.append(f"{metric}_bucket{bucket_labels} {bucket}")
+                inf_labels = self._labels(labels + (("le", "+Inf"),))
+                lines.append(f"{metric}_bucket{inf_labels} {count}")
+                lines.append(f"{metric}_sum{self._labels(labels)} {total}")
+                lines.append(f"{metric}_count{self._labels(labels)} {count}")
+            lines.append(f"# TYPE {metric}_max gauge")
+            for labels, (_, _, maximum, *_) in series:
+                lines.append(f"{metric}_max{self._labels(labels)} {maximum}")
+
+        counters = defaultdict(list)
+        for (name, labels), value in sorted(self._counters.items()):
+            counters[name].append((labels, value))
+        for name, series in counters.items():
+            metric = f"{self.PREFIX}{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for labels, value in series:
+                lines.append(f"{metric}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, format: str = None) -> None:
+        """Writes all the recorded values to a file. The file is replaced
+        atomically, as expected by the Prometheus textfile collector.
+        @param path The path of the file to write.
+        @param format "json" or "prometheus", defaults to "prometheus" for
+        files with a .prom extension and "json" otherwise.
+        """
+        if format is None:
+            format = "prometheus" if path.endswith(".prom") else "json"
+        if format == "prometheus":
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.snapshot(), indent=2) + "\n"
+        temporary_path = f"{path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as metrics_file:
+            metrics_file.write(content)
+        os.replace(temporary_path, path)
+
+
+# The registry of the process.
+METRICS = Metrics()